@@ -0,0 +1,15 @@
+from .fhir import AsyncFHIRClient, FHIRClient, FHIRRequestError
+from .registry import LibraryRegistry
+from .cache import ResultCache
+from .timing import PhaseTimer
+from .gc import AsyncResourceCollector, ResourceCollector
+from .query import (
+    AsyncCQLQueryClient,
+    AsyncQueryResult,
+    CQLQueryClient,
+    Granularity,
+    QueryResult,
+)
+from .batch import AsyncBatchExecutor, BatchExecutor, BatchResult
+from .load import AsyncLoadGenerator, LatencyHistogram, LoadGenerator, LoadReport
+from .cube import perform_cube_query, async_perform_cube_query
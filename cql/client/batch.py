@@ -0,0 +1,101 @@
+import asyncio
+import inspect
+import logging
+import time
+
+from cql.client.query import AsyncCQLQueryClient, Granularity
+
+DEFAULT_CONCURRENCY = 8
+END_OF_SPECS = object()
+
+
+class BatchResult:
+    def __init__(self, spec, result=None, error=None, elapsed=None):
+        self.spec = spec
+        self.result = result
+        self.error = error
+        self.elapsed = elapsed
+
+
+class AsyncBatchExecutor:
+    """
+    Runs the queries of an iterable of hashable specs, at most concurrency at
+    a time. build_query(spec) returns the (cql_query, parameters) of a spec,
+    or is a coroutine function returning them: it runs on the event loop, so
+    it must not call the synchronous FHIRClient.
+    Identical specs are run only once; the specs are read lazily, only when
+    a slot is free and the previous results have been consumed, and each
+    BatchResult is yielded as soon as its query finishes
+    """
+
+    def __init__(
+        self,
+        query_client: AsyncCQLQueryClient,
+        build_query,
+        granularity=Granularity.COUNT,
+        concurrency=DEFAULT_CONCURRENCY,
+    ):
+        self.query_client = query_client
+        self.build_query = build_query
+        self.granularity = granularity
+        self.concurrency = concurrency
+
+    async def execute(self, spec):
+        start = time.perf_counter()
+        try:
+            query = self.build_query(spec)
+            if inspect.isawaitable(query):
+                query = await query
+            cql_query, parameters = query
+            result = await self.query_client.perform_cql_query(
+                cql_query, self.granularity, parameters
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.debug("Query %s failed: %s" % (spec, e))
+            return BatchResult(spec, error=e, elapsed=time.perf_counter() - start)
+        return BatchResult(spec, result=result, elapsed=time.perf_counter() - start)
+
+    async def run(self, specs):
+        seen = set()
+        pending = set()
+        specs = iter(specs)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < self.concurrency:
+                    spec = next(specs, END_OF_SPECS)
+                    if spec is END_OF_SPECS:
+                        exhausted = True
+                    elif spec not in seen:
+                        seen.add(spec)
+                        pending.add(asyncio.ensure_future(self.execute(spec)))
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+
+class BatchExecutor:
+    """
+    Synchronous wrapper around AsyncBatchExecutor, running on the event loop
+    of the given FHIRClient
+    """
+
+    def __init__(self, query_client, build_query, **kwargs):
+        self.fhir_client = query_client.fhir_client
+        self.async_executor = AsyncBatchExecutor(
+            query_client.async_client, build_query, **kwargs
+        )
+
+    def run(self, specs):
+        return self.fhir_client.iterate(self.async_executor.run(specs), batch_size=1)
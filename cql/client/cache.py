@@ -0,0 +1,204 @@
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024  # serialized size of the results kept in memory
+DEFAULT_DISK_CACHE_SIZE = 100000
+DEFAULT_CACHE_TTL = 60 * 60  # seconds
+# seconds a watermark is reused before the _history is read again: a change
+# can go unnoticed for at most this long
+DEFAULT_WATERMARK_TTL = 1
+WATERMARK_RESOURCE_TYPES = ["Consent", "Specimen"]
+
+
+def canonicalize_cql_query(cql_query):
+    # indentation and blank lines do not change the meaning of the query
+    return "\n".join(line.strip() for line in cql_query.splitlines() if line.strip())
+
+
+def canonicalize_parameters(parameters):
+    return sorted(
+        json.dumps(p.get_resource(), sort_keys=True) for p in parameters or []
+    )
+
+
+def get_history_timestamp(bundle):
+    for entry in bundle.get("entry", []):
+        resource = entry.get("resource") or {}
+        return entry.get("response", {}).get("lastModified") or resource.get(
+            "meta", {}
+        ).get("lastUpdated")
+    return None
+
+
+class ResultCache:
+    """
+    LRU cache of query results with a TTL and an optional sqlite tier on
+    disk. Every result is stored with the watermark of the data it was
+    computed from, i.e. the time of the last change (update or deletion) of
+    a Consent or a Specimen, and is only returned while the watermark is
+    unchanged, so that a consent withdrawal is never hidden by a stale count.
+    Results are kept serialized, bounded by max_size entries and max_bytes,
+    and every get returns a new copy, which callers are free to modify
+    """
+
+    def __init__(
+        self,
+        max_size=DEFAULT_CACHE_SIZE,
+        ttl=DEFAULT_CACHE_TTL,
+        path=None,
+        max_disk_size=DEFAULT_DISK_CACHE_SIZE,
+        max_bytes=DEFAULT_CACHE_BYTES,
+        watermark_ttl=DEFAULT_WATERMARK_TTL,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.max_disk_size = max_disk_size
+        self.max_bytes = max_bytes
+        self.watermark_ttl = watermark_ttl
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+        self._watermarks = {}
+        self._lock = threading.Lock()
+        self._connection = None
+        if path is not None:
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, watermark TEXT, created REAL, value TEXT)"
+            )
+            self._connection.commit()
+
+    @staticmethod
+    def make_key(base_url, cql_query, parameters, granularity):
+        content = json.dumps(
+            {
+                "server": base_url,
+                "cql": canonicalize_cql_query(cql_query),
+                "parameters": canonicalize_parameters(parameters),
+                "granularity": granularity.value,
+            },
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def make_search_key(base_url, params, granularity):
+        content = json.dumps(
+            {
+                "server": base_url,
+                "search": sorted(params.items()),
+                "granularity": granularity.value,
+            },
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    async def fetch_watermark(fhir_client):
+        bundles = await asyncio.gather(
+            *(
+                fhir_client.request("GET", f"{resource_type}/_history", params={"_count": "1"})
+                for resource_type in WATERMARK_RESOURCE_TYPES
+            )
+        )
+        return "|".join(get_history_timestamp(bundle) or "" for bundle in bundles)
+
+    async def get_watermark(self, fhir_client):
+        """
+        Returns the watermark of the server, read again only when the last one
+        is older than watermark_ttl seconds
+        """
+        with self._lock:
+            watermark = self._watermarks.get(fhir_client.base_url)
+        if watermark is not None and time.monotonic() - watermark[0] < self.watermark_ttl:
+            return watermark[1]
+        fetched = time.monotonic()
+        value = await ResultCache.fetch_watermark(fhir_client)
+        with self._lock:
+            self._watermarks[fhir_client.base_url] = (fetched, value)
+        return value
+
+    def _is_valid(self, watermark, created, entry_watermark):
+        return entry_watermark == watermark and time.time() - created < self.ttl
+
+    def get(self, key, watermark):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._is_valid(watermark, entry[1], entry[0]):
+                    self._entries.move_to_end(key)
+                    return json.loads(entry[2])
+                self._remove(key)
+            if self._connection is None:
+                return None
+            row = self._connection.execute(
+                "SELECT watermark, created, value FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if not self._is_valid(watermark, row[1], row[0]):
+                self._connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._connection.commit()
+                return None
+            self._store(key, (row[0], row[1], row[2]))
+            return json.loads(row[2])
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size_bytes -= len(entry[2])
+
+    def _store(self, key, entry):
+        if key in self._entries:
+            self._remove(key)
+        if len(entry[2]) > self.max_bytes:
+            # too large to be kept in memory: only the disk tier has it
+            return
+        self._entries[key] = entry
+        self.size_bytes += len(entry[2])
+        while len(self._entries) > self.max_size or self.size_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def put(self, key, watermark, value):
+        created = time.time()
+        value = json.dumps(value)
+        with self._lock:
+            self._store(key, (watermark, created, value))
+            if self._connection is None:
+                return
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (key, watermark, created, value),
+            )
+            self._connection.execute(
+                "DELETE FROM cache WHERE key NOT IN "
+                "(SELECT key FROM cache ORDER BY created DESC LIMIT ?)",
+                (self.max_disk_size,),
+            )
+            self._connection.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._watermarks.clear()
+            self.size_bytes = 0
+            if self._connection is not None:
+                self._connection.execute("DELETE FROM cache")
+                self._connection.commit()
+        logging.debug("Result cache cleared")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
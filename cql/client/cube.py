@@ -0,0 +1,147 @@
+from cql.models import Parameter, Stratifier, StratifierComponent
+
+GENDER = "Gender"
+AGE_CLASS = "AgeClass"
+SAMPLE_TYPE = "SampleType"
+DIAGNOSIS = "Diagnosis"
+CCE_DECISION = "CCEDecision"
+CUBE_STRATIFIER = "Cube"
+
+CUBE_DIMENSIONS = {
+    GENDER: """
+    define Gender:
+      Patient.gender
+    """,
+    AGE_CLASS: """
+    define AgeClass:
+      ((years between Patient.birthDate and Today()) div 10) * 10
+    """,
+    SAMPLE_TYPE: """
+    define SampleType:
+      First(
+        Specimen.type.coding C
+        where C.system = 'https://fhir.bbmri.de/CodeSystem/SampleMaterialType'
+        return C.code
+      )
+    """,
+    DIAGNOSIS: """
+    define Diagnosis:
+      First(
+        flatten (
+          Specimen.extension E
+          where E.url = 'https://fhir.bbmri.de/StructureDefinition/SampleDiagnosis'
+          return (E.value.coding C where C.system = 'http://hl7.org/fhir/sid/icd-10' return C.code)
+        )
+      )
+    """,
+    CCE_DECISION: """
+    define CCEDecision:
+      if Specimen.id in PermittedSpecimenIds then 'permit'
+      else if Specimen.id in DeniedSpecimenIds then 'deny'
+      else 'none'
+    """,
+}
+
+CONSENT_DECISIONS = """
+    define PermittedSpecimenIds:
+        flatten (
+            [Consent] C
+            return flatten (
+                C.provision.provision Q
+                return flatten (
+                    Q.data D
+                    where Q.type = 'permit' and CCECode in Q.code.coding.code
+                    return Split(D.reference.reference, '/')[1]
+                    )
+                )
+        )
+
+    define DeniedSpecimenIds:
+        flatten (
+            [Consent] C
+            return flatten (
+                C.provision.provision Q
+                return flatten (
+                    Q.data D
+                    where Q.type = 'deny' and CCECode in Q.code.coding.code
+                    return Split(D.reference.reference, '/')[1]
+                    )
+                )
+        )
+"""
+
+
+def create_cube_cql_query(dimensions):
+    """
+    Returns a Specimen-context CQL library defining every Specimen as initial
+    population and one expression per dimension of the cube. The CCE decision
+    dimension refers to the CCE passed in the CCECode parameter
+    """
+    unknown = set(dimensions) - set(CUBE_DIMENSIONS)
+    if unknown:
+        raise ValueError(f"Unknown cube dimensions: {', '.join(sorted(unknown))}")
+    query = """
+    library ConsentSpecimenCube version '1.0.0'
+    using FHIR version '4.0.0'
+    include FHIRHelpers version '4.0.0'
+    """
+    if CCE_DECISION in dimensions:
+        query += "parameter CCECode String\n"
+        query += "context Unfiltered\n"
+        query += CONSENT_DECISIONS
+    query += "context Specimen\n"
+    query += "define Patient:\n singleton from ([Patient])\n"
+    query += "define InInitialPopulation:\n true\n"
+    for dimension in dimensions:
+        query += CUBE_DIMENSIONS[dimension]
+    return query
+
+
+def create_cube_stratifiers(dimensions, joint=True):
+    """
+    With joint, returns a single stratifier with one component per dimension,
+    whose strata are the cells of the cube; otherwise one stratifier per
+    dimension, whose strata are the marginal counts
+    """
+    if joint:
+        return [
+            Stratifier(
+                expression=None,
+                code=CUBE_STRATIFIER,
+                components=[StratifierComponent(d, d) for d in dimensions],
+            )
+        ]
+    return [Stratifier(expression=d, code=d) for d in dimensions]
+
+
+def create_cube_parameters(cce_code=None):
+    return [Parameter("CCECode", cce_code)] if cce_code is not None else None
+
+
+def create_cube_query(dimensions, cce_code=None, joint=True):
+    if CCE_DECISION in dimensions and cce_code is None:
+        raise ValueError(f"The {CCE_DECISION} dimension requires a CCE code")
+    return (
+        create_cube_cql_query(dimensions),
+        create_cube_stratifiers(dimensions, joint),
+        create_cube_parameters(cce_code),
+    )
+
+
+def perform_cube_query(query_client, dimensions, cce_code=None, joint=True):
+    """
+    Evaluates the cube with a single $evaluate-measure and returns its strata:
+    with joint, a list of rows mapping each dimension to its value, plus the
+    count; otherwise a dict of such lists, one per dimension
+    """
+    strata = query_client.perform_stratified_query(
+        *create_cube_query(dimensions, cce_code, joint)
+    )
+    return strata[CUBE_STRATIFIER] if joint else strata
+
+
+async def async_perform_cube_query(query_client, dimensions, cce_code=None, joint=True):
+    strata = await query_client.perform_stratified_query(
+        *create_cube_query(dimensions, cce_code, joint)
+    )
+    return strata[CUBE_STRATIFIER] if joint else strata
@@ -0,0 +1,311 @@
+import asyncio
+import logging
+import threading
+from urllib.parse import urlsplit
+
+import aiohttp
+from aiohttp import web
+
+from cql.client.stream import BundleParser
+
+FHIR_REQUEST_HEADER = {"Content-type": "application/fhir+json"}
+DEFAULT_POOL_SIZE = 100
+DEFAULT_POOL_SIZE_PER_HOST = 32
+DEFAULT_KEEPALIVE_TIMEOUT = 30
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_BATCH_SIZE = 500
+MISSING_STATUSES = (404, 410)  # the resource is not, or no longer, on the server
+
+
+def get_link(bundle, relation):
+    for link in bundle.get("link", []):
+        if link.get("relation") == relation:
+            return link.get("url")
+    return None
+
+
+async def iterate_list(items):
+    for item in items:
+        yield item
+
+
+async def next_batch(async_iterator, size):
+    items = []
+    try:
+        while len(items) < size:
+            items.append(await async_iterator.__anext__())
+    except StopAsyncIteration:
+        return items, True
+    return items, False
+
+
+class FHIRRequestError(Exception):
+    def __init__(self, status, outcome):
+        super(FHIRRequestError, self).__init__(outcome)
+        self.status = status
+        self.outcome = outcome
+
+
+class AsyncFHIRClient:
+    """
+    asyncio FHIR client backed by a single aiohttp.ClientSession, so that
+    connections to the FHIR server are kept alive and reused across requests
+    """
+
+    def __init__(
+        self,
+        base_url,
+        pool_size=DEFAULT_POOL_SIZE,
+        pool_size_per_host=DEFAULT_POOL_SIZE_PER_HOST,
+        keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+        timeout=None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = pool_size
+        self.pool_size_per_host = pool_size_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=FHIR_REQUEST_HEADER,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    def url(self, path):
+        if path.startswith("http://") or path.startswith("https://"):
+            # paging links are built by the server from its own BASE_URL, which
+            # may not be the address the client is using to reach it
+            base = urlsplit(self.base_url)
+            return urlsplit(path)._replace(scheme=base.scheme, netloc=base.netloc).geturl()
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    async def request(self, method, path, json=None, params=None, headers=None):
+        url = self.url(path)
+        logging.debug("Performing request to %s" % url)
+        try:
+            async with self._get_session().request(
+                method,
+                url,
+                json=json.get_resource() if json is not None else None,
+                params=params,
+                headers=headers,
+            ) as res:
+                body = await res.json(content_type=None)
+                status = res.status
+        except aiohttp.ClientConnectionError:
+            raise web.HTTPInternalServerError(reason="Error contacting data service")
+
+        if status not in (200, 201):
+            logging.debug("Error performing the request. Returned code %s" % status)
+            raise FHIRRequestError(status, body)
+        return body
+
+    async def stream_entries(self, path, params=None, parser=None, headers=None):
+        parser = parser if parser is not None else BundleParser()
+        url = self.url(path)
+        logging.debug("Performing streaming request to %s" % url)
+        try:
+            async with self._get_session().get(url, params=params, headers=headers) as res:
+                if res.status != 200:
+                    body = await res.json(content_type=None)
+                    logging.debug(
+                        "Error performing the request. Returned code %s" % res.status
+                    )
+                    raise FHIRRequestError(res.status, body)
+                async for chunk in res.content.iter_chunked(DEFAULT_CHUNK_SIZE):
+                    for entry in parser.feed(chunk):
+                        yield entry
+                for entry in parser.close():
+                    yield entry
+        except aiohttp.ClientConnectionError:
+            raise web.HTTPInternalServerError(reason="Error contacting data service")
+
+    async def fetch_page(self, path, params=None, fields=None, headers=None):
+        parser = BundleParser(fields)
+        entries = [
+            entry async for entry in self.stream_entries(path, params, parser, headers)
+        ]
+        return parser, entries
+
+    async def iter_pages(self, path, params=None, prefetch=True):
+        page = await self.request("GET", path, params=params)
+        next_page = None
+        try:
+            while page is not None:
+                next_url = get_link(page, "next")
+                if next_url is not None and prefetch:
+                    next_page = asyncio.ensure_future(self.request("GET", next_url))
+                yield page
+                if next_page is not None:
+                    page, next_page = await next_page, None
+                elif next_url is not None:
+                    page = await self.request("GET", next_url)
+                else:
+                    page = None
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def iter_entries(
+        self,
+        path,
+        params=None,
+        page_size=DEFAULT_PAGE_SIZE,
+        fields=None,
+        prefetch=True,
+        headers=None,
+    ):
+        """
+        Yields the entries of a search, following the next links. The current
+        page is parsed incrementally while it is received; as soon as its next
+        link is known, the following page is prefetched
+        """
+        params = dict(params or {})
+        params.setdefault("_count", page_size)
+        parser = BundleParser(fields)
+        page = self.stream_entries(path, params, parser, headers)
+        next_page = None
+        try:
+            while page is not None:
+                next_url = None
+                async for entry in page:
+                    if prefetch and next_page is None and next_url is None:
+                        next_url = get_link(parser.bundle, "next")
+                        if next_url is not None:
+                            next_page = asyncio.ensure_future(
+                                self.fetch_page(next_url, fields=fields, headers=headers)
+                            )
+                    yield entry
+                if next_page is not None:
+                    parser, entries = await next_page
+                    next_page = None
+                    page = iterate_list(entries)
+                elif get_link(parser.bundle, "next") is not None:
+                    next_url = get_link(parser.bundle, "next")
+                    parser = BundleParser(fields)
+                    page = self.stream_entries(next_url, None, parser, headers)
+                else:
+                    page = None
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def iter_resources(
+        self, path, params=None, page_size=DEFAULT_PAGE_SIZE, fields=None, prefetch=True
+    ):
+        async for entry in self.iter_entries(path, params, page_size, fields, prefetch):
+            yield entry["resource"]
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+class FHIRClient:
+    """
+    Synchronous wrapper around AsyncFHIRClient. The async client runs on a
+    private event loop in a daemon thread, so the connection pool outlives
+    each single call and the client can be shared between threads
+    """
+
+    def __init__(self, base_url, **kwargs):
+        self.async_client = AsyncFHIRClient(base_url, **kwargs)
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return self.async_client.base_url
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever,
+                    name="fhir-client-loop",
+                    daemon=True,
+                )
+                self._thread.start()
+            return self._loop
+
+    def run(self, coro):
+        if threading.current_thread() is self._thread:
+            # waiting on the loop from its own thread would never return
+            coro.close()
+            raise RuntimeError(
+                "FHIRClient called from its event loop, use its async_client instead"
+            )
+        return asyncio.run_coroutine_threadsafe(coro, self._get_loop()).result()
+
+    def request(self, method, path, json=None, params=None, headers=None):
+        return self.run(
+            self.async_client.request(
+                method, path, json=json, params=params, headers=headers
+            )
+        )
+
+    def iterate(self, async_iterator, batch_size=DEFAULT_BATCH_SIZE):
+        # items are moved from the event loop thread in batches, to avoid
+        # paying a thread round-trip for every single item
+        try:
+            while True:
+                items, exhausted = self.run(next_batch(async_iterator, batch_size))
+                yield from items
+                if exhausted:
+                    return
+        finally:
+            self.run(async_iterator.aclose())
+
+    def iter_pages(self, path, params=None, prefetch=True):
+        return self.iterate(self.async_client.iter_pages(path, params, prefetch), 1)
+
+    def iter_entries(
+        self, path, params=None, page_size=DEFAULT_PAGE_SIZE, fields=None, prefetch=True
+    ):
+        return self.iterate(
+            self.async_client.iter_entries(path, params, page_size, fields, prefetch)
+        )
+
+    def iter_resources(
+        self, path, params=None, page_size=DEFAULT_PAGE_SIZE, fields=None, prefetch=True
+    ):
+        return self.iterate(
+            self.async_client.iter_resources(path, params, page_size, fields, prefetch)
+        )
+
+    def close(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        asyncio.run_coroutine_threadsafe(self.async_client.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
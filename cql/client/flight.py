@@ -0,0 +1,36 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller starts the
+    call, the others wait for the same task and all of them get its result or
+    its exception. A caller being cancelled does not affect the others; the
+    call itself is cancelled when no caller is waiting for it anymore
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    async def do(self, key, function, *args):
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = [asyncio.ensure_future(function(*args)), 0]
+            call[0].add_done_callback(lambda _: self._forget(key, call))
+        call[1] += 1
+        try:
+            return await asyncio.shield(call[0])
+        finally:
+            call[1] -= 1
+            if call[1] == 0 and not call[0].done():
+                # a later caller with the same key starts a new call instead
+                # of joining the cancelled one
+                self._forget(key, call)
+                call[0].cancel()
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import web
+
+from cql.client.fhir import DEFAULT_PAGE_SIZE, FHIRRequestError
+from cql.models import DeletionBundle
+
+TRANSIENT_TAG_SYSTEM = "https://github.com/crs4/consent-cql-client/CodeSystem/tags"
+TRANSIENT_TAG_CODE = "transient"
+DEFAULT_GC_BATCH_SIZE = 100
+DEFAULT_GC_TTL = 24 * 60 * 60  # seconds after which the sweeper deletes leftovers
+TRANSIENT_RESOURCE_TYPES = ["Measure", "Library"]
+
+
+def transient_tag():
+    return {"system": TRANSIENT_TAG_SYSTEM, "code": TRANSIENT_TAG_CODE}
+
+
+def get_sweep_cutoff(ttl):
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=ttl)
+    return cutoff.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class AsyncResourceCollector:
+    """
+    Deletes the transient resources (Library, Measure and subject List)
+    created by the queries. Tracked resources are deleted in the background,
+    batch_size at a time, with batch Bundles; the Libraries and Measures
+    are also tagged as transient, so that sweep() can remove the ones left
+    behind by crashed runs once they are older than the ttl. The Lists of
+    cql.consent.ConsentLists are long-lived and never swept
+    """
+
+    def __init__(
+        self, fhir_client, batch_size=DEFAULT_GC_BATCH_SIZE, ttl=DEFAULT_GC_TTL
+    ):
+        self.fhir_client = fhir_client
+        self.batch_size = batch_size
+        self.ttl = ttl
+        self._pending = []
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def track(self, resource_type, id):
+        self._pending.append(f"{resource_type}/{id}")
+        if len(self._pending) >= self.batch_size:
+            self._schedule()
+
+    def _schedule(self):
+        while self._pending:
+            references = self._pending[: self.batch_size]
+            del self._pending[: self.batch_size]
+            task = asyncio.get_running_loop().create_task(self.delete(references))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def delete(self, references):
+        logging.debug("Deleting %s transient resources" % len(references))
+        try:
+            await self.fhir_client.request("POST", "", DeletionBundle(references))
+        except (FHIRRequestError, web.HTTPException) as e:
+            # what is left over is tagged, the sweeper will delete it later
+            logging.warning("Deletion of %s resources failed: %s" % (len(references), e))
+            return 0
+        return len(references)
+
+    async def flush(self):
+        self._schedule()
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    async def sweep(self, ttl=None, page_size=DEFAULT_PAGE_SIZE):
+        params = {
+            "_tag": f"{TRANSIENT_TAG_SYSTEM}|{TRANSIENT_TAG_CODE}",
+            "_lastUpdated": f"lt{get_sweep_cutoff(ttl if ttl is not None else self.ttl)}",
+        }
+        references = []
+        for resource_type in TRANSIENT_RESOURCE_TYPES:
+            async for resource in self.fhir_client.iter_resources(
+                resource_type, params=params, page_size=page_size, fields=[]
+            ):
+                references.append(f"{resource_type}/{resource['id']}")
+        deleted = 0
+        for i in range(0, len(references), self.batch_size):
+            deleted += await self.delete(references[i : i + self.batch_size])
+        logging.debug("Swept %s transient resources" % deleted)
+        return deleted
+
+
+class ResourceCollector:
+    """
+    Synchronous wrapper around AsyncResourceCollector, running on the event
+    loop of the given FHIRClient
+    """
+
+    def __init__(self, fhir_client, **kwargs):
+        self.fhir_client = fhir_client
+        self.async_collector = AsyncResourceCollector(fhir_client.async_client, **kwargs)
+
+    def __len__(self):
+        return len(self.async_collector)
+
+    def flush(self):
+        return self.fhir_client.run(self.async_collector.flush())
+
+    def sweep(self, ttl=None, page_size=DEFAULT_PAGE_SIZE):
+        return self.fhir_client.run(self.async_collector.sweep(ttl, page_size))
@@ -0,0 +1,248 @@
+import asyncio
+import inspect
+import logging
+import random
+import time
+
+from cql.client.query import AsyncCQLQueryClient, Granularity
+
+SUB_BUCKET_BITS = 7  # 128 sub-buckets per power of two: values within 1%
+DEFAULT_INTERVAL = 1.0  # seconds of each window of the timeline
+DEFAULT_MAX_IN_FLIGHT = 1000
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of latencies in nanoseconds: every power of two is
+    split in 2**SUB_BUCKET_BITS linear sub-buckets, so the memory is constant
+    and every recorded value is known with a bounded relative error
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+
+    @staticmethod
+    def bucket(value):
+        exponent = value.bit_length()
+        if exponent <= SUB_BUCKET_BITS:
+            return value
+        shift = exponent - SUB_BUCKET_BITS
+        return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+    @staticmethod
+    def bucket_value(bucket):
+        shift = bucket >> SUB_BUCKET_BITS
+        if shift == 0:
+            return bucket
+        # the middle of the sub-bucket
+        sub_bucket = bucket - (shift << SUB_BUCKET_BITS)
+        return (sub_bucket << shift) + (1 << (shift - 1))
+
+    def record(self, value):
+        bucket = self.bucket(max(int(value), 0))
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.total += other.total
+
+    def percentile(self, q):
+        if self.total == 0:
+            return None
+        rank = max(1, round(self.total * q / 100))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return self.bucket_value(bucket)
+        return self.bucket_value(max(self.counts))
+
+    def to_dict(self, unit=1e6):
+        return {
+            "count": self.total,
+            **{
+                f"p{q}": self.percentile(q) / unit if self.total else None
+                for q in (50, 90, 95, 99, 99.9)
+            },
+        }
+
+
+class LoadReport:
+    """
+    Latencies and errors of a load run, overall and per window of interval
+    seconds, by completion time
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.histogram = LatencyHistogram()
+        self.windows = {}
+        self.started = 0
+        self.completed = 0
+        self.errors = 0
+        self.dropped = 0
+        self.duration = None
+
+    def _window(self, elapsed):
+        index = int(elapsed // self.interval)
+        if index not in self.windows:
+            self.windows[index] = {"histogram": LatencyHistogram(), "errors": 0, "dropped": 0}
+        return self.windows[index]
+
+    def record(self, elapsed, latency, error=None):
+        window = self._window(elapsed)
+        if error is not None:
+            self.errors += 1
+            window["errors"] += 1
+            return
+        self.completed += 1
+        self.histogram.record(latency)
+        window["histogram"].record(latency)
+
+    def drop(self, elapsed):
+        self.dropped += 1
+        self._window(elapsed)["dropped"] += 1
+
+    def to_dict(self):
+        attempted = self.completed + self.errors + self.dropped
+        return {
+            "duration": self.duration,
+            "started": self.started,
+            "completed": self.completed,
+            "errors": self.errors,
+            "dropped": self.dropped,
+            "throughput": self.completed / self.duration if self.duration else None,
+            "error_rate": (self.errors + self.dropped) / attempted if attempted else None,
+            "latency_ms": self.histogram.to_dict(),
+            "timeline": [
+                {
+                    "start": index * self.interval,
+                    "throughput": window["histogram"].total / self.interval,
+                    "errors": window["errors"],
+                    "dropped": window["dropped"],
+                    "latency_ms": window["histogram"].to_dict(),
+                }
+                for index, window in sorted(self.windows.items())
+            ],
+        }
+
+
+class AsyncLoadGenerator:
+    """
+    Drives the query client with the queries built by build_query(spec) for
+    the specs drawn by next_spec(rng) (as in AsyncBatchExecutor, build_query
+    can be a coroutine function), either open loop, with Poisson arrivals
+    at a target rate, or closed loop, with a number of users each running one
+    query after the other. In open loop the latency is measured from the
+    scheduled arrival, so that a saturated server is not hidden by the
+    generator waiting for it; arrivals beyond max_in_flight are dropped.
+    The specs are drawn when each query is started, from a Random of their
+    own, so that the same seed always gives the same sequence of queries
+    whatever the arrival and think times, drawn from another one
+    """
+
+    def __init__(
+        self,
+        query_client: AsyncCQLQueryClient,
+        build_query,
+        next_spec,
+        granularity=Granularity.COUNT,
+        seed=None,
+        interval=DEFAULT_INTERVAL,
+        max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+    ):
+        self.query_client = query_client
+        self.build_query = build_query
+        self.next_spec = next_spec
+        self.granularity = granularity
+        self.rng = random.Random(seed)
+        self.timing_rng = random.Random(None if seed is None else f"{seed}:timing")
+        self.interval = interval
+        self.max_in_flight = max_in_flight
+
+    async def execute(self, report, start, scheduled, spec):
+        error = None
+        try:
+            query = self.build_query(spec)
+            if inspect.isawaitable(query):
+                query = await query
+            cql_query, parameters = query
+            await self.query_client.perform_cql_query(
+                cql_query, self.granularity, parameters
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.debug("Query failed: %s" % e)
+            error = e
+        now = time.perf_counter_ns()
+        report.record((now - start) / 1e9, now - scheduled, error)
+
+    async def run_open_loop(self, rate, duration):
+        report = LoadReport(self.interval)
+        tasks = set()
+        start = time.perf_counter_ns()
+        scheduled = start
+        end = start + int(duration * 1e9)
+        while True:
+            scheduled += int(self.timing_rng.expovariate(rate) * 1e9)
+            if scheduled >= end:
+                break
+            # drawn even for dropped arrivals, so that the n-th arrival always
+            # gets the same spec
+            spec = self.next_spec(self.rng)
+            delay = (scheduled - time.perf_counter_ns()) / 1e9
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if len(tasks) >= self.max_in_flight:
+                report.drop((scheduled - start) / 1e9)
+                continue
+            report.started += 1
+            task = asyncio.ensure_future(self.execute(report, start, scheduled, spec))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        report.duration = (time.perf_counter_ns() - start) / 1e9
+        return report
+
+    async def run_closed_loop(self, users, duration, think_time=0):
+        report = LoadReport(self.interval)
+        start = time.perf_counter_ns()
+        end = start + int(duration * 1e9)
+
+        async def user():
+            while time.perf_counter_ns() < end:
+                report.started += 1
+                spec = self.next_spec(self.rng)
+                await self.execute(report, start, time.perf_counter_ns(), spec)
+                if think_time:
+                    await asyncio.sleep(self.timing_rng.expovariate(1 / think_time))
+
+        await asyncio.gather(*[user() for _ in range(users)])
+        report.duration = (time.perf_counter_ns() - start) / 1e9
+        return report
+
+
+class LoadGenerator:
+    """
+    Synchronous wrapper around AsyncLoadGenerator, running on the event loop
+    of the given FHIRClient
+    """
+
+    def __init__(self, query_client, build_query, next_spec, **kwargs):
+        self.fhir_client = query_client.fhir_client
+        self.async_generator = AsyncLoadGenerator(
+            query_client.async_client, build_query, next_spec, **kwargs
+        )
+
+    def run_open_loop(self, rate, duration):
+        return self.fhir_client.run(self.async_generator.run_open_loop(rate, duration))
+
+    def run_closed_loop(self, users, duration, think_time=0):
+        return self.fhir_client.run(
+            self.async_generator.run_closed_loop(users, duration, think_time)
+        )
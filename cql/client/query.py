@@ -0,0 +1,692 @@
+import base64
+import contextlib
+import logging
+import secrets
+import uuid
+from datetime import datetime
+from enum import Enum
+
+from cql.client.cache import ResultCache
+from cql.client.fhir import DEFAULT_PAGE_SIZE, MISSING_STATUSES, FHIRRequestError
+from cql.client.flight import SingleFlight
+from cql.client.gc import AsyncResourceCollector, transient_tag
+from cql.client.registry import LibraryRegistry
+from cql.client.timing import PhaseTimer
+from cql.compiler import SPECIMEN, Query, compile_query
+from cql.compiler.search import SEARCH_HEADERS, plan_search
+from cql.models import (
+    Library,
+    Population,
+    Measure,
+    EvaluationMeasure,
+    TransactionBundle,
+)
+
+FHIR_LIBRARY_VERSION = "0.1.1"
+FHIR_MEASURE_YEAR_VERSION = "0.1.1"
+FHIR_MEASURE_EVALUATION_YEAR_START = "1900"
+FHIR_MEASURE_EVALUATION_YEAR_END = "2100"
+
+
+class Granularity(Enum):
+    RESOURCES = "RESOURCES"
+    COUNT = "COUNT"
+
+
+def encode(string):
+    return base64.b64encode(string.encode("ascii"))
+
+
+def generate_uuid():
+    return "urn:uuid:{uuid}".format(uuid=uuid.uuid1())
+
+
+def generate_creation_timestamp():
+    return f"{datetime.today().strftime('%Y-%m-%dT%H:%M:%S.%f%z')[:-3]}Z"
+
+
+def generate_id():
+    return secrets.token_hex(8)
+
+
+def initial_population():
+    return [Population(expression="InInitialPopulation", code="initial-population")]
+
+
+def get_population_count(evaluation_measure_results):
+    return evaluation_measure_results["group"][0]["population"][0]["count"]
+
+
+def get_strata(evaluation_measure_results):
+    """
+    Returns, for each stratifier of the MeasureReport, the list of its strata as
+    dicts mapping the stratifier (or component) codes to the stratum values,
+    plus the population count
+    """
+    strata = {}
+    for stratifier in evaluation_measure_results["group"][0].get("stratifier", []):
+        code = stratifier["code"][0].get("text")
+        rows = []
+        for stratum in stratifier.get("stratum", []):
+            if "component" in stratum:
+                row = {
+                    c["code"].get("text"): c["value"].get("text")
+                    for c in stratum["component"]
+                }
+            else:
+                row = {code: stratum.get("value", {}).get("text")}
+            row["count"] = stratum["population"][0]["count"]
+            rows.append(row)
+        strata[code] = rows
+    return strata
+
+
+def is_missing_search_parameter(outcome):
+    """
+    Tells whether an OperationOutcome reports an unknown search parameter,
+    e.g. because the custom SearchParameters are not loaded by the server
+    """
+    if not isinstance(outcome, dict):
+        return False
+    for issue in outcome.get("issue", []):
+        diagnostics = issue.get("diagnostics", "").lower()
+        if issue.get("code") == "not-supported" or "search-param" in diagnostics:
+            return True
+    return False
+
+
+def plan_report_type(granularity):
+    """
+    Returns the cheapest report type for the granularity: a count does not
+    need the server to build and store the subject List
+    """
+    if granularity == Granularity.COUNT:
+        return EvaluationMeasure.POPULATION
+    return EvaluationMeasure.SUBJECT_LIST
+
+
+def get_subject_list_id(evaluation_measure_results):
+    return evaluation_measure_results["group"][0]["population"][0][
+        "subjectResults"
+    ]["reference"][5:]
+
+
+class AsyncCQLQueryClient:
+    def __init__(
+        self,
+        fhir_client,
+        subject="Specimen",
+        registry: LibraryRegistry = None,
+        page_size=DEFAULT_PAGE_SIZE,
+        library_version=FHIR_LIBRARY_VERSION,
+        measure_version=FHIR_MEASURE_YEAR_VERSION,
+        period_start=FHIR_MEASURE_EVALUATION_YEAR_START,
+        period_end=FHIR_MEASURE_EVALUATION_YEAR_END,
+        transaction=False,
+        collector: AsyncResourceCollector = None,
+        cache: ResultCache = None,
+        search_fast_path=True,
+        timer: PhaseTimer = None,
+        coalesce=True,
+    ):
+        self.fhir_client = fhir_client
+        self.subject = subject
+        self.registry = registry
+        self.page_size = page_size
+        self.library_version = library_version
+        self.measure_version = measure_version
+        self.period_start = period_start
+        self.period_end = period_end
+        self.transaction = transaction
+        self.collector = collector
+        self.cache = cache
+        self.search_fast_path = search_fast_path
+        self.timer = timer
+        self.coalesce = coalesce
+        self._flights = SingleFlight()
+
+    def phase(self, name):
+        return self.timer.phase(name) if self.timer is not None else contextlib.nullcontext()
+
+    def get_tags(self):
+        # pairs kept in the registry are reused, only the others are transient
+        if self.collector is not None and self.registry is None:
+            return [transient_tag()]
+        return None
+
+    def collect(self, resource_type, id):
+        if self.collector is not None:
+            self.collector.track(resource_type, id)
+
+    def create_library(self, cql_query, url):
+        return Library(
+            version_id=self.library_version,
+            last_updated=generate_creation_timestamp(),
+            data=encode(cql_query).decode("ascii"),
+            id=generate_id(),
+            url=url,
+            tags=self.get_tags(),
+        )
+
+    def create_measure(self, populations, library_url, stratifiers=None):
+        return Measure(
+            stratifiers=stratifiers if stratifiers is not None else [],
+            populations=populations,
+            version_id=self.measure_version,
+            last_updated=generate_creation_timestamp(),
+            subject=self.subject,
+            library_url=library_url,
+            id=generate_id(),
+            tags=self.get_tags(),
+        )
+
+    def create_evaluation_measure(self, report_type, parameters=None):
+        return EvaluationMeasure(
+            period_start=self.period_start,
+            period_end=self.period_end,
+            report_type=report_type,
+            parameters=parameters,
+        )
+
+    def registry_key(self, cql_query, populations, stratifiers=None):
+        measure_shape = {
+            "subject": self.subject,
+            "populations": [p.get_resource() for p in populations],
+            "stratifiers": [s.get_resource() for s in stratifiers or []],
+            "library_version": self.library_version,
+            "measure_version": self.measure_version,
+        }
+        return LibraryRegistry.make_key(
+            self.fhir_client.base_url, cql_query, measure_shape
+        )
+
+    async def create_libraries_and_measures(self, queries):
+        """
+        Creates the Library/Measure pairs of the given (cql_query, populations,
+        library_url, stratifiers) tuples with a single transaction Bundle. The
+        ids are assigned by the client, so the Measures can be evaluated as soon
+        as the transaction returns
+        """
+        resources = []
+        for cql_query, populations, library_url, stratifiers in queries:
+            resources.append(self.create_library(cql_query, library_url))
+            resources.append(self.create_measure(populations, library_url, stratifiers))
+        logging.debug("POST transaction with %s Libraries and Measures" % len(resources))
+        with self.phase("transaction"):
+            await self.fhir_client.request("POST", "", TransactionBundle(resources))
+        logging.debug("Transaction completed")
+        return [
+            (library.id, measure.id)
+            for library, measure in zip(resources[::2], resources[1::2])
+        ]
+
+    async def create_library_and_measure(
+        self, cql_query, populations, library_url, stratifiers=None
+    ):
+        if self.transaction:
+            pairs = await self.create_libraries_and_measures(
+                [(cql_query, populations, library_url, stratifiers)]
+            )
+            return pairs[0]
+        library = self.create_library(cql_query, library_url)
+        logging.debug("POST Library")
+        with self.phase("library"):
+            created_library = await self.fhir_client.request("POST", "Library", library)
+        logging.debug("Library created")
+        measure = self.create_measure(populations, library_url, stratifiers)
+        logging.debug("Creating Measure")
+        logging.debug(measure.get_resource())
+        with self.phase("measure"):
+            created_measure = await self.fhir_client.request("POST", "Measure", measure)
+        logging.debug("Measure created")
+        return created_library["id"], created_measure["id"]
+
+    async def evaluate_measure(self, measure_id, report_type, parameters=None):
+        evaluation_measure = self.create_evaluation_measure(report_type, parameters)
+        logging.debug("Evaluating Measure")
+        logging.debug(evaluation_measure.get_resource())
+        with self.phase("evaluate"):
+            evaluation_measure_results = await self.fhir_client.request(
+                "POST",
+                f"Measure/{measure_id}/$evaluate-measure",
+                json=evaluation_measure,
+            )
+        logging.debug("Measure evaluated")
+        logging.debug(evaluation_measure_results)
+        return evaluation_measure_results
+
+    async def evaluate_cql_query(
+        self, cql_query, report_type, populations=None, parameters=None, stratifiers=None
+    ):
+        logging.debug(cql_query)
+        populations = populations if populations is not None else initial_population()
+        if self.registry is None:
+            library_id, measure_id = await self.create_library_and_measure(
+                cql_query, populations, generate_uuid(), stratifiers
+            )
+            try:
+                return await self.evaluate_measure(measure_id, report_type, parameters)
+            finally:
+                self.collect("Measure", measure_id)
+                self.collect("Library", library_id)
+
+        key = self.registry_key(cql_query, populations, stratifiers)
+        entry = self.registry.get(key)
+        if entry is not None:
+            logging.debug("Reusing Measure %s" % entry.measure_id)
+            try:
+                return await self.evaluate_measure(
+                    entry.measure_id, report_type, parameters
+                )
+            except FHIRRequestError as e:
+                # other errors (e.g. invalid parameters) leave the pair valid
+                if e.status not in MISSING_STATUSES:
+                    raise
+                logging.debug("Measure %s lost by the server" % entry.measure_id)
+                self.registry.discard(key)
+
+        library_url = LibraryRegistry.library_url(key)
+        library_id, measure_id = await self.create_library_and_measure(
+            cql_query, populations, library_url, stratifiers
+        )
+        # registered before the evaluation, so that a failing one does not
+        # leave an unregistered and untagged pair on the server
+        self.registry.put(key, library_url, library_id, measure_id)
+        return await self.evaluate_measure(measure_id, report_type, parameters)
+
+    async def prepare_cql_queries(self, cql_queries, populations=None, stratifiers=None):
+        """
+        Creates in one transaction the Library/Measure pairs of all the given
+        queries that are not in the registry yet, and returns the Measure ids
+        in the order of the queries
+        """
+        populations = populations if populations is not None else initial_population()
+        measure_ids = {}
+        missing = {}
+        for cql_query in cql_queries:
+            key = self.registry_key(cql_query, populations, stratifiers)
+            entry = self.registry.get(key) if self.registry is not None else None
+            if entry is not None:
+                measure_ids[cql_query] = entry.measure_id
+            elif cql_query not in missing:
+                library_url = (
+                    LibraryRegistry.library_url(key)
+                    if self.registry is not None
+                    else generate_uuid()
+                )
+                missing[cql_query] = (key, library_url)
+        if missing:
+            pairs = await self.create_libraries_and_measures(
+                [
+                    (cql_query, populations, library_url, stratifiers)
+                    for cql_query, (_, library_url) in missing.items()
+                ]
+            )
+            for (cql_query, (key, library_url)), (library_id, measure_id) in zip(
+                missing.items(), pairs
+            ):
+                if self.registry is not None:
+                    self.registry.put(key, library_url, library_id, measure_id)
+                measure_ids[cql_query] = measure_id
+        return [measure_ids[cql_query] for cql_query in cql_queries]
+
+    def iter_list_entries(self, list_id, fields=None):
+        return self.fhir_client.iter_entries(
+            self.subject,
+            params={"_list": list_id},
+            page_size=self.page_size,
+            fields=fields,
+        )
+
+    async def iter_report_entries(self, evaluation_measure_results, fields=None):
+        list_id = get_subject_list_id(evaluation_measure_results)
+        try:
+            async for entry in self.iter_list_entries(list_id, fields):
+                yield entry
+        finally:
+            self.collect("List", list_id)
+
+    async def iter_entries(self, cql_query: str, parameters=None, fields=None):
+        evaluation_measure_results = await self.evaluate_cql_query(
+            cql_query, EvaluationMeasure.SUBJECT_LIST, parameters=parameters
+        )
+        async for entry in self.iter_report_entries(evaluation_measure_results, fields):
+            yield entry
+
+    async def iter_resources(self, cql_query: str, parameters=None, fields=None):
+        async for entry in self.iter_entries(cql_query, parameters, fields):
+            yield entry["resource"]
+
+    async def query(self, cql_query: str, granularity: Granularity, parameters=None):
+        """
+        Evaluates the query with the report type planned for the granularity
+        and returns an AsyncQueryResult
+        """
+        report_type = plan_report_type(granularity)
+        if self.registry is not None:
+            evaluation_measure_results = await self.evaluate_cql_query(
+                cql_query, report_type, parameters=parameters
+            )
+            return AsyncQueryResult(
+                self, cql_query, parameters, report_type, evaluation_measure_results
+            )
+        # without a registry the pair is kept until the result is released,
+        # so that an upgrade evaluates the same Measure again
+        logging.debug(cql_query)
+        library_id, measure_id = await self.create_library_and_measure(
+            cql_query, initial_population(), generate_uuid()
+        )
+        try:
+            evaluation_measure_results = await self.evaluate_measure(
+                measure_id, report_type, parameters
+            )
+        except BaseException:
+            self.collect("Measure", measure_id)
+            self.collect("Library", library_id)
+            raise
+        return AsyncQueryResult(
+            self,
+            cql_query,
+            parameters,
+            report_type,
+            evaluation_measure_results,
+            library_id,
+            measure_id,
+        )
+
+    async def perform_stratified_query(
+        self, cql_query: str, stratifiers, parameters=None
+    ):
+        evaluation_measure_results = await self.evaluate_cql_query(
+            cql_query,
+            EvaluationMeasure.POPULATION,
+            parameters=parameters,
+            stratifiers=stratifiers,
+        )
+        return get_strata(evaluation_measure_results)
+
+    async def perform_cql_query(
+        self, cql_query: str, granularity: Granularity, parameters=None
+    ):
+        key = ResultCache.make_key(
+            self.fhir_client.base_url, cql_query, parameters, granularity
+        )
+        return await self.perform_cached(
+            key, self.compute_cql_query, cql_query, granularity, parameters
+        )
+
+    async def perform_cached(self, key, function, *args):
+        if not self.coalesce:
+            return await self.cached_query(key, function, *args)
+        # identical queries in flight share the same evaluation
+        return await self._flights.do(key, self.cached_query, key, function, *args)
+
+    async def cached_query(self, key, function, *args):
+        if self.cache is None:
+            return await function(*args)
+        watermark = await self.cache.get_watermark(self.fhir_client)
+        result = self.cache.get(key, watermark)
+        if result is not None:
+            logging.debug("Result found in cache")
+            return result
+        result = await function(*args)
+        self.cache.put(key, watermark, result)
+        return result
+
+    async def perform_search(self, params, granularity: Granularity):
+        key = ResultCache.make_search_key(self.fhir_client.base_url, params, granularity)
+        return await self.perform_cached(key, self.compute_search, params, granularity)
+
+    async def compute_search(self, params, granularity: Granularity):
+        if granularity == Granularity.COUNT:
+            with self.phase("search"):
+                bundle = await self.fhir_client.request(
+                    "GET",
+                    SPECIMEN,
+                    params={**params, "_summary": "count"},
+                    headers=SEARCH_HEADERS,
+                )
+            return bundle["total"]
+        with self.phase("search"):
+            fhir_entries = [
+                entry
+                async for entry in self.fhir_client.iter_entries(
+                    SPECIMEN,
+                    params=params,
+                    page_size=self.page_size,
+                    headers=SEARCH_HEADERS,
+                )
+            ]
+        return {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "total": len(fhir_entries),
+            "entry": fhir_entries,
+        }
+
+    async def perform_query(
+        self, query: Query, granularity: Granularity, parameters=None
+    ):
+        """
+        Answers the query with a FHIR search when it is a plain conjunction the
+        server can index (see plan_search), otherwise with its compiled CQL
+        """
+        params = plan_search(query) if self.search_fast_path else None
+        if params is not None:
+            try:
+                return await self.perform_search(params, granularity)
+            except FHIRRequestError as e:
+                if not 400 <= e.status < 500:
+                    raise
+                if is_missing_search_parameter(e.outcome):
+                    # the custom SearchParameters are not loaded by the server
+                    logging.warning("Search not supported by the server, using CQL: %s" % e)
+                    self.search_fast_path = False
+                else:
+                    logging.debug("Search failed, using CQL for this query: %s" % e)
+        return await self.perform_cql_query(compile_query(query), granularity, parameters)
+
+    async def compute_cql_query(self, cql_query, granularity, parameters=None):
+        async with await self.query(cql_query, granularity, parameters) as result:
+            if granularity == Granularity.COUNT:
+                return result.count
+            return await result.get_bundle()
+
+
+class AsyncQueryResult:
+    """
+    Lazy result of a query. The count is read from the MeasureReport; the
+    subject List is only requested (re-evaluating the Measure with a
+    subject-list report) the first time the resources are asked for. A
+    transient Library/Measure pair (no registry) is only handed to the
+    collector by release(), or on leaving an async with block, so that
+    the upgrade reuses it
+    """
+
+    def __init__(
+        self,
+        query_client,
+        cql_query,
+        parameters,
+        report_type,
+        evaluation_measure_results,
+        library_id=None,
+        measure_id=None,
+    ):
+        self.query_client = query_client
+        self.cql_query = cql_query
+        self.parameters = parameters
+        self.report_type = report_type
+        self.evaluation_measure_results = evaluation_measure_results
+        self.library_id = library_id
+        self.measure_id = measure_id
+        self._subject_list_results = (
+            evaluation_measure_results
+            if report_type == EvaluationMeasure.SUBJECT_LIST
+            else None
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+    @property
+    def count(self):
+        return get_population_count(self.evaluation_measure_results)
+
+    async def upgrade(self):
+        if self._subject_list_results is None:
+            logging.debug("Upgrading the result to a subject list")
+            if self.measure_id is not None:
+                self._subject_list_results = await self.query_client.evaluate_measure(
+                    self.measure_id, EvaluationMeasure.SUBJECT_LIST, self.parameters
+                )
+            else:
+                self._subject_list_results = await self.query_client.evaluate_cql_query(
+                    self.cql_query, EvaluationMeasure.SUBJECT_LIST, parameters=self.parameters
+                )
+        return self._subject_list_results
+
+    def release(self):
+        """
+        Hands the transient Library/Measure pair of the result to the
+        collector; upgrading afterwards creates a new one
+        """
+        if self.measure_id is not None:
+            self.query_client.collect("Measure", self.measure_id)
+            self.query_client.collect("Library", self.library_id)
+        self.library_id = self.measure_id = None
+
+    async def iter_entries(self, fields=None):
+        evaluation_measure_results = await self.upgrade()
+        # the List is collected once read, iterating again needs a new one
+        self._subject_list_results = None
+        async for entry in self.query_client.iter_report_entries(
+            evaluation_measure_results, fields
+        ):
+            yield entry
+
+    async def iter_resources(self, fields=None):
+        async for entry in self.iter_entries(fields):
+            yield entry["resource"]
+
+    async def get_bundle(self):
+        evaluation_measure_results = await self.upgrade()
+        self._subject_list_results = None
+        with self.query_client.phase("fetch"):
+            fhir_entries = [
+                entry
+                async for entry in self.query_client.iter_report_entries(
+                    evaluation_measure_results
+                )
+            ]
+        return {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "total": len(fhir_entries),
+            "entry": fhir_entries,
+        }
+
+
+class QueryResult:
+    """
+    Synchronous wrapper around AsyncQueryResult
+    """
+
+    def __init__(self, fhir_client, async_result: AsyncQueryResult):
+        self.fhir_client = fhir_client
+        self.async_result = async_result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    @property
+    def count(self):
+        return self.async_result.count
+
+    def release(self):
+        # the collector is driven from the event loop
+        self.fhir_client.run(self._release())
+
+    async def _release(self):
+        self.async_result.release()
+
+    def iter_entries(self, fields=None):
+        return self.fhir_client.iterate(self.async_result.iter_entries(fields))
+
+    def iter_resources(self, fields=None):
+        return self.fhir_client.iterate(self.async_result.iter_resources(fields))
+
+    def get_bundle(self):
+        return self.fhir_client.run(self.async_result.get_bundle())
+
+
+class CQLQueryClient:
+    """
+    Synchronous wrapper around AsyncCQLQueryClient, running on the event loop
+    of the given FHIRClient
+    """
+
+    def __init__(self, fhir_client, collector=None, **kwargs):
+        self.fhir_client = fhir_client
+        self.collector = collector
+        self.async_client = AsyncCQLQueryClient(
+            fhir_client.async_client,
+            collector=collector.async_collector if collector is not None else None,
+            **kwargs,
+        )
+
+    def perform_cql_query(
+        self, cql_query: str, granularity: Granularity, parameters=None
+    ):
+        return self.fhir_client.run(
+            self.async_client.perform_cql_query(cql_query, granularity, parameters)
+        )
+
+    def prepare_cql_queries(self, cql_queries, populations=None, stratifiers=None):
+        return self.fhir_client.run(
+            self.async_client.prepare_cql_queries(cql_queries, populations, stratifiers)
+        )
+
+    def evaluate_measure(self, measure_id, report_type, parameters=None):
+        return self.fhir_client.run(
+            self.async_client.evaluate_measure(measure_id, report_type, parameters)
+        )
+
+    def query(self, cql_query: str, granularity: Granularity, parameters=None):
+        return QueryResult(
+            self.fhir_client,
+            self.fhir_client.run(
+                self.async_client.query(cql_query, granularity, parameters)
+            ),
+        )
+
+    def perform_query(self, query: Query, granularity: Granularity, parameters=None):
+        return self.fhir_client.run(
+            self.async_client.perform_query(query, granularity, parameters)
+        )
+
+    def perform_search(self, params, granularity: Granularity):
+        return self.fhir_client.run(self.async_client.perform_search(params, granularity))
+
+    def perform_stratified_query(self, cql_query: str, stratifiers, parameters=None):
+        return self.fhir_client.run(
+            self.async_client.perform_stratified_query(
+                cql_query, stratifiers, parameters
+            )
+        )
+
+    def iter_entries(self, cql_query: str, parameters=None, fields=None):
+        return self.fhir_client.iterate(
+            self.async_client.iter_entries(cql_query, parameters, fields)
+        )
+
+    def iter_resources(self, cql_query: str, parameters=None, fields=None):
+        return self.fhir_client.iterate(
+            self.async_client.iter_resources(cql_query, parameters, fields)
+        )
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import uuid
+
+REGISTRY_URL_NAMESPACE = uuid.UUID("6f1f4d2e-4c1b-5a7e-9a55-3c0b3d7e6a11")
+
+
+class RegisteredMeasure:
+    def __init__(self, key, library_url, library_id, measure_id):
+        self.key = key
+        self.library_url = library_url
+        self.library_id = library_id
+        self.measure_id = measure_id
+
+
+class LibraryRegistry:
+    """
+    Content-addressed store of the Library/Measure pairs already created on a
+    FHIR server, persisted in a local sqlite database. Pairs are keyed by a
+    hash of the CQL text and of the shape of the Measure, so the same query
+    is translated and compiled by the server only once
+    """
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS registry ("
+            "key TEXT PRIMARY KEY, library_url TEXT, library_id TEXT, measure_id TEXT)"
+        )
+        self._connection.commit()
+        self._entries = {
+            row[0]: RegisteredMeasure(*row)
+            for row in self._connection.execute(
+                "SELECT key, library_url, library_id, measure_id FROM registry"
+            )
+        }
+
+    @staticmethod
+    def make_key(base_url, cql_query, measure_shape):
+        content = json.dumps(
+            {"server": base_url, "cql": cql_query, "measure": measure_shape},
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def library_url(key):
+        return "urn:uuid:{uuid}".format(uuid=uuid.uuid5(REGISTRY_URL_NAMESPACE, key))
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def put(self, key, library_url, library_id, measure_id):
+        entry = RegisteredMeasure(key, library_url, library_id, measure_id)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO registry VALUES (?, ?, ?, ?)",
+                (key, library_url, library_id, measure_id),
+            )
+            self._connection.commit()
+            self._entries[key] = entry
+        return entry
+
+    def discard(self, key):
+        with self._lock:
+            self._connection.execute("DELETE FROM registry WHERE key = ?", (key,))
+            self._connection.commit()
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,138 @@
+import codecs
+import json
+import re
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+DECODER = json.JSONDecoder()
+
+
+def project(resource, fields):
+    return {key: value for key, value in resource.items() if key in fields}
+
+
+class BundleParser:
+    """
+    Incremental parser of a FHIR Bundle. The response body is fed chunk by
+    chunk and every element of the top-level "entry" array is returned as
+    soon as it is complete, so that the Bundle is never held in memory as a
+    whole. The other top-level elements (e.g. "link" and "total") are
+    collected in the bundle attribute.
+
+    If fields is given, only those top-level elements (plus resourceType and
+    id) of each entry resource are kept.
+    """
+
+    def __init__(self, fields=None):
+        self.fields = (
+            set(fields) | {"resourceType", "id"} if fields is not None else None
+        )
+        self.bundle = {}
+        self.done = False
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._key = None
+        self._state = self._parse_start
+
+    def feed(self, data, final=False):
+        self._buffer = self._buffer[self._pos :] + self._decoder.decode(data, final)
+        self._pos = 0
+        entries = []
+        while not self.done and self._state(entries, final):
+            pass
+        if final and not self.done:
+            raise ValueError("Incomplete Bundle")
+        return entries
+
+    def close(self):
+        return self.feed(b"", final=True)
+
+    def _next_char(self):
+        self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+        return self._buffer[self._pos] if self._pos < len(self._buffer) else None
+
+    def _expect(self, char):
+        c = self._next_char()
+        if c is None:
+            return False
+        if c != char:
+            raise ValueError(f"Expected '{char}' at {self._pos}, found '{c}'")
+        self._pos += 1
+        return True
+
+    def _decode(self, final):
+        try:
+            value, end = DECODER.raw_decode(self._buffer, self._pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            return False, None
+        # a value ending exactly at the end of the buffer could be a truncated number
+        if end == len(self._buffer) and not final:
+            return False, None
+        self._pos = end
+        return True, value
+
+    def _parse_start(self, entries, final):
+        if not self._expect("{"):
+            return False
+        self._state = self._parse_key
+        return True
+
+    def _parse_key(self, entries, final):
+        c = self._next_char()
+        if c is None:
+            return False
+        if c == "}":
+            self._pos += 1
+            self.done = True
+            return True
+        if c == ",":
+            self._pos += 1
+            return True
+        complete, self._key = self._decode(final)
+        if not complete:
+            return False
+        self._state = self._parse_colon
+        return True
+
+    def _parse_colon(self, entries, final):
+        if not self._expect(":"):
+            return False
+        self._state = self._parse_entries if self._key == "entry" else self._parse_value
+        return True
+
+    def _parse_value(self, entries, final):
+        if self._next_char() is None:
+            return False
+        complete, value = self._decode(final)
+        if not complete:
+            return False
+        self.bundle[self._key] = value
+        self._state = self._parse_key
+        return True
+
+    def _parse_entries(self, entries, final):
+        if not self._expect("["):
+            return False
+        self._state = self._parse_entry
+        return True
+
+    def _parse_entry(self, entries, final):
+        c = self._next_char()
+        if c is None:
+            return False
+        if c == "]":
+            self._pos += 1
+            self._state = self._parse_key
+            return True
+        if c == ",":
+            self._pos += 1
+            return True
+        complete, entry = self._decode(final)
+        if not complete:
+            return False
+        if self.fields is not None and "resource" in entry:
+            entry["resource"] = project(entry["resource"], self.fields)
+        entries.append(entry)
+        return True
@@ -0,0 +1,57 @@
+import math
+import time
+from contextlib import contextmanager
+
+
+class PhaseTimer:
+    """
+    Accumulates the time spent by the query client in each phase (Library
+    POST, Measure POST, evaluation, fetch of the results...) in nanoseconds,
+    measured with perf_counter_ns. Meant for sequential benchmarks: the
+    phases of concurrent queries would add up
+    """
+
+    def __init__(self):
+        self.phases = {}
+
+    def reset(self):
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter_ns() - start
+
+
+def percentile(values, q):
+    """
+    Returns the q-th percentile (0-100) of the values, interpolating linearly
+    between the closest ranks
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * q / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def summarize(values):
+    n = len(values)
+    if n == 0:
+        return {"count": 0}
+    mean = sum(values) / n
+    variance = sum((v - mean) ** 2 for v in values) / (n - 1) if n > 1 else 0.0
+    return {
+        "count": n,
+        "mean": mean,
+        "std": math.sqrt(variance),
+        "min": min(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
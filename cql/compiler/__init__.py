@@ -0,0 +1,15 @@
+from .nodes import (
+    PATIENT,
+    SPECIMEN,
+    STRING,
+    STRING_LIST,
+    ConsentCriterion,
+    DiagnosisCriterion,
+    GenderCriterion,
+    Query,
+    QueryParameter,
+    SampleTypeCriterion,
+    SpecimenIdsCriterion,
+    SpecimenListCriterion,
+)
+from .compiler import CODE_SYSTEMS, CQLCompiler, compile_query, quote
@@ -0,0 +1,182 @@
+from cql.compiler.nodes import (
+    PATIENT,
+    SPECIMEN,
+    STRING,
+    STRING_LIST,
+    ConsentCriterion,
+    DiagnosisCriterion,
+    GenderCriterion,
+    Query,
+    QueryParameter,
+    SampleTypeCriterion,
+    SpecimenIdsCriterion,
+    SpecimenListCriterion,
+)
+
+CODE_SYSTEMS = {
+    "FastingStatus": "http://terminology.hl7.org/CodeSystem/v2-0916",
+    "SampleMaterialType": "https://fhir.bbmri.de/CodeSystem/SampleMaterialType",
+    "icd10": "http://hl7.org/fhir/sid/icd-10",
+    "icd10gm": "http://fhir.de/CodeSystem/dimdi/icd-10-gm",
+    "loinc": "http://loinc.org",
+    "ordo": "http://www.orpha.net/ORDO/",
+    "uberon": "http://purl.obolibrary.org/obo/uberon.owl",
+    "StorageTemperature": "https://fhir.bbmri.de/CodeSystem/StorageTemperature",
+    "CommonConditionElements": "https://fhir.bbmri.de/CodeSystem/common-condition-elements-cs",
+}
+SAMPLE_DIAGNOSIS_URL = "https://fhir.bbmri.de/StructureDefinition/SampleDiagnosis"
+FHIR_VERSION = "4.0.0"
+LIBRARY_VERSION = "1.0.0"
+
+
+def quote(value):
+    escaped = value.replace("\\", "\\\\").replace("'", "\\'")
+    return f"'{escaped}'"
+
+
+class CQLCompiler:
+    """
+    Compiles a Query to CQL text. The output is canonical: the criteria and
+    the declarations are sorted, only the code systems and the parameters
+    that are referenced are declared, and the layout is fixed, so that equal
+    queries always compile to the same bytes
+    """
+
+    def __init__(self, query: Query):
+        self.query = query
+        self.code_systems = set()
+        self.parameters = {}
+        self.unfiltered = []
+
+    def value(self, value, type=STRING):
+        if isinstance(value, QueryParameter):
+            if self.parameters.get(value.name, value.type) != value.type:
+                raise ValueError(f"Parameter {value.name} declared with two types")
+            self.parameters[value.name] = value.type
+            return value.name
+        if type == STRING_LIST:
+            return "{" + ", ".join(quote(v) for v in value) + "}"
+        return quote(value)
+
+    def code_system(self, name):
+        self.code_systems.add(name)
+        return f"{name}.id"
+
+    def define_unfiltered(self, prefix, body):
+        number = sum(1 for name, _ in self.unfiltered if name.startswith(prefix)) + 1
+        name = f"{prefix}{number}"
+        self.unfiltered.append((name, body))
+        return name
+
+    def consent_ids(self, criterion: ConsentCriterion):
+        conditions = [
+            f"C.system = {self.code_system('CommonConditionElements')}",
+            f"C.code in {self.value(criterion.codes, STRING_LIST)}",
+        ]
+        provision_filter = f"exists (Q.code.coding C where {' and '.join(conditions)})"
+        if criterion.decision is not None:
+            provision_filter = f"Q.type = {self.value(criterion.decision)}\n          and {provision_filter}"
+        return self.define_unfiltered(
+            "ConsentedSpecimenIds",
+            "  flatten (\n"
+            "    [Consent] Co\n"
+            "    return flatten (\n"
+            "      Co.provision.provision Q\n"
+            f"        where {provision_filter}\n"
+            "        return (Q.data D return Split(D.reference.reference, '/')[1])\n"
+            "    )\n"
+            "  )",
+        )
+
+    def list_ids(self, criterion: SpecimenListCriterion):
+        return self.define_unfiltered(
+            "ListedSpecimenIds",
+            "  flatten (\n"
+            "    [List] L\n"
+            f"      where L.id = {self.value(criterion.list_id)}\n"
+            "      return (L.entry E return Split(E.item.reference, '/')[1])\n"
+            "  )",
+        )
+
+    def specimen_predicate(self, criterion, specimen):
+        if isinstance(criterion, DiagnosisCriterion):
+            return (
+                f"exists ({specimen}.extension E"
+                f" where E.url = {quote(SAMPLE_DIAGNOSIS_URL)}"
+                f" and exists (E.value.coding C"
+                f" where C.system = {self.code_system('icd10')}"
+                f" and C.code = {self.value(criterion.code)}))"
+            )
+        if isinstance(criterion, SampleTypeCriterion):
+            return (
+                f"exists ({specimen}.type.coding C"
+                f" where C.system = {self.code_system('SampleMaterialType')}"
+                f" and C.code = {self.value(criterion.code)})"
+            )
+        if isinstance(criterion, ConsentCriterion):
+            return f"{specimen}.id in {self.consent_ids(criterion)}"
+        if isinstance(criterion, SpecimenIdsCriterion):
+            return f"{specimen}.id in {self.value(criterion.ids, STRING_LIST)}"
+        if isinstance(criterion, SpecimenListCriterion):
+            return f"{specimen}.id in {self.list_ids(criterion)}"
+        raise ValueError(f"Unsupported criterion: {type(criterion).__name__}")
+
+    def patient_predicate(self, criterion: GenderCriterion, patient):
+        return f"{patient}.gender = {self.value(criterion.gender)}"
+
+    def population(self):
+        criteria = sorted(
+            self.query.criteria, key=lambda c: repr((type(c).__name__, c.key()))
+        )
+        patient_criteria = [c for c in criteria if isinstance(c, GenderCriterion)]
+        specimen_criteria = [c for c in criteria if not isinstance(c, GenderCriterion)]
+        if self.query.context == SPECIMEN:
+            predicates = [self.specimen_predicate(c, SPECIMEN) for c in specimen_criteria]
+            if patient_criteria:
+                conditions = [self.patient_predicate(c, "P") for c in patient_criteria]
+                predicates.append(
+                    f"exists ([Patient] P where {' and '.join(conditions)})"
+                )
+        else:
+            predicates = [self.patient_predicate(c, PATIENT) for c in patient_criteria]
+            if specimen_criteria:
+                conditions = [self.specimen_predicate(c, "S") for c in specimen_criteria]
+                predicates.append(
+                    f"exists ([Specimen] S where {' and '.join(conditions)})"
+                )
+        return "\n  and ".join(predicates) if predicates else "true"
+
+    def compile(self):
+        population = self.population()
+        lines = [
+            f"library {self.query.library} version {quote(LIBRARY_VERSION)}",
+            f"using FHIR version {quote(FHIR_VERSION)}",
+            f"include FHIRHelpers version {quote(FHIR_VERSION)}",
+            "",
+        ]
+        if self.code_systems:
+            lines += [
+                f"codesystem {name}: {quote(CODE_SYSTEMS[name])}"
+                for name in sorted(self.code_systems)
+            ]
+            lines.append("")
+        if self.parameters:
+            lines += [
+                f"parameter {name} {type}" for name, type in sorted(self.parameters.items())
+            ]
+            lines.append("")
+        if self.unfiltered:
+            lines += ["context Unfiltered", ""]
+            for name, body in self.unfiltered:
+                lines += [f"define {name}:", body, ""]
+        lines += [
+            f"context {self.query.context}",
+            "",
+            "define InInitialPopulation:",
+            f"  {population}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+def compile_query(query: Query):
+    return CQLCompiler(query).compile()
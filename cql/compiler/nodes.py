@@ -0,0 +1,140 @@
+SPECIMEN = "Specimen"
+PATIENT = "Patient"
+CONTEXTS = (SPECIMEN, PATIENT)
+STRING = "String"
+STRING_LIST = "List<String>"
+
+
+class QueryParameter:
+    """
+    Reference to a CQL parameter, to be used in place of a literal value
+    """
+
+    def __init__(self, name, type=STRING):
+        self.name = name
+        self.type = type
+
+    def key(self):
+        return ("parameter", self.name, self.type)
+
+    def __eq__(self, other):
+        return isinstance(other, QueryParameter) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+
+def value_key(value):
+    return value.key() if isinstance(value, QueryParameter) else ("literal", value)
+
+
+class Criterion:
+    def key(self):
+        raise NotImplementedError
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash((type(self).__name__, self.key()))
+
+
+class DiagnosisCriterion(Criterion):
+    def __init__(self, code):
+        self.code = code
+
+    def key(self):
+        return (value_key(self.code),)
+
+
+class GenderCriterion(Criterion):
+    def __init__(self, gender):
+        self.gender = gender
+
+    def key(self):
+        return (value_key(self.gender),)
+
+
+class SampleTypeCriterion(Criterion):
+    def __init__(self, code):
+        self.code = code
+
+    def key(self):
+        return (value_key(self.code),)
+
+
+class ConsentCriterion(Criterion):
+    """
+    The Specimen is referenced by a Consent provision for any of the CCE
+    codes, optionally only with the given decision (permit or deny). The
+    codes are either a list of literals or a List<String> parameter
+    """
+
+    def __init__(self, codes, decision=None):
+        if isinstance(codes, QueryParameter):
+            self.codes = codes
+        else:
+            self.codes = tuple(sorted(set(codes)))
+        self.decision = decision
+
+    def key(self):
+        codes = (
+            value_key(self.codes)
+            if isinstance(self.codes, QueryParameter)
+            else ("literal",) + self.codes
+        )
+        return (codes, value_key(self.decision))
+
+
+class SpecimenIdsCriterion(Criterion):
+    """
+    The id of the Specimen is in a List<String> parameter, e.g. the consented
+    ids computed by a ConsentIndex
+    """
+
+    def __init__(self, ids: QueryParameter):
+        self.ids = ids
+
+    def key(self):
+        return (value_key(self.ids),)
+
+
+class SpecimenListCriterion(Criterion):
+    """
+    The Specimen is an entry of the FHIR List with the given id, e.g. a List
+    materialized by ConsentLists
+    """
+
+    def __init__(self, list_id):
+        self.list_id = list_id
+
+    def key(self):
+        return (value_key(self.list_id),)
+
+
+class Query:
+    """
+    A query is the conjunction of its criteria, evaluated in the Specimen or
+    in the Patient context. Criteria are a set: order and duplicates do not
+    matter
+    """
+
+    def __init__(self, context=SPECIMEN, criteria=(), library="ConsentSpecimenQuery"):
+        if context not in CONTEXTS:
+            raise ValueError(f"Unsupported context: {context}")
+        self.context = context
+        self.criteria = frozenset(criteria)
+        self.library = library
+
+    def key(self):
+        return (
+            self.library,
+            self.context,
+            tuple(sorted(repr((type(c).__name__, c.key())) for c in self.criteria)),
+        )
+
+    def __eq__(self, other):
+        return isinstance(other, Query) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
@@ -0,0 +1,158 @@
+import json
+
+from cql.compiler.compiler import CODE_SYSTEMS, SAMPLE_DIAGNOSIS_URL
+from cql.compiler.nodes import (
+    SPECIMEN,
+    ConsentCriterion,
+    DiagnosisCriterion,
+    GenderCriterion,
+    Query,
+    QueryParameter,
+    SampleTypeCriterion,
+    SpecimenListCriterion,
+)
+
+SEARCH_PARAMETER_URL = "https://github.com/crs4/consent-cql-client/SearchParameter"
+CCE_CODES = [
+    "REGULATORY_JURISDICTION",
+    "COMMERCIAL_USE",
+    "RETURN_OF_RESULTS",
+    "CONTACT_TO_PARTICIPATE",
+    "GENERATION_OF_BIOLOGICAL_PRODUCTS",
+    "RETURN_OF_INCIDENTAL_FINDINGS",
+    "DATA_LINKAGE",
+    "DATA_SAMPLE_POST_MORTEM_REUSE",
+]
+DECISIONS = ["permit", "deny"]
+# every Consent.status: the compiled CQL does not filter Consents by status
+CONSENT_STATUSES = ["draft", "proposed", "active", "rejected", "inactive", "entered-in-error"]
+# unknown search parameters are an error instead of being ignored, which
+# would silently widen the search
+SEARCH_HEADERS = {"Prefer": "handling=strict"}
+
+
+def get_provision_search_parameter_code(cce_code, decision):
+    return f"provision-{decision}-{cce_code.lower().replace('_', '-')}"
+
+
+def create_search_parameter(code, base, type, expression, description, target=None):
+    search_parameter = {
+        "resourceType": "SearchParameter",
+        "url": f"{SEARCH_PARAMETER_URL}/{base}-{code}",
+        "name": code,
+        "status": "active",
+        "description": description,
+        "code": code,
+        "base": [base],
+        "type": type,
+        "expression": expression,
+    }
+    if target is not None:
+        search_parameter["target"] = [target]
+    return search_parameter
+
+
+def create_search_parameters(cce_codes=CCE_CODES):
+    """
+    Returns the Bundle of the custom SearchParameters loaded by Blaze (see
+    DB_SEARCH_PARAM_BUNDLE in blaze/docker-compose.yml). Besides the plain
+    code, type and data of the Consent provisions, which match independently
+    of each other, there is one reference parameter per (CCE, decision),
+    whose expression only selects the Specimens of the provisions with that
+    code and type, so that _has searches keep them correlated
+    """
+    search_parameters = [
+        create_search_parameter(
+            "provision-code",
+            "Consent",
+            "token",
+            "Consent.provision.provision.code",
+            "Code of a nested provision of the Consent",
+        ),
+        create_search_parameter(
+            "provision-type",
+            "Consent",
+            "token",
+            "Consent.provision.provision.type",
+            "Type (permit or deny) of a nested provision of the Consent",
+        ),
+        create_search_parameter(
+            "provision-data",
+            "Consent",
+            "reference",
+            "Consent.provision.provision.data.reference",
+            "Resource referenced by a nested provision of the Consent",
+            "Specimen",
+        ),
+        create_search_parameter(
+            "diagnosis",
+            "Specimen",
+            "token",
+            f"Specimen.extension.where(url = '{SAMPLE_DIAGNOSIS_URL}').value",
+            "Diagnosis the Specimen was taken for",
+        ),
+    ]
+    for cce_code in cce_codes:
+        for decision in DECISIONS:
+            search_parameters.append(
+                create_search_parameter(
+                    get_provision_search_parameter_code(cce_code, decision),
+                    "Consent",
+                    "reference",
+                    "Consent.provision.provision.where(type = '%s' and "
+                    "code.coding.where(system = '%s' and code = '%s').exists())"
+                    ".data.reference"
+                    % (decision, CODE_SYSTEMS["CommonConditionElements"], cce_code),
+                    f"Specimen with a {decision} provision for {cce_code}",
+                    "Specimen",
+                )
+            )
+    return {
+        "resourceType": "Bundle",
+        "type": "collection",
+        "entry": [
+            {"fullUrl": p["url"], "resource": p} for p in search_parameters
+        ],
+    }
+
+
+def plan_search(query: Query):
+    """
+    Returns the parameters of a Specimen search with the same results as the
+    compiled CQL of the query, or None when the query cannot be answered by a
+    REST search: other contexts,
+    parameterized values, consent criteria on more CCEs (a disjunction) or
+    without a decision, or criteria that would repeat a search parameter
+    """
+    if query.context != SPECIMEN:
+        return None
+    params = {}
+    for criterion in query.criteria:
+        values = [getattr(criterion, a) for a in vars(criterion)]
+        if any(isinstance(v, QueryParameter) for v in values):
+            return None
+        if isinstance(criterion, DiagnosisCriterion):
+            key, value = "diagnosis", f"{CODE_SYSTEMS['icd10']}|{criterion.code}"
+        elif isinstance(criterion, SampleTypeCriterion):
+            key, value = "type", f"{CODE_SYSTEMS['SampleMaterialType']}|{criterion.code}"
+        elif isinstance(criterion, GenderCriterion):
+            key, value = "subject:Patient.gender", criterion.gender
+        elif isinstance(criterion, SpecimenListCriterion):
+            key, value = "_list", criterion.list_id
+        elif isinstance(criterion, ConsentCriterion):
+            if len(criterion.codes) != 1 or criterion.decision not in DECISIONS:
+                return None
+            code = get_provision_search_parameter_code(
+                criterion.codes[0], criterion.decision
+            )
+            key, value = f"_has:Consent:{code}:status", ",".join(CONSENT_STATUSES)
+        else:
+            return None
+        if key in params:
+            return None
+        params[key] = value
+    return dict(sorted(params.items()))
+
+
+if __name__ == "__main__":
+    print(json.dumps(create_search_parameters(), indent=2))
@@ -0,0 +1,4 @@
+from .index import ConsentIndex, PERMIT, DENY
+from .sync import ConsentSync
+from .history import ConsentHistory
+from .lists import ConsentLists, create_consent_list_cql_definition
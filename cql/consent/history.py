@@ -0,0 +1,235 @@
+import math
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timezone
+
+from cql.client.fhir import DEFAULT_PAGE_SIZE
+from cql.consent.index import (
+    INACTIVE_STATUSES,
+    PERMIT,
+    DENY,
+    get_cce_codes,
+    get_specimen_id,
+)
+from cql.consent.sync import SYNC_FIELDS, get_entry_timestamp, get_history_consent_id
+
+HISTORY_FIELDS = SYNC_FIELDS + ["dateTime"]
+
+
+def parse_timestamp(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        moment = value
+    else:
+        moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def get_period(element):
+    period = element.get("period", {})
+    start = parse_timestamp(period.get("start"))
+    end = parse_timestamp(period.get("end"))
+    return (
+        start if start is not None else -math.inf,
+        end if end is not None else math.inf,
+    )
+
+
+def get_decision_segments(provisions, start, end):
+    """
+    Splits [start, end) in the segments where the decision is constant, given
+    the (start, end, decision) provisions of a specimen and CCE. Where more
+    provisions overlap, the one that started last wins
+    """
+    boundaries = sorted(
+        {start, end}
+        | {t for p in provisions for t in p[:2] if start < t < end}
+    )
+    segments = []
+    for segment_start, segment_end in zip(boundaries, boundaries[1:]):
+        covering = [p for p in provisions if p[0] <= segment_start < p[1]]
+        if not covering:
+            continue
+        decision = max(covering, key=lambda p: p[0])[2]
+        if segments and segments[-1][2] == decision and segments[-1][1] == segment_start:
+            segments[-1] = (segments[-1][0], segment_end, decision)
+        else:
+            segments.append((segment_start, segment_end, decision))
+    return segments
+
+
+def merge_intervals(intervals):
+    """
+    Merges the overlapping or adjacent (start, end, specimen id) intervals of
+    the same specimen, e.g. from two Consents, so that at any moment each
+    specimen is covered by at most one interval
+    """
+    merged = []
+    last = {}
+    for start, end, specimen_id in sorted(intervals, key=lambda i: (i[2], i[0])):
+        previous = last.get(specimen_id)
+        if previous is not None and start <= merged[previous][1]:
+            merged[previous] = (merged[previous][0], max(merged[previous][1], end), specimen_id)
+        else:
+            last[specimen_id] = len(merged)
+            merged.append((start, end, specimen_id))
+    return merged
+
+
+class ConsentIntervals:
+    def __init__(self, intervals):
+        # merged, so that counting intervals counts specimens
+        intervals = sorted(merge_intervals(intervals))
+        self.starts = array("d", [i[0] for i in intervals])
+        self.ends = array("d", [i[1] for i in intervals])
+        self.specimen_ids = [i[2] for i in intervals]
+        self.sorted_ends = array("d", sorted(self.ends))
+
+    def count(self, moment):
+        return bisect_right(self.starts, moment) - bisect_right(self.sorted_ends, moment)
+
+    def get_specimen_ids(self, moment):
+        last = bisect_right(self.starts, moment)
+        return {
+            self.specimen_ids[i] for i in range(last) if self.ends[i] > moment
+        }
+
+
+class ConsentHistory:
+    """
+    Versioned, time-indexed store of the Consent resources, to answer
+    point-in-time ("as-of") questions. A version of a Consent is in force
+    from its dateTime (or lastUpdated) until the next version or the deletion
+    of the Consent; within a version, each provision applies during its
+    period. For every (CCE, decision) the resulting intervals are indexed by
+    start and end, so counts are two binary searches
+    """
+
+    def __init__(self):
+        self._versions = {}
+        self._intervals = None
+        self._segments = None
+
+    def add_version(self, consent, consent_id=None, timestamp=None):
+        consent_id = consent_id if consent_id is not None else consent["id"]
+        recorded = timestamp or consent.get("meta", {}).get("lastUpdated") or ""
+        effective = consent.get("dateTime") or recorded
+        self._versions.setdefault(consent_id, []).append(
+            (parse_timestamp(effective) if effective else -math.inf, recorded, consent)
+        )
+        self._intervals = self._segments = None
+
+    def add_deletion(self, consent_id, timestamp):
+        self._versions.setdefault(consent_id, []).append(
+            (parse_timestamp(timestamp), timestamp, None)
+        )
+        self._intervals = self._segments = None
+
+    def add_history_entry(self, entry):
+        consent_id = get_history_consent_id(entry)
+        timestamp = get_entry_timestamp(entry)
+        if entry.get("request", {}).get("method") == "DELETE" or not entry.get(
+            "resource"
+        ):
+            self.add_deletion(consent_id, timestamp)
+        else:
+            self.add_version(entry["resource"], consent_id, timestamp)
+
+    def add_bundle(self, bundle):
+        for entry in bundle.get("entry", []):
+            resource = entry.get("resource", {})
+            if resource.get("resourceType") == "Consent":
+                consent_id = resource.get("id") or entry["request"]["url"].split("/")[1]
+                self.add_version(resource, consent_id)
+
+    def _build(self):
+        segments = {}
+        intervals = {}
+        for versions in self._versions.values():
+            versions.sort(key=lambda v: v[:2])
+            ends = [v[0] for v in versions[1:]] + [math.inf]
+            for (version_start, _, consent), version_end in zip(versions, ends):
+                if consent is None or consent.get("status") in INACTIVE_STATUSES:
+                    continue
+                top_start, top_end = get_period(consent.get("provision", {}))
+                start = max(version_start, top_start)
+                end = min(version_end, top_end)
+                if start >= end:
+                    continue
+                provisions = {}
+                for provision in consent.get("provision", {}).get("provision", []):
+                    decision = provision.get("type")
+                    if decision not in (PERMIT, DENY):
+                        continue
+                    provision_start, provision_end = get_period(provision)
+                    for code in get_cce_codes(provision):
+                        for data in provision.get("data", []):
+                            reference = data.get("reference", {}).get("reference")
+                            if reference is None:
+                                continue
+                            provisions.setdefault(
+                                (get_specimen_id(reference), code), []
+                            ).append((provision_start, provision_end, decision))
+                for (specimen_id, code), specimen_provisions in provisions.items():
+                    for segment in get_decision_segments(
+                        specimen_provisions, start, end
+                    ):
+                        segments.setdefault((specimen_id, code), []).append(segment)
+                        intervals.setdefault((code, segment[2]), []).append(
+                            (segment[0], segment[1], specimen_id)
+                        )
+        self._segments = segments
+        self._intervals = {
+            key: ConsentIntervals(value) for key, value in intervals.items()
+        }
+
+    def _get_intervals(self, code, decision):
+        if self._intervals is None:
+            self._build()
+        return self._intervals.get((code, decision))
+
+    def get_specimen_ids(self, moment, permit=(), deny=()):
+        """
+        Returns the ids of the specimens that, at the given moment, permitted
+        all the CCEs in permit and denied all the CCEs in deny
+        """
+        moment = parse_timestamp(moment)
+        result = None
+        for code, decision in [(c, PERMIT) for c in permit] + [(c, DENY) for c in deny]:
+            intervals = self._get_intervals(code, decision)
+            ids = intervals.get_specimen_ids(moment) if intervals is not None else set()
+            result = ids if result is None else result & ids
+        return result if result is not None else set()
+
+    def count(self, moment, permit=(), deny=()):
+        if len(permit) + len(deny) == 1:
+            code, decision = (permit[0], PERMIT) if permit else (deny[0], DENY)
+            intervals = self._get_intervals(code, decision)
+            return intervals.count(parse_timestamp(moment)) if intervals else 0
+        return len(self.get_specimen_ids(moment, permit, deny))
+
+    def get_decision(self, specimen_id, code, moment):
+        if self._segments is None:
+            self._build()
+        moment = parse_timestamp(moment)
+        for start, end, decision in self._segments.get((specimen_id, code), []):
+            if start <= moment < end:
+                return decision
+        return None
+
+    def load(self, fhir_client, page_size=DEFAULT_PAGE_SIZE):
+        for entry in fhir_client.iter_entries(
+            "Consent/_history", page_size=page_size, fields=HISTORY_FIELDS
+        ):
+            self.add_history_entry(entry)
+        return self
+
+    async def async_load(self, fhir_client, page_size=DEFAULT_PAGE_SIZE):
+        async for entry in fhir_client.iter_entries(
+            "Consent/_history", page_size=page_size, fields=HISTORY_FIELDS
+        ):
+            self.add_history_entry(entry)
+        return self
@@ -0,0 +1,298 @@
+import base64
+from array import array
+
+from cql.client.fhir import DEFAULT_PAGE_SIZE
+from cql.models import Parameter
+
+CCE_SYSTEM = "https://fhir.bbmri.de/CodeSystem/common-condition-elements-cs"
+PERMIT = "permit"
+DENY = "deny"
+INACTIVE_STATUSES = ("inactive", "rejected", "entered-in-error")
+CONSENT_FIELDS = ["status", "provision"]
+MAX_CODES = 32
+# ids above which get_parameters refuses to build a request body, that would
+# reach megabytes: a materialized List (ConsentLists) scales instead
+MAX_PARAMETER_IDS = 10000
+
+
+def get_specimen_id(reference):
+    return reference.split("/")[1]
+
+
+def get_cce_codes(provision):
+    return [
+        coding["code"]
+        for concept in provision.get("code", [])
+        for coding in concept.get("coding", [])
+        if coding.get("system", CCE_SYSTEM) == CCE_SYSTEM and "code" in coding
+    ]
+
+
+def get_provision_decisions(consent):
+    """
+    Returns a dict (specimen id, CCE code) -> decision for the nested provisions
+    of a Consent. When the same specimen and CCE appear in more than one
+    provision, the one with the latest period start wins
+    """
+    decisions = {}
+    if consent.get("status") in INACTIVE_STATUSES:
+        return decisions
+    starts = {}
+    for provision in consent.get("provision", {}).get("provision", []):
+        decision = provision.get("type")
+        if decision not in (PERMIT, DENY):
+            continue
+        start = provision.get("period", {}).get("start", "")
+        for code in get_cce_codes(provision):
+            for data in provision.get("data", []):
+                reference = data.get("reference", {}).get("reference")
+                if reference is None:
+                    continue
+                key = (get_specimen_id(reference), code)
+                if start >= starts.get(key, ""):
+                    starts[key] = start
+                    decisions[key] = decision
+    return decisions
+
+
+def encode_array(values):
+    return base64.b64encode(values.tobytes()).decode("ascii")
+
+
+def decode_array(data, typecode="I"):
+    values = array(typecode)
+    values.frombytes(base64.b64decode(data))
+    return values
+
+
+def encode_contribution(position, code_bit, decision):
+    return (position * MAX_CODES + code_bit) << 1 | (decision == DENY)
+
+
+def decode_contribution(value):
+    key, is_deny = divmod(value, 2)
+    position, code_bit = divmod(key, MAX_CODES)
+    return position, code_bit, DENY if is_deny else PERMIT
+
+
+def iter_positions(mask):
+    data = mask.to_bytes((mask.bit_length() + 7) // 8, "little")
+    for i, byte in enumerate(data):
+        if byte:
+            for bit in range(8):
+                if byte >> bit & 1:
+                    yield i * 8 + bit
+
+
+class ConsentIndex:
+    """
+    Client-side index of the Consent resources. Every Specimen referenced in
+    a Consent gets a position; its permit and deny decisions are stored as
+    bitmasks of CCE codes in two arrays, while for each (CCE, decision) a
+    bitmap of specimen positions answers membership queries with a few
+    integer operations. The decisions contributed by each Consent are kept,
+    so that removing or updating one recomputes its positions from the
+    other Consents still in the index, the latest added winning.
+
+    The index holds the decisions in force, which is what the Lists and the
+    parameters built from it are meant to enforce: inactive, rejected and
+    entered-in-error Consents are skipped, and for a Specimen and CCE the
+    provision with the latest start wins. The compiled ConsentCriterion (and
+    cql.offline, which follows it) instead matches any provision with the
+    code, whatever the Consent status, so the cohorts only agree on data
+    without withdrawn or superseded Consents
+    """
+
+    def __init__(self):
+        self.codes = []
+        self.specimen_ids = []
+        self.permit = array("I")
+        self.deny = array("I")
+        self._code_bits = {}
+        self._positions = {}
+        self._consents = {}
+        self._contributions = {}
+        self._bitmaps = {}
+        self._masks = {}
+
+    def __len__(self):
+        return len(self.specimen_ids)
+
+    def _get_code_bit(self, code):
+        if code not in self._code_bits:
+            if len(self.codes) == MAX_CODES:
+                raise ValueError(f"Too many CCE codes, at most {MAX_CODES} are supported")
+            self._code_bits[code] = len(self.codes)
+            self.codes.append(code)
+        return self._code_bits[code]
+
+    def _get_position(self, specimen_id):
+        position = self._positions.get(specimen_id)
+        if position is None:
+            position = self._positions[specimen_id] = len(self.specimen_ids)
+            self.specimen_ids.append(specimen_id)
+            self.permit.append(0)
+            self.deny.append(0)
+        return position
+
+    def _set_bit(self, code_bit, decision, position, value):
+        bitmap = self._bitmaps.get((code_bit, decision))
+        if bitmap is None:
+            bitmap = self._bitmaps[(code_bit, decision)] = bytearray()
+        byte = position >> 3
+        if byte >= len(bitmap):
+            bitmap.extend(bytes(byte + 1 - len(bitmap)))
+        if value:
+            bitmap[byte] |= 1 << (position & 7)
+        else:
+            bitmap[byte] &= ~(1 << (position & 7)) & 0xFF
+        self._masks.pop((code_bit, decision), None)
+
+    def _update_decision(self, position, code_bit):
+        # the decision of a specimen and CCE is the one of the latest added
+        # Consent that still contributes one
+        contributions = self._contributions.get((position, code_bit))
+        decision = next(reversed(contributions.values())) if contributions else None
+        for masks, masks_decision in ((self.permit, PERMIT), (self.deny, DENY)):
+            value = decision == masks_decision
+            if bool(masks[position] >> code_bit & 1) != value:
+                if value:
+                    masks[position] |= 1 << code_bit
+                else:
+                    masks[position] &= ~(1 << code_bit)
+                self._set_bit(code_bit, masks_decision, position, value)
+
+    def add_consent(self, consent, consent_id=None):
+        consent_id = consent_id if consent_id is not None else consent["id"]
+        self.remove_consent(consent_id)
+        contributions = array("Q")
+        for (specimen_id, code), decision in get_provision_decisions(consent).items():
+            position = self._get_position(specimen_id)
+            code_bit = self._get_code_bit(code)
+            self._contributions.setdefault((position, code_bit), {})[consent_id] = decision
+            self._update_decision(position, code_bit)
+            contributions.append(encode_contribution(position, code_bit, decision))
+        self._consents[consent_id] = contributions
+
+    def add_bundle(self, bundle):
+        for entry in bundle.get("entry", []):
+            resource = entry.get("resource", {})
+            if resource.get("resourceType") == "Consent":
+                consent_id = resource.get("id") or entry["request"]["url"].split("/")[1]
+                self.add_consent(resource, consent_id)
+
+    def remove_consent(self, consent_id):
+        for value in self._consents.pop(consent_id, []):
+            position, code_bit, _ = decode_contribution(value)
+            contributions = self._contributions[(position, code_bit)]
+            del contributions[consent_id]
+            if not contributions:
+                del self._contributions[(position, code_bit)]
+            self._update_decision(position, code_bit)
+
+    def _get_mask(self, code, decision):
+        code_bit = self._code_bits.get(code)
+        if code_bit is None:
+            return 0
+        mask = self._masks.get((code_bit, decision))
+        if mask is None:
+            bitmap = self._bitmaps.get((code_bit, decision), b"")
+            mask = self._masks[(code_bit, decision)] = int.from_bytes(bitmap, "little")
+        return mask
+
+    def mask(self, permit=(), deny=()):
+        """
+        Returns the bitmap of the positions of the specimens that permit all
+        the CCEs in permit and deny all the CCEs in deny
+        """
+        masks = [self._get_mask(code, PERMIT) for code in permit]
+        masks += [self._get_mask(code, DENY) for code in deny]
+        if not masks:
+            return (1 << len(self.specimen_ids)) - 1
+        mask = masks[0]
+        for other in masks[1:]:
+            mask &= other
+        return mask
+
+    def count(self, permit=(), deny=()):
+        return self.mask(permit, deny).bit_count()
+
+    def get_specimen_ids(self, permit=(), deny=()):
+        return [self.specimen_ids[p] for p in iter_positions(self.mask(permit, deny))]
+
+    def get_decision(self, specimen_id, code):
+        position = self._positions.get(specimen_id)
+        code_bit = self._code_bits.get(code)
+        if position is None or code_bit is None:
+            return None
+        if self.permit[position] >> code_bit & 1:
+            return PERMIT
+        if self.deny[position] >> code_bit & 1:
+            return DENY
+        return None
+
+    def get_parameters(self, name, permit=(), deny=(), max_ids=MAX_PARAMETER_IDS):
+        """
+        Returns the ids of the matching specimens as a CQL List<String> parameter,
+        to push the consent filter to the server as a pre-filtered id set. Every
+        id is a Parameter of the request body, so more than max_ids raise a
+        ValueError: materialize a List with ConsentLists instead. The ids
+        follow the decisions in force (see ConsentIndex), not the CQL semantics
+        """
+        count = self.count(permit, deny)
+        if max_ids is not None and count > max_ids:
+            raise ValueError(
+                f"{count} consented specimens exceed the {max_ids} ids that can be "
+                "passed as parameters, use a ConsentList"
+            )
+        return [Parameter(name, s) for s in self.get_specimen_ids(permit, deny)]
+
+    def to_dict(self):
+        return {
+            "codes": self.codes,
+            "specimen_ids": self.specimen_ids,
+            "permit": encode_array(self.permit),
+            "deny": encode_array(self.deny),
+            "contributions": {c: encode_array(p) for c, p in self._consents.items()},
+            "bitmaps": {
+                f"{code_bit}:{decision}": base64.b64encode(bitmap).decode("ascii")
+                for (code_bit, decision), bitmap in self._bitmaps.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls()
+        index.codes = list(data["codes"])
+        index._code_bits = {code: bit for bit, code in enumerate(index.codes)}
+        index.specimen_ids = list(data["specimen_ids"])
+        index._positions = {s: p for p, s in enumerate(index.specimen_ids)}
+        index.permit = decode_array(data["permit"])
+        index.deny = decode_array(data["deny"])
+        if "contributions" not in data:
+            raise ValueError("Consent index saved by an older version, the Consents must be loaded again")
+        index._consents = {c: decode_array(p, "Q") for c, p in data["contributions"].items()}
+        for consent_id, contributions in index._consents.items():
+            for value in contributions:
+                position, code_bit, decision = decode_contribution(value)
+                index._contributions.setdefault((position, code_bit), {})[consent_id] = decision
+        for key, bitmap in data["bitmaps"].items():
+            code_bit, decision = key.split(":")
+            index._bitmaps[(int(code_bit), decision)] = bytearray(
+                base64.b64decode(bitmap)
+            )
+        return index
+
+    def load(self, fhir_client, page_size=DEFAULT_PAGE_SIZE):
+        for consent in fhir_client.iter_resources(
+            "Consent", page_size=page_size, fields=CONSENT_FIELDS
+        ):
+            self.add_consent(consent)
+        return self
+
+    async def async_load(self, fhir_client, page_size=DEFAULT_PAGE_SIZE):
+        async for consent in fhir_client.iter_resources(
+            "Consent", page_size=page_size, fields=CONSENT_FIELDS
+        ):
+            self.add_consent(consent)
+        return self
@@ -0,0 +1,151 @@
+import hashlib
+import logging
+
+from cql.client.fhir import MISSING_STATUSES, FHIRRequestError
+from cql.consent.index import ConsentIndex
+from cql.models import FHIRResource
+
+CONSENT_LIST_ID_PREFIX = "consented-specimens"
+
+
+def get_consent_list_key(permit=(), deny=()):
+    return tuple(sorted(set(permit))), tuple(sorted(set(deny)))
+
+
+def get_consent_list_id(permit=(), deny=()):
+    permit, deny = get_consent_list_key(permit, deny)
+    digest = hashlib.sha256(
+        f"permit={','.join(permit)};deny={','.join(deny)}".encode("utf-8")
+    ).hexdigest()
+    return f"{CONSENT_LIST_ID_PREFIX}-{digest[:16]}"
+
+
+def create_consent_list_cql_definition(list_id_expression="ConsentListId"):
+    """
+    Returns the CQL (to be placed in the Unfiltered context) that defines
+    ConsentedSpecimenIds as the ids of the specimens in a materialized List.
+    By default the id of the List is read from the ConsentListId parameter
+    """
+    return f"""
+    define ConsentedSpecimenIds:
+        flatten (
+            [List] L
+            where L.id = {list_id_expression}
+            return (L.entry E return Split(E.item.reference, '/')[1])
+        )
+    """
+
+
+class ConsentList(FHIRResource):
+    def __init__(self, id, permit, deny, specimen_ids):
+        self.id = id
+        self.permit = permit
+        self.deny = deny
+        self.specimen_ids = specimen_ids
+        title = " and ".join(
+            [f"permit {c}" for c in permit] + [f"deny {c}" for c in deny]
+        )
+        super(ConsentList, self).__init__(
+            {
+                "resourceType": "List",
+                "id": self.id,
+                "status": "current",
+                "mode": "working",
+                "title": f"Specimens with consent: {title}",
+                "entry": [
+                    {"item": {"reference": f"Specimen/{s}"}} for s in self.specimen_ids
+                ],
+            }
+        )
+
+
+class ConsentLists:
+    """
+    Materializes on the FHIR server one List of consented Specimen references
+    per (CCE set, decision), computed from a ConsentIndex, so that queries
+    filter against the List (via _list or ConsentedSpecimenIds in CQL)
+    instead of re-evaluating the Consents. refresh() re-uploads only the
+    Lists whose content changed since the Consents were last synchronized;
+    it can be given as the on_change callback of a ConsentSync, which also
+    passes the index when a full load replaced it. materialize() checks that
+    a List it already uploaded is still on the server, and uploads it again
+    if it is not, so that a query never reads a missing List as empty. The
+    Lists hold the decisions in force of the index, not the CQL semantics
+    (see ConsentIndex)
+    """
+
+    def __init__(self, index: ConsentIndex):
+        self.index = index
+        self._digests = {}
+
+    def _create_list(self, key):
+        permit, deny = key
+        specimen_ids = self.index.get_specimen_ids(permit, deny)
+        digest = hashlib.sha256("\n".join(specimen_ids).encode("utf-8")).hexdigest()
+        consent_list = ConsentList(get_consent_list_id(permit, deny), permit, deny, specimen_ids)
+        return consent_list, digest
+
+    def _forget_missing(self, key, error):
+        if error.status not in MISSING_STATUSES:
+            raise error
+        logging.debug("List %s missing on the server" % get_consent_list_id(*key))
+        del self._digests[key]
+
+    def materialize(self, fhir_client, permit=(), deny=()):
+        key = get_consent_list_key(permit, deny)
+        if key in self._digests:
+            try:
+                fhir_client.request(
+                    "GET", f"List/{get_consent_list_id(permit, deny)}", params={"_elements": "id"}
+                )
+            except FHIRRequestError as e:
+                self._forget_missing(key, e)
+        if key not in self._digests:
+            consent_list, digest = self._create_list(key)
+            fhir_client.request("PUT", f"List/{consent_list.id}", consent_list)
+            self._digests[key] = digest
+        return get_consent_list_id(permit, deny)
+
+    async def async_materialize(self, fhir_client, permit=(), deny=()):
+        key = get_consent_list_key(permit, deny)
+        if key in self._digests:
+            try:
+                await fhir_client.request(
+                    "GET", f"List/{get_consent_list_id(permit, deny)}", params={"_elements": "id"}
+                )
+            except FHIRRequestError as e:
+                self._forget_missing(key, e)
+        if key not in self._digests:
+            consent_list, digest = self._create_list(key)
+            await fhir_client.request("PUT", f"List/{consent_list.id}", consent_list)
+            self._digests[key] = digest
+        return get_consent_list_id(permit, deny)
+
+    def _changed_lists(self):
+        for key, digest in list(self._digests.items()):
+            consent_list, new_digest = self._create_list(key)
+            if new_digest != digest:
+                yield key, consent_list, new_digest
+
+    def refresh(self, fhir_client, index=None):
+        if index is not None:
+            self.index = index
+        refreshed = 0
+        for key, consent_list, digest in self._changed_lists():
+            fhir_client.request("PUT", f"List/{consent_list.id}", consent_list)
+            self._digests[key] = digest
+            refreshed += 1
+        return refreshed
+
+    async def async_refresh(self, fhir_client, index=None):
+        if index is not None:
+            self.index = index
+        refreshed = 0
+        for key, consent_list, digest in self._changed_lists():
+            await fhir_client.request("PUT", f"List/{consent_list.id}", consent_list)
+            self._digests[key] = digest
+            refreshed += 1
+        return refreshed
+
+    def get_search_params(self, fhir_client, permit=(), deny=()):
+        return {"_list": self.materialize(fhir_client, permit, deny)}
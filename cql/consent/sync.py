@@ -0,0 +1,206 @@
+import asyncio
+import inspect
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+
+from cql.client.fhir import DEFAULT_PAGE_SIZE
+from cql.consent.index import ConsentIndex, CONSENT_FIELDS
+
+SYNC_FIELDS = CONSENT_FIELDS + ["meta"]
+
+
+def get_history_consent_id(entry):
+    resource = entry.get("resource")
+    if resource is not None and "id" in resource:
+        return resource["id"]
+    return entry["request"]["url"].split("/")[1]
+
+
+def get_entry_timestamp(entry):
+    resource = entry.get("resource") or {}
+    return entry.get("response", {}).get("lastModified") or resource.get(
+        "meta", {}
+    ).get("lastUpdated", "")
+
+
+def to_datetime(value):
+    """
+    Parses a FHIR instant, so that instants with different offsets or
+    fractional digits compare correctly
+    """
+    if not value:
+        return None
+    moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment
+
+
+def is_later(timestamp, other):
+    timestamp, other = to_datetime(timestamp), to_datetime(other)
+    return timestamp is not None and (other is None or timestamp > other)
+
+
+def get_history_position(bundle):
+    """
+    Returns the position of a Consent/_history?_count=1 Bundle: the time of
+    the server snapshot, or the time of its newest entry
+    """
+    position = bundle.get("meta", {}).get("lastUpdated")
+    for entry in bundle.get("entry", [])[:1]:
+        position = position or get_entry_timestamp(entry)
+    return position or None
+
+
+class ConsentSync:
+    """
+    Keeps a ConsentIndex up to date with the server. The first sync loads
+    every Consent; the following ones only read Consent/_history?_since=
+    the last seen lastUpdated (the watermark) and apply the latest version
+    of each changed Consent, or remove it if it was deleted. The watermark
+    and the index are persisted in state_path, so that a restarted process
+    catches up from the deltas. The watermark of the first sync is the
+    position of the history before the load starts, so that the Consents
+    changed while it is running are read again by the next sync.
+    on_change(index), if given, is called after every sync that loaded or
+    changed Consents, e.g. to refresh the ConsentLists built on the index;
+    async_sync awaits it when it returns a coroutine
+    """
+
+    def __init__(self, state_path=None, page_size=DEFAULT_PAGE_SIZE, on_change=None):
+        self.state_path = state_path
+        self.page_size = page_size
+        self.on_change = on_change
+        self.index = ConsentIndex()
+        self.watermark = None
+        if state_path is not None and os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            try:
+                self.index = ConsentIndex.from_dict(state["index"])
+                self.watermark = state["watermark"]
+            except ValueError as e:
+                logging.warning("Ignoring %s: %s" % (state_path, e))
+
+    def save(self):
+        if self.state_path is None:
+            return
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"watermark": self.watermark, "index": self.index.to_dict()}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _update_watermark(self, timestamp):
+        if is_later(timestamp, self.watermark):
+            self.watermark = timestamp
+
+    def _start_load(self, history_bundle):
+        self.index = ConsentIndex()
+        self._load_position = get_history_position(history_bundle)
+        self._latest_loaded = None
+
+    def _load_consent(self, consent):
+        self.index.add_consent(consent)
+        timestamp = consent.get("meta", {}).get("lastUpdated")
+        if is_later(timestamp, self._latest_loaded):
+            self._latest_loaded = timestamp
+
+    def _end_load(self):
+        # without a history position (e.g. no Consent yet) the newest loaded
+        # Consent is the best available lower bound
+        self.watermark = self._load_position or self._latest_loaded
+        self.save()
+        return len(self.index)
+
+    def _collect_change(self, changes, entry):
+        consent_id = get_history_consent_id(entry)
+        if consent_id not in changes or is_later(
+            get_entry_timestamp(entry), get_entry_timestamp(changes[consent_id])
+        ):
+            changes[consent_id] = entry
+
+    def _apply_changes(self, changes):
+        for consent_id, entry in changes.items():
+            if entry.get("request", {}).get("method") == "DELETE" or not entry.get(
+                "resource"
+            ):
+                self.index.remove_consent(consent_id)
+            else:
+                self.index.add_consent(entry["resource"], consent_id)
+            self._update_watermark(get_entry_timestamp(entry))
+        logging.debug("Applied %s Consent changes" % len(changes))
+        self.save()
+        return len(changes)
+
+    def _history_params(self):
+        return {"_since": self.watermark}
+
+    def sync(self, fhir_client):
+        changed = self._sync(fhir_client)
+        if changed and self.on_change is not None:
+            self.on_change(self.index)
+        return changed
+
+    async def async_sync(self, fhir_client):
+        changed = await self._async_sync(fhir_client)
+        if changed and self.on_change is not None:
+            result = self.on_change(self.index)
+            if inspect.isawaitable(result):
+                await result
+        return changed
+
+    def _sync(self, fhir_client):
+        if self.watermark is None:
+            self._start_load(
+                fhir_client.request("GET", "Consent/_history", params={"_count": "1"})
+            )
+            for consent in fhir_client.iter_resources(
+                "Consent", page_size=self.page_size, fields=SYNC_FIELDS
+            ):
+                self._load_consent(consent)
+            return self._end_load()
+        changes = {}
+        for entry in fhir_client.iter_entries(
+            "Consent/_history",
+            params=self._history_params(),
+            page_size=self.page_size,
+            fields=SYNC_FIELDS,
+        ):
+            self._collect_change(changes, entry)
+        return self._apply_changes(changes)
+
+    async def _async_sync(self, fhir_client):
+        if self.watermark is None:
+            self._start_load(
+                await fhir_client.request(
+                    "GET", "Consent/_history", params={"_count": "1"}
+                )
+            )
+            async for consent in fhir_client.iter_resources(
+                "Consent", page_size=self.page_size, fields=SYNC_FIELDS
+            ):
+                self._load_consent(consent)
+            return self._end_load()
+        changes = {}
+        async for entry in fhir_client.iter_entries(
+            "Consent/_history",
+            params=self._history_params(),
+            page_size=self.page_size,
+            fields=SYNC_FIELDS,
+        ):
+            self._collect_change(changes, entry)
+        return self._apply_changes(changes)
+
+    def poll(self, fhir_client, interval, stop_event: threading.Event = None):
+        stop_event = stop_event if stop_event is not None else threading.Event()
+        while not stop_event.is_set():
+            self.sync(fhir_client)
+            stop_event.wait(interval)
+
+    async def async_poll(self, fhir_client, interval):
+        while True:
+            await self.async_sync(fhir_client)
+            await asyncio.sleep(interval)
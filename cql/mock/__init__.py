@@ -0,0 +1,2 @@
+from .dataset import create_dataset, load_bundles
+from .server import AsyncMockServer, MockServer, select_subjects
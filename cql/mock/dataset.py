@@ -0,0 +1,132 @@
+import glob
+import json
+import random
+
+from cql.compiler.compiler import CODE_SYSTEMS, SAMPLE_DIAGNOSIS_URL
+from cql.compiler.search import CCE_CODES, CONSENT_STATUSES, DECISIONS
+
+DIAGNOSES = ["C18.0", "C34.1", "C50.9", "C61", "E11.9", "I10", "J45.9", "K50.9", "M05.9", "G35"]
+SAMPLE_TYPES = ["dna", "whole-blood", "urine", "blood-serum", "tissue-other", "saliva", "blood-plasma"]
+GENDERS = ["male", "female"]
+DEFAULT_PAYLOAD_SIZE = 0  # bytes of padding added to every Specimen
+
+
+def create_patient(id, gender):
+    return {"resourceType": "Patient", "id": id, "gender": gender}
+
+
+def create_specimen(id, patient_id, sample_type, diagnosis, payload_size=DEFAULT_PAYLOAD_SIZE):
+    specimen = {
+        "resourceType": "Specimen",
+        "id": id,
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "type": {
+            "coding": [{"system": CODE_SYSTEMS["SampleMaterialType"], "code": sample_type}]
+        },
+        "extension": [
+            {
+                "url": SAMPLE_DIAGNOSIS_URL,
+                "valueCodeableConcept": {
+                    "coding": [{"system": CODE_SYSTEMS["icd10"], "code": diagnosis}]
+                },
+            }
+        ],
+    }
+    if payload_size:
+        specimen["note"] = [{"text": "x" * payload_size}]
+    return specimen
+
+
+def create_consent(id, patient_id, status, provisions):
+    """
+    Returns a Consent whose provisions are (decision, CCE code, Specimen ids)
+    """
+    return {
+        "resourceType": "Consent",
+        "id": id,
+        "status": status,
+        "patient": {"reference": f"Patient/{patient_id}"},
+        "provision": {
+            "type": "deny",
+            "provision": [
+                {
+                    "type": decision,
+                    "code": [
+                        {
+                            "coding": [
+                                {"system": CODE_SYSTEMS["CommonConditionElements"], "code": cce_code}
+                            ]
+                        }
+                    ],
+                    "data": [
+                        {"meaning": "instance", "reference": {"reference": f"Specimen/{s}"}}
+                        for s in specimen_ids
+                    ],
+                }
+                for decision, cce_code, specimen_ids in provisions
+            ],
+        },
+    }
+
+
+def create_dataset(
+    number_of_patients,
+    specimens_per_patient=4,
+    payload_size=DEFAULT_PAYLOAD_SIZE,
+    seed=0,
+    consents=False,
+):
+    """
+    Yields number_of_patients random Patients, each followed by its Specimens
+    and, if consents, by a Consent of random status with a random decision
+    per CCE for a random subset of them. The same seed always gives the
+    same resources
+    """
+    rng = random.Random(seed)
+    for i in range(number_of_patients):
+        patient_id = f"patient-{i}"
+        yield create_patient(patient_id, rng.choice(GENDERS))
+        specimen_ids = [f"specimen-{i}-{j}" for j in range(specimens_per_patient)]
+        for specimen_id in specimen_ids:
+            yield create_specimen(
+                specimen_id,
+                patient_id,
+                rng.choice(SAMPLE_TYPES),
+                rng.choice(DIAGNOSES),
+                payload_size,
+            )
+        if consents:
+            yield create_consent(
+                f"consent-{i}",
+                patient_id,
+                rng.choice(CONSENT_STATUSES),
+                [
+                    (
+                        rng.choice(DECISIONS),
+                        cce_code,
+                        [s for s in specimen_ids if rng.random() < 0.5],
+                    )
+                    for cce_code in CCE_CODES
+                ],
+            )
+
+
+def load_bundles(pattern):
+    """
+    Yields the resources of the Bundles in the JSON files matching the glob
+    pattern, e.g. the examples uploaded to Blaze by examples/load_examples.sh.
+    .ndjson files are read as one resource per line
+    """
+    for path in sorted(glob.glob(pattern, recursive=True)):
+        if path.endswith(".ndjson"):
+            with open(path) as f:
+                yield from (json.loads(line) for line in f if line.strip())
+            continue
+        with open(path) as f:
+            bundle = json.load(f)
+        if bundle.get("resourceType") != "Bundle":
+            yield bundle
+            continue
+        for entry in bundle.get("entry", []):
+            if "resource" in entry:
+                yield entry["resource"]
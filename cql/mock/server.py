@@ -0,0 +1,540 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import random
+import secrets
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+from aiohttp import web
+
+from cql.compiler.compiler import CODE_SYSTEMS, SAMPLE_DIAGNOSIS_URL
+from cql.compiler.search import CCE_CODES, DECISIONS, get_provision_search_parameter_code
+from cql.mock.dataset import create_dataset
+
+DEFAULT_HOST = "localhost"
+DEFAULT_PORT = 8089
+DEFAULT_PREFIX = "/fhir"  # as Blaze, so that only the port changes in FHIR_BASE_URL
+DEFAULT_SELECTIVITY = 0.05  # fraction of the subjects matched by a query
+DEFAULT_PAGE_SIZE = 50
+HISTORY_SIZE = 1000  # history entries kept per resource type
+PROVISION_SEARCH_PARAMETERS = {
+    get_provision_search_parameter_code(cce_code, decision): (cce_code, decision)
+    for cce_code in CCE_CODES
+    for decision in DECISIONS
+}
+# seconds each kind of request is delayed by, to emulate the server work
+DEFAULT_LATENCY = {
+    "create": 0,
+    "read": 0,
+    "search": 0,
+    "history": 0,
+    "transaction": 0,
+    "evaluate": 0,
+}
+
+
+def generate_timestamp():
+    return f"{datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]}Z"
+
+
+def parse_timestamp(timestamp):
+    return datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+
+
+def operation_outcome(status, diagnostics):
+    return web.json_response(
+        {
+            "resourceType": "OperationOutcome",
+            "issue": [{"severity": "error", "code": "processing", "diagnostics": diagnostics}],
+        },
+        status=status,
+    )
+
+
+def select_subjects(key, subject_ids, selectivity=DEFAULT_SELECTIVITY):
+    """
+    Returns a pseudo-random subset of the subject ids, always the same for
+    the same key, e.g. the text of a CQL query and its parameters
+    """
+    seed = int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8], "big")
+    rng = random.Random(seed)
+    size = min(len(subject_ids), round(len(subject_ids) * selectivity * 2 * rng.random()))
+    return sorted(rng.sample(subject_ids, size))
+
+
+def match_last_updated(resource, value):
+    prefix, timestamp = value[:2], value[2:]
+    if prefix not in ("lt", "le", "gt", "ge", "eq"):
+        prefix, timestamp = "eq", value
+    last_updated = parse_timestamp(resource.get("meta", {}).get("lastUpdated", "1970-01-01T00:00:00Z"))
+    cutoff = parse_timestamp(timestamp)
+    return {
+        "lt": last_updated < cutoff,
+        "le": last_updated <= cutoff,
+        "gt": last_updated > cutoff,
+        "ge": last_updated >= cutoff,
+        "eq": last_updated == cutoff,
+    }[prefix]
+
+
+def match_token(concepts, value):
+    """
+    Matches a token search value ([system|]code, comma-separated for "or")
+    against the codings of the CodeableConcepts
+    """
+    codings = [c for concept in concepts for c in concept.get("coding", [])]
+    for token in value.split(","):
+        system, separator, code = token.rpartition("|")
+        if any(
+            c.get("code") == code and (not separator or c.get("system") == system)
+            for c in codings
+        ):
+            return True
+    return False
+
+
+def get_reference_id(reference):
+    return reference.split("/")[-1] if reference else None
+
+
+def match_tag(resource, value):
+    system, _, code = value.rpartition("|")
+    return any(
+        t.get("code") == code and (not system or t.get("system") == system)
+        for t in resource.get("meta", {}).get("tag", [])
+    )
+
+
+class AsyncMockServer:
+    """
+    In-memory stand-in for Blaze, to benchmark and test the client without a
+    FHIR server. It stores any resource (created by POST, PUT or transaction
+    and batch Bundles), answers searches by _id, _list, _tag, _lastUpdated
+    and the Specimen parameters of the search fast path, with paging and
+    _summary=count, the _history of each resource type, and
+    $evaluate-measure. CQL is not evaluated: the subjects of a Measure are
+    those returned by cql_evaluator(cql_query, parameters) if given, else,
+    as for searches by any other parameter, a subset of the stored ones
+    picked by a hash of the query (see select_subjects); strata are left
+    empty. Every kind of request can be delayed by a fixed latency
+    """
+
+    def __init__(
+        self,
+        resources=(),
+        latency=None,
+        selectivity=DEFAULT_SELECTIVITY,
+        evaluator=None,
+        cql_evaluator=None,
+        prefix=DEFAULT_PREFIX,
+    ):
+        self.resources = {}
+        self.history = {}
+        self.latency = {**DEFAULT_LATENCY, **(latency or {})}
+        self.selectivity = selectivity
+        self.evaluator = evaluator if evaluator is not None else self.select_subjects
+        self.cql_evaluator = cql_evaluator
+        self.prefix = prefix
+        self.requests = {}
+        self._runner = None
+        for resource in resources:
+            self.store(resource)
+
+    def select_subjects(self, key, subject_ids):
+        return select_subjects(key, subject_ids, self.selectivity)
+
+    def create_app(self):
+        app = web.Application(client_max_size=1024**3)
+        app.add_routes(
+            [
+                web.post(self.prefix, self.handle_bundle),
+                web.post(f"{self.prefix}/", self.handle_bundle),
+                web.get(f"{self.prefix}/{{type}}/_history", self.handle_history),
+                web.post(f"{self.prefix}/Measure/{{id}}/$evaluate-measure", self.handle_evaluate),
+                web.get(f"{self.prefix}/{{type}}", self.handle_search),
+                web.post(f"{self.prefix}/{{type}}", self.handle_create),
+                web.get(f"{self.prefix}/{{type}}/{{id}}", self.handle_read),
+                web.put(f"{self.prefix}/{{type}}/{{id}}", self.handle_update),
+                web.delete(f"{self.prefix}/{{type}}/{{id}}", self.handle_delete),
+            ]
+        )
+        return app
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        """
+        Starts serving on host:port (0 for a free port) and returns the base
+        URL to give to the FHIR client
+        """
+        self._runner = web.AppRunner(self.create_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}{self.prefix}"
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+        self._runner = None
+
+    async def delay(self, operation):
+        self.requests[operation] = self.requests.get(operation, 0) + 1
+        if self.latency.get(operation):
+            await asyncio.sleep(self.latency[operation])
+
+    def store(self, resource, method="PUT"):
+        resource_type = resource["resourceType"]
+        resources = self.resources.setdefault(resource_type, {})
+        if method == "POST" or "id" not in resource:
+            resource["id"] = secrets.token_hex(8)
+        previous = resources.get(resource["id"])
+        version = int(previous["meta"]["versionId"]) + 1 if previous is not None else 1
+        resource["meta"] = {
+            **resource.get("meta", {}),
+            "versionId": str(version),
+            "lastUpdated": generate_timestamp(),
+        }
+        resources[resource["id"]] = resource
+        self.record_history(resource_type, resource, method)
+        return resource
+
+    def remove(self, resource_type, id):
+        resource = self.resources.get(resource_type, {}).pop(id, None)
+        if resource is not None:
+            self.record_history(resource_type, {"resourceType": resource_type, "id": id}, "DELETE")
+        return resource
+
+    def record_history(self, resource_type, resource, method):
+        # the version and its history entry share the same instant, as in Blaze
+        timestamp = resource.get("meta", {}).get("lastUpdated") or generate_timestamp()
+        entry = {
+            "fullUrl": f"{resource_type}/{resource['id']}",
+            "request": {"method": method, "url": f"{resource_type}/{resource['id']}"},
+            "response": {"status": "204" if method == "DELETE" else "200", "lastModified": timestamp},
+        }
+        if method != "DELETE":
+            entry["resource"] = resource
+        self.history.setdefault(resource_type, deque(maxlen=HISTORY_SIZE)).appendleft(entry)
+
+    def base_url(self, request):
+        return f"{request.url.origin()}{self.prefix}"
+
+    async def handle_create(self, request):
+        await self.delay("create")
+        resource = await request.json()
+        if resource.get("resourceType") != request.match_info["type"]:
+            return operation_outcome(400, "Resource type does not match the URL")
+        return web.json_response(self.store(resource, "POST"), status=201)
+
+    async def handle_update(self, request):
+        await self.delay("create")
+        resource = await request.json()
+        resource["id"] = request.match_info["id"]
+        return web.json_response(self.store(resource))
+
+    async def handle_read(self, request):
+        await self.delay("read")
+        resource = self.resources.get(request.match_info["type"], {}).get(request.match_info["id"])
+        if resource is None:
+            return operation_outcome(404, "Resource not found")
+        return web.json_response(resource)
+
+    async def handle_delete(self, request):
+        await self.delay("create")
+        self.remove(request.match_info["type"], request.match_info["id"])
+        return web.Response(status=204)
+
+    async def handle_bundle(self, request):
+        await self.delay("transaction")
+        bundle = await request.json()
+        if bundle.get("resourceType") != "Bundle" or bundle.get("type") not in ("transaction", "batch"):
+            return operation_outcome(400, "Expected a transaction or batch Bundle")
+        entries = []
+        for entry in bundle.get("entry", []):
+            method = entry["request"]["method"]
+            resource_type, _, id = entry["request"]["url"].partition("/")
+            if method == "DELETE":
+                self.remove(resource_type, id)
+                entries.append({"response": {"status": "204"}})
+                continue
+            resource = entry["resource"]
+            if method == "PUT":
+                resource["id"] = id
+            resource = self.store(resource, method)
+            entries.append(
+                {
+                    "response": {
+                        "status": "201" if method == "POST" else "200",
+                        "location": f"{resource_type}/{resource['id']}/_history/{resource['meta']['versionId']}",
+                        "lastModified": resource["meta"]["lastUpdated"],
+                    }
+                }
+            )
+        return web.json_response(
+            {"resourceType": "Bundle", "type": f"{bundle['type']}-response", "entry": entries}
+        )
+
+    async def handle_history(self, request):
+        await self.delay("history")
+        resource_type = request.match_info["type"]
+        query = {name: request.query.getone(name) for name in request.query}
+        entries = list(self.history.get(resource_type, []))
+        if "_since" in query:
+            since = parse_timestamp(query["_since"])
+            entries = [
+                e for e in entries if parse_timestamp(e["response"]["lastModified"]) >= since
+            ]
+        count = int(query.get("_count", DEFAULT_PAGE_SIZE))
+        offset = int(query.get("_offset", 0))
+        bundle = {"resourceType": "Bundle", "type": "history", "total": len(entries)}
+        bundle["link"] = [{"relation": "self", "url": str(request.url)}]
+        bundle["entry"] = entries[offset : offset + count]
+        if offset + count < len(entries):
+            next_query = urlencode({**query, "_offset": offset + count})
+            bundle["link"].append(
+                {
+                    "relation": "next",
+                    "url": f"{self.base_url(request)}/{resource_type}/_history?{next_query}",
+                }
+            )
+        return web.json_response(bundle)
+
+    def search(self, resource_type, query):
+        resources = self.resources.get(resource_type, {})
+        ids = sorted(resources)
+        other = []
+        for name, value in sorted(query.items()):
+            if name in ("_count", "_offset", "_summary", "_elements"):
+                continue
+            if name == "_id":
+                values = set(value.split(","))
+                ids = [i for i in ids if i in values]
+            elif name == "_list":
+                references = {
+                    e["item"]["reference"]
+                    for e in self.resources.get("List", {}).get(value, {}).get("entry", [])
+                }
+                ids = [i for i in ids if f"{resource_type}/{i}" in references]
+            elif name == "_tag":
+                ids = [i for i in ids if match_tag(resources[i], value)]
+            elif name == "_lastUpdated":
+                ids = [i for i in ids if match_last_updated(resources[i], value)]
+            elif resource_type == "Specimen" and name.startswith("_has:") and self.is_specimen_search_parameter(name):
+                specimen_ids = self.get_provision_specimens(name, value)
+                ids = [i for i in ids if i in specimen_ids]
+            elif resource_type == "Specimen" and self.is_specimen_search_parameter(name):
+                ids = [i for i in ids if self.match_specimen(resources[i], name, value)]
+            else:
+                other.append(f"{name}={value}")
+        if other:
+            ids = self.evaluator(f"{resource_type}?{'&'.join(other)}", ids)
+        return ids
+
+    @staticmethod
+    def is_specimen_search_parameter(name):
+        if name in ("diagnosis", "type", "subject:Patient.gender"):
+            return True
+        parts = name.split(":")
+        return (
+            len(parts) == 4
+            and parts[:2] == ["_has", "Consent"]
+            and parts[2] in PROVISION_SEARCH_PARAMETERS
+            and parts[3] == "status"
+        )
+
+    def match_specimen(self, specimen, name, value):
+        """
+        Matches a Specimen against the diagnosis, type and gender parameters
+        of the search fast path, as defined in blaze/custom-search-parameters.json
+        """
+        if name == "diagnosis":
+            return match_token(
+                [
+                    e.get("valueCodeableConcept", {})
+                    for e in specimen.get("extension", [])
+                    if e.get("url") == SAMPLE_DIAGNOSIS_URL
+                ],
+                value,
+            )
+        if name == "type":
+            return match_token([specimen.get("type", {})], value)
+        patient_id = get_reference_id(specimen.get("subject", {}).get("reference"))
+        patient = self.resources.get("Patient", {}).get(patient_id)
+        return patient is not None and patient.get("gender") in value.split(",")
+
+    def get_provision_specimens(self, name, value):
+        """
+        Returns the ids of the Specimens matching a
+        _has:Consent:provision-<decision>-<cce>:status search: those referenced
+        by a provision with the decision and the CCE code, in a Consent with
+        one of the statuses
+        """
+        cce_code, decision = PROVISION_SEARCH_PARAMETERS[name.split(":")[2]]
+        token = f"{CODE_SYSTEMS['CommonConditionElements']}|{cce_code}"
+        statuses = value.split(",")
+        specimen_ids = set()
+        for consent in self.resources.get("Consent", {}).values():
+            if consent.get("status") not in statuses:
+                continue
+            for provision in consent.get("provision", {}).get("provision", []):
+                if provision.get("type") == decision and match_token(provision.get("code", []), token):
+                    specimen_ids.update(
+                        get_reference_id(d.get("reference", {}).get("reference"))
+                        for d in provision.get("data", [])
+                    )
+        return specimen_ids
+
+    async def handle_search(self, request):
+        await self.delay("search")
+        resource_type = request.match_info["type"]
+        query = {name: request.query.getone(name) for name in request.query}
+        if request.headers.get("Prefer") == "handling=strict":
+            for name in query:
+                if not (
+                    name.startswith("_")
+                    and not name.startswith("_has:")
+                    or resource_type == "Specimen" and self.is_specimen_search_parameter(name)
+                ):
+                    return operation_outcome(
+                        400,
+                        f"The search-param with code `{name}` and type `{resource_type}` was not found.",
+                    )
+        ids = self.search(resource_type, query)
+        bundle = {"resourceType": "Bundle", "type": "searchset", "total": len(ids)}
+        if query.get("_summary") == "count":
+            return web.json_response(bundle)
+        count = int(query.get("_count", DEFAULT_PAGE_SIZE))
+        offset = int(query.get("_offset", 0))
+        resources = self.resources.get(resource_type, {})
+        base_url = self.base_url(request)
+        bundle["link"] = [{"relation": "self", "url": str(request.url)}]
+        bundle["entry"] = [
+            {
+                "fullUrl": f"{base_url}/{resource_type}/{id}",
+                "resource": resources[id],
+                "search": {"mode": "match"},
+            }
+            for id in ids[offset : offset + count]
+        ]
+        if offset + count < len(ids):
+            next_query = urlencode({**query, "_offset": offset + count})
+            bundle["link"].append(
+                {"relation": "next", "url": f"{base_url}/{resource_type}?{next_query}"}
+            )
+        return web.json_response(bundle)
+
+    def evaluate(self, measure, parameters):
+        library_url = measure["library"][0]
+        library = next(
+            (r for r in self.resources.get("Library", {}).values() if r.get("url") == library_url),
+            None,
+        )
+        if library is None:
+            return None
+        cql_query = base64.b64decode(library["content"][0]["data"]).decode("utf-8")
+        subject_type = measure["subjectCodeableConcept"]["coding"][0]["code"]
+        if self.cql_evaluator is not None:
+            subject_ids = self.cql_evaluator(cql_query, parameters)
+            if subject_ids is not None:
+                return subject_type, subject_ids
+        key = cql_query + json.dumps(parameters, sort_keys=True)
+        return subject_type, self.evaluator(key, sorted(self.resources.get(subject_type, {})))
+
+    async def handle_evaluate(self, request):
+        await self.delay("evaluate")
+        measure = self.resources.get("Measure", {}).get(request.match_info["id"])
+        if measure is None:
+            return operation_outcome(404, "Measure not found")
+        body = await request.json()
+        arguments = {p["name"]: p for p in body.get("parameter", [])}
+        report_type = arguments.get("reportType", {}).get("valueCode", "population")
+        parameters = arguments.get("parameters", {}).get("resource", {}).get("parameter", [])
+        evaluation = self.evaluate(measure, parameters)
+        if evaluation is None:
+            return operation_outcome(422, "Library of the Measure not found")
+        subject_type, subject_ids = evaluation
+        group = measure["group"][0]
+        populations = []
+        for population in group.get("population", []):
+            result = {"code": population["code"], "count": len(subject_ids)}
+            if report_type == "subject-list":
+                subject_list = self.store(
+                    {
+                        "resourceType": "List",
+                        "status": "current",
+                        "mode": "working",
+                        "entry": [
+                            {"item": {"reference": f"{subject_type}/{i}"}} for i in subject_ids
+                        ],
+                    },
+                    "POST",
+                )
+                result["subjectResults"] = {"reference": f"List/{subject_list['id']}"}
+            populations.append(result)
+        return web.json_response(
+            {
+                "resourceType": "MeasureReport",
+                "status": "complete",
+                "type": "subject-list" if report_type == "subject-list" else "summary",
+                "measure": measure.get("url", f"Measure/{measure['id']}"),
+                "date": generate_timestamp(),
+                "group": [
+                    {
+                        "population": populations,
+                        "stratifier": [
+                            {"code": [s["code"]], "stratum": []}
+                            for s in group.get("stratifier", [])
+                        ],
+                    }
+                ],
+            }
+        )
+
+
+class MockServer:
+    """
+    Synchronous wrapper around AsyncMockServer, serving from a private event
+    loop in a daemon thread, so that it can run in the same process as the
+    synchronous clients
+    """
+
+    def __init__(self, resources=(), **kwargs):
+        self.async_server = AsyncMockServer(resources, **kwargs)
+        self._loop = None
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self, host=DEFAULT_HOST, port=0):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="fhir-mock-server", daemon=True
+        )
+        self._thread.start()
+        return asyncio.run_coroutine_threadsafe(
+            self.async_server.start(host, port), self._loop
+        ).result()
+
+    def close(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.async_server.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = self._thread = None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    server = AsyncMockServer(create_dataset(10000))
+    web.run_app(server.create_app(), host=DEFAULT_HOST, port=DEFAULT_PORT)
@@ -7,7 +7,10 @@ class FHIRResource:
         return self._resource
 
 
+from .bundle import DeletionBundle, TransactionBundle
 from .evaluation_measure import EvaluationMeasure
 from .library import Library
 from .measure import Measure
+from .parameter import Parameter
 from .population import Population
+from .stratifier import Stratifier, StratifierComponent
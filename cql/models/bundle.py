@@ -0,0 +1,39 @@
+from cql.models import FHIRResource
+
+
+def create_transaction_entry(resource):
+    return {
+        "resource": resource,
+        "request": {
+            "method": "PUT",
+            "url": f"{resource['resourceType']}/{resource['id']}",
+        },
+    }
+
+
+class TransactionBundle(FHIRResource):
+    def __init__(self, resources: list[FHIRResource]):
+        self.resources = resources
+        super(TransactionBundle, self).__init__(
+            {
+                "resourceType": "Bundle",
+                "type": "transaction",
+                "entry": [
+                    create_transaction_entry(r.get_resource()) for r in self.resources
+                ],
+            }
+        )
+
+
+class DeletionBundle(FHIRResource):
+    def __init__(self, references: list[str]):
+        self.references = references
+        super(DeletionBundle, self).__init__(
+            {
+                "resourceType": "Bundle",
+                "type": "batch",
+                "entry": [
+                    {"request": {"method": "DELETE", "url": r}} for r in self.references
+                ],
+            }
+        )
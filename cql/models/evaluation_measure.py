@@ -1,23 +1,35 @@
 from cql.models import FHIRResource
+from cql.models.parameter import Parameter
 
 
 class EvaluationMeasure(FHIRResource):
     SUBJECT_LIST = "subject-list"
     POPULATION = "population"
 
-    def __init__(self, period_start, period_end, report_type):
+    def __init__(
+        self, period_start, period_end, report_type, parameters: list[Parameter] = None
+    ):
         assert report_type in (self.SUBJECT_LIST, self.POPULATION)
         self.period_start = period_start
         self.period_end = period_end
         self.report_type = report_type
+        self.parameters = parameters if parameters is not None else []
 
+        resource_parameters = [
+            {"name": "periodStart", "valueDate": self.period_start},
+            {"name": "periodEnd", "valueDate": self.period_end},
+            {"name": "reportType", "valueCode": self.report_type},
+        ]
+        if self.parameters:
+            resource_parameters.append(
+                {
+                    "name": "parameters",
+                    "resource": {
+                        "resourceType": "Parameters",
+                        "parameter": [p.get_resource() for p in self.parameters],
+                    },
+                }
+            )
         super(EvaluationMeasure, self).__init__(
-            {
-                "resourceType": "Parameters",
-                "parameter": [
-                    {"name": "periodStart", "valueDate": self.period_start},
-                    {"name": "periodEnd", "valueDate": self.period_end},
-                    {"name": "reportType", "valueCode": self.report_type},
-                ],
-            }
+            {"resourceType": "Parameters", "parameter": resource_parameters}
         )
@@ -2,17 +2,19 @@ from cql.models import FHIRResource
 
 
 class Library(FHIRResource):
-    def __init__(self, version_id, last_updated, data, id, url):
+    def __init__(self, version_id, last_updated, data, id, url, tags=None):
         self.version_id = version_id
         self.last_updated = last_updated
         self.data = data
         self.id = id
         self.url = url
+        self.tags = tags
         super(Library, self).__init__(
             {
                 "meta": {
                     "versionId": self.version_id,
                     "lastUpdated": self.last_updated,
+                    **({"tag": self.tags} if self.tags else {}),
                 },
                 "content": [{"contentType": "text/cql", "data": self.data}],
                 "resourceType": "Library",
@@ -13,6 +13,7 @@ class Measure(FHIRResource):
         subject,
         library_url,
         id,
+        tags=None,
     ):
         self.stratifiers = stratifiers
         self.populations = populations
@@ -21,6 +22,7 @@ class Measure(FHIRResource):
         self.subject = subject
         self.library_url = library_url
         self.id = id
+        self.tags = tags
         super(Measure, self).__init__(
             {
                 "group": [
@@ -32,6 +34,7 @@ class Measure(FHIRResource):
                 "meta": {
                     "versionId": self.version_id,
                     "lastUpdated": self.last_updated,
+                    **({"tag": self.tags} if self.tags else {}),
                 },
                 "subjectCodeableConcept": {
                     "coding": [
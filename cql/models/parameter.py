@@ -0,0 +1,19 @@
+from cql.models import FHIRResource
+
+
+class Parameter(FHIRResource):
+    STRING = "String"
+    CODE = "Code"
+    INTEGER = "Integer"
+    DECIMAL = "Decimal"
+    BOOLEAN = "Boolean"
+    DATE = "Date"
+    DATETIME = "DateTime"
+
+    def __init__(self, name, value, value_type=STRING):
+        self.name = name
+        self.value = value
+        self.value_type = value_type
+        super(Parameter, self).__init__(
+            {"name": self.name, f"value{self.value_type}": self.value}
+        )
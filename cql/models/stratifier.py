@@ -1,13 +1,26 @@
 from cql.models import FHIRResource
 
 
-class Stratifier(FHIRResource):
+class StratifierComponent(FHIRResource):
     def __init__(self, expression, code):
         self.expression = expression
         self.code = code
-        super(Stratifier, self).__init__(
+        super(StratifierComponent, self).__init__(
             {
                 "criteria": {"expression": self.expression, "language": "text/cql"},
                 "code": {"text": self.code},
             }
         )
+
+
+class Stratifier(FHIRResource):
+    def __init__(self, expression, code, components: list[StratifierComponent] = None):
+        self.expression = expression
+        self.code = code
+        self.components = components if components is not None else []
+        resource = {"code": {"text": self.code}}
+        if self.expression is not None:
+            resource["criteria"] = {"expression": self.expression, "language": "text/cql"}
+        if self.components:
+            resource["component"] = [c.get_resource() for c in self.components]
+        super(Stratifier, self).__init__(resource)
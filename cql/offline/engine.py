@@ -0,0 +1,299 @@
+import numpy as np
+
+from cql.compiler.compiler import CODE_SYSTEMS, SAMPLE_DIAGNOSIS_URL
+from cql.compiler.nodes import (
+    PATIENT,
+    SPECIMEN,
+    ConsentCriterion,
+    DiagnosisCriterion,
+    GenderCriterion,
+    Query,
+    QueryParameter,
+    SampleTypeCriterion,
+    SpecimenIdsCriterion,
+    SpecimenListCriterion,
+)
+from cql.consent.index import get_specimen_id
+
+NO_PATIENT = -1
+
+
+class Vocabulary:
+    """
+    Maps the values of a column to small integers, so that the column can be
+    stored in a NumPy array and compared with vectorized operations
+    """
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def lookup(self, values):
+        return np.array(
+            [self.codes[v] for v in values if v in self.codes], dtype=np.int32
+        )
+
+
+def get_codes(concepts, system):
+    return [
+        coding["code"]
+        for concept in concepts
+        for coding in concept.get("coding", [])
+        if coding.get("system") == system and "code" in coding
+    ]
+
+
+def get_diagnosis_codes(specimen):
+    return get_codes(
+        [
+            e.get("valueCodeableConcept", {})
+            for e in specimen.get("extension", [])
+            if e.get("url") == SAMPLE_DIAGNOSIS_URL
+        ],
+        CODE_SYSTEMS["icd10"],
+    )
+
+
+def get_reference_id(reference, resource_type):
+    if reference is None or not reference.startswith(f"{resource_type}/"):
+        return None
+    return get_specimen_id(reference)
+
+
+class ColumnBuilder:
+    """
+    Accumulates (row, value code) pairs of a multi-valued column
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.codes = []
+
+    def append(self, row, code):
+        self.rows.append(row)
+        self.codes.append(code)
+
+    def build(self):
+        return (
+            np.array(self.rows, dtype=np.int64),
+            np.array(self.codes, dtype=np.int32),
+        )
+
+
+class CohortEngine:
+    """
+    Offline, columnar evaluator of the cql.compiler queries over a dataset of
+    FHIR resources (Patients, Specimens, Consents and Lists), e.g. the one
+    written by test/generate_test_resources.py. Every attribute is a NumPy
+    array of integer codes, one row per Specimen (or per Specimen attribute
+    value, for multi-valued ones), and every criterion becomes a boolean mask,
+    so a query costs a few vectorized operations. The semantics are those of
+    the compiled CQL: in particular a consent criterion matches the Specimens
+    referenced by any provision with the code and type, whatever the status
+    of the Consent and the other provisions for the same Specimen, unlike
+    cql.consent.ConsentIndex, which keeps only the decisions in force
+    """
+
+    def __init__(self, resources):
+        self.specimen_ids = []
+        self.patient_ids = []
+        self.specimen_positions = {}
+        self.patient_positions = {}
+        self.diagnoses = Vocabulary()
+        self.sample_types = Vocabulary()
+        self.genders = Vocabulary()
+        self.cce_codes = Vocabulary()
+        self.decisions = Vocabulary()
+        self.lists = {}
+        specimen_patients = []
+        patient_genders = []
+        diagnosis_column = ColumnBuilder()
+        sample_type_column = ColumnBuilder()
+        provision_codes = []
+        provision_decisions = []
+        provision_references = []
+        list_references = {}
+        for resource in resources:
+            resource_type = resource.get("resourceType")
+            if resource_type == "Specimen":
+                row = self._get_position(self.specimen_ids, self.specimen_positions, resource["id"])
+                if row == len(specimen_patients):
+                    specimen_patients.append(None)
+                specimen_patients[row] = get_reference_id(
+                    resource.get("subject", {}).get("reference"), "Patient"
+                )
+                for code in get_diagnosis_codes(resource):
+                    diagnosis_column.append(row, self.diagnoses.encode(code))
+                for code in get_codes([resource.get("type", {})], CODE_SYSTEMS["SampleMaterialType"]):
+                    sample_type_column.append(row, self.sample_types.encode(code))
+            elif resource_type == "Patient":
+                row = self._get_position(self.patient_ids, self.patient_positions, resource["id"])
+                if row == len(patient_genders):
+                    patient_genders.append(None)
+                patient_genders[row] = resource.get("gender")
+            elif resource_type == "Consent":
+                for provision in resource.get("provision", {}).get("provision", []):
+                    decision = self.decisions.encode(provision.get("type"))
+                    for code in get_codes(provision.get("code", []), CODE_SYSTEMS["CommonConditionElements"]):
+                        for data in provision.get("data", []):
+                            reference = data.get("reference", {}).get("reference")
+                            if reference is not None:
+                                provision_codes.append(self.cce_codes.encode(code))
+                                provision_decisions.append(decision)
+                                provision_references.append(get_specimen_id(reference))
+            elif resource_type == "List":
+                list_references[resource["id"]] = [
+                    get_reference_id(e.get("item", {}).get("reference"), "Specimen")
+                    for e in resource.get("entry", [])
+                ]
+
+        # Specimen rows are only known once all the resources are read
+        self.specimen_patient = np.array(
+            [self.patient_positions.get(p, NO_PATIENT) for p in specimen_patients],
+            dtype=np.int64,
+        )
+        self.patient_gender = np.array(
+            [self.genders.encode(g) for g in patient_genders], dtype=np.int32
+        )
+        self.diagnosis_rows, self.diagnosis_codes = diagnosis_column.build()
+        self.sample_type_rows, self.sample_type_codes = sample_type_column.build()
+        self.provision_codes = np.array(provision_codes, dtype=np.int32)
+        self.provision_decisions = np.array(provision_decisions, dtype=np.int32)
+        self.provision_rows = self.get_rows(provision_references)
+        for list_id, references in list_references.items():
+            self.lists[list_id] = self.get_rows(references)
+
+    @staticmethod
+    def _get_position(ids, positions, id):
+        position = positions.get(id)
+        if position is None:
+            position = positions[id] = len(ids)
+            ids.append(id)
+        return position
+
+    def __len__(self):
+        return len(self.specimen_ids)
+
+    def get_rows(self, specimen_ids):
+        """
+        Returns the rows of the given Specimen ids, -1 for unknown ones
+        """
+        return np.array(
+            [self.specimen_positions.get(i, -1) for i in specimen_ids], dtype=np.int64
+        )
+
+    def rows_mask(self, rows):
+        mask = np.zeros(len(self.specimen_ids), dtype=bool)
+        mask[rows[rows >= 0]] = True
+        return mask
+
+    def column_mask(self, rows, codes, vocabulary, values):
+        return self.rows_mask(rows[np.isin(codes, vocabulary.lookup(values))])
+
+    def criterion_mask(self, criterion, parameters):
+        def values(v):
+            return resolve_values(v, parameters)
+
+        if isinstance(criterion, DiagnosisCriterion):
+            return self.column_mask(
+                self.diagnosis_rows, self.diagnosis_codes, self.diagnoses, values(criterion.code)
+            )
+        if isinstance(criterion, SampleTypeCriterion):
+            return self.column_mask(
+                self.sample_type_rows, self.sample_type_codes, self.sample_types, values(criterion.code)
+            )
+        if isinstance(criterion, GenderCriterion):
+            genders = np.isin(self.patient_gender, self.genders.lookup(values(criterion.gender)))
+            has_patient = self.specimen_patient != NO_PATIENT
+            mask = np.zeros(len(self.specimen_ids), dtype=bool)
+            mask[has_patient] = genders[self.specimen_patient[has_patient]]
+            return mask
+        if isinstance(criterion, ConsentCriterion):
+            selected = np.isin(self.provision_codes, self.cce_codes.lookup(values(criterion.codes)))
+            if criterion.decision is not None:
+                selected &= np.isin(
+                    self.provision_decisions, self.decisions.lookup(values(criterion.decision))
+                )
+            return self.rows_mask(self.provision_rows[selected])
+        if isinstance(criterion, SpecimenIdsCriterion):
+            return self.rows_mask(self.get_rows(values(criterion.ids)))
+        if isinstance(criterion, SpecimenListCriterion):
+            rows = [self.lists[i] for i in values(criterion.list_id) if i in self.lists]
+            return self.rows_mask(np.concatenate(rows) if rows else np.array([], dtype=np.int64))
+        raise ValueError(f"Unsupported criterion: {type(criterion).__name__}")
+
+    def specimen_mask(self, criteria, parameters=None):
+        """
+        Returns the boolean mask of the Specimens matching all the criteria.
+        parameters maps the names of the QueryParameters to their values, or
+        is a list of cql.models.Parameter, repeated for List<String> ones
+        """
+        parameters = get_parameter_values(parameters)
+        mask = np.ones(len(self.specimen_ids), dtype=bool)
+        for criterion in criteria:
+            mask &= self.criterion_mask(criterion, parameters)
+        return mask
+
+    def patient_mask(self, criteria, parameters=None):
+        """
+        Returns the boolean mask of the Patients matching the gender criteria
+        with at least one Specimen matching all the others
+        """
+        gender_criteria = [c for c in criteria if isinstance(c, GenderCriterion)]
+        specimen_criteria = [c for c in criteria if not isinstance(c, GenderCriterion)]
+        values = get_parameter_values(parameters)
+        mask = np.ones(len(self.patient_ids), dtype=bool)
+        for criterion in gender_criteria:
+            genders = resolve_values(criterion.gender, values)
+            mask &= np.isin(self.patient_gender, self.genders.lookup(genders))
+        if specimen_criteria:
+            specimens = self.specimen_mask(specimen_criteria, parameters)
+            patients = np.zeros(len(self.patient_ids), dtype=bool)
+            patients[self.specimen_patient[specimens & (self.specimen_patient != NO_PATIENT)]] = True
+            mask &= patients
+        return mask
+
+    def subject_mask(self, query: Query, parameters=None):
+        if query.context == SPECIMEN:
+            return self.specimen_mask(query.criteria, parameters)
+        if query.context == PATIENT:
+            return self.patient_mask(query.criteria, parameters)
+        raise ValueError(f"Unsupported context: {query.context}")
+
+    def evaluate(self, query: Query, parameters=None):
+        """
+        Returns the ids of the subjects (Specimens or Patients, by the context
+        of the query) in the initial population
+        """
+        ids = self.specimen_ids if query.context == SPECIMEN else self.patient_ids
+        return [ids[i] for i in np.flatnonzero(self.subject_mask(query, parameters))]
+
+    def count(self, query: Query, parameters=None):
+        return int(self.subject_mask(query, parameters).sum())
+
+
+def resolve_values(value, parameters):
+    """
+    Returns the list of the values of a literal or of a QueryParameter
+    """
+    if isinstance(value, QueryParameter):
+        value = parameters[value.name]
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def get_parameter_values(parameters):
+    if parameters is None:
+        return {}
+    if isinstance(parameters, dict):
+        return parameters
+    values = {}
+    for parameter in parameters:
+        values.setdefault(parameter.name, []).append(parameter.value)
+    return {name: v[0] if len(v) == 1 else v for name, v in values.items()}
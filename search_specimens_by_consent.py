@@ -1,14 +1,23 @@
-import base64
 import json
-import secrets
-import uuid
-import requests
 import pprint
 
-from datetime import datetime
-from cql.models import Library, Population, Measure, EvaluationMeasure
-from aiohttp import web
-from enum import Enum
+from cql.client import (
+    FHIRClient,
+    CQLQueryClient,
+    Granularity,
+    LibraryRegistry,
+    ResourceCollector,
+    ResultCache,
+)
+from cql.compiler import (
+    STRING_LIST,
+    ConsentCriterion,
+    Query,
+    QueryParameter,
+    compile_query,
+)
+from cql.consent import ConsentHistory
+from cql.models import Parameter
 
 
 import logging
@@ -16,187 +25,97 @@ import logging
 logging.basicConfig(level=logging.DEBUG, format="%(levelname)s:%(message)s")
 
 
-class Granularity(Enum):
-    RESOURCES = "RESOURCES"
-    COUNT = "COUNT"
-
-
 FHIR_BASE_URL = "http://localhost:8089/fhir"
+FHIR_CLIENT_POOL_SIZE = 100
+FHIR_CLIENT_POOL_SIZE_PER_HOST = 32
+FHIR_REGISTRY_PATH = "./cql_registry.sqlite"
+RESULT_CACHE_PATH = "./cql_cache.sqlite"  # results are reused until a Consent or a Specimen changes
+FHIR_TRANSACTION = True  # if True, the Library and the Measure are created with a single transaction Bundle
+FHIR_GC_TTL = 24 * 60 * 60  # transient resources left by crashed runs are deleted after this many seconds
 FHIR_SPECIMEN_RESOURCE_URL = f"{FHIR_BASE_URL}/Specimen"
 FHIR_PATIENT_RESOURCE_URL = f"{FHIR_BASE_URL}/Patient"
 FHIR_ORGANIZATION_RESOURCE_URL = f"{FHIR_BASE_URL}/Organization"
-FHIR_REQUEST_HEADER = {"Content-type": "application/fhir+json"}
-MAX_RESULTS = 11000
-FHIR_LIBRARY_VERSION = "0.1.1"
-FHIR_MEASURE_YEAR_VERSION = "0.1.1"
-FHIR_MEASURE_EVALUATION_YEAR_START = "1900"
-FHIR_MEASURE_EVALUATION_YEAR_END = "2100"
+PAGE_SIZE = 1000  # resources retrieved per page with RESOURCES granularity
 CQL_QUERY_CONTEXT = "Specimen"  # This can be Specimen or  Patient
 CQL_QUERY_GRANULARITY = Granularity.COUNT  # it can be count or resources
+CQL_QUERY_PARAMETERIZED = False  # if True, the CCEs are passed as CQL parameters
+# e.g. "2025-03-01": count the Specimens permitting the CCEs at that time. The
+# as-of count follows the consent index: the Specimens that permitted ALL the
+# CCEs under an active Consent, the latest provision winning, while the CQL
+# query matches the Specimens with any provision (permit or deny) on ANY of the
+# CCEs, whatever the Consent status, so with more CCEs the two differ
+CONSENT_AS_OF = None
 CCEs = ["CONTACT_TO_PARTICIPATE"]  # Common Condition Elements codes
 
 
-def encode(string):
-    return base64.b64encode(string.encode("ascii"))
-
-
-def generate_uuid():
-    return "urn:uuid:{uuid}".format(uuid=uuid.uuid1())
-
-
-def generate_creation_timestamp():
-    return f"{datetime.today().strftime('%Y-%m-%dT%H:%M:%S.%f%z')[:-3]}Z"
+FHIR_CLIENT = FHIRClient(
+    FHIR_BASE_URL,
+    pool_size=FHIR_CLIENT_POOL_SIZE,
+    pool_size_per_host=FHIR_CLIENT_POOL_SIZE_PER_HOST,
+)
+COLLECTOR = ResourceCollector(FHIR_CLIENT, ttl=FHIR_GC_TTL)
+QUERY_CLIENT = CQLQueryClient(
+    FHIR_CLIENT,
+    collector=COLLECTOR,
+    subject=CQL_QUERY_CONTEXT,
+    registry=LibraryRegistry(FHIR_REGISTRY_PATH),
+    cache=ResultCache(path=RESULT_CACHE_PATH),
+    page_size=PAGE_SIZE,
+    transaction=FHIR_TRANSACTION,
+)
 
 
-def generate_id():
-    return secrets.token_hex(8)
-
-
-def perform_fhir_api_request(method, url, json=None, params=None):
-    try:
-        res = requests.request(
-            method,
-            url,
-            json=json.get_resource() if json is not None else None,
-            params=params if params is not None else None,
-            headers=FHIR_REQUEST_HEADER,
-        )
-    except requests.exceptions.ConnectionError:
-        raise web.HTTPInternalServerError(reason="Error contacting data service")
-
-    logging.debug("Performing request to %s" % url)
-    if res.status_code not in (200, 201):
-        logging.debug(
-            "Error performing the request. Returned code %s" % res.status_code
-        )
-        raise Exception(res.json())
-    return res.json()
+def perform_cql_query(cql_query: str, granularity: Granularity, parameters=None):
+    return QUERY_CLIENT.perform_cql_query(cql_query, granularity, parameters)
 
 
 def create_cql_query(context: str, CCEs: list):
-    return f"""
-    library ConsentSpecimenQuery version '1.0.0'
-    using FHIR version '4.0.0'
-    include FHIRHelpers version '4.0.0'
-    context Unfiltered
-    
-    define SpecimenIdsReferencedInConsent:
-        flatten (
-            [Consent] C
-            return flatten (
-                C.provision.provision Q
-                return flatten (
-                    Q.data D
-                    where Q.code.coding.system = 'https://fhir.bbmri.de/CodeSystem/common-condition-elements-cs'
-                    and Q.code.coding.code in List<String>{{{','.join("'"+cce+"'" for cce in CCEs)}}}
-                    return Split(D.reference.reference, '/')[1]
-                    )
-                )
-        )
-        
-    context {context}
-    
-   define InInitialPopulation:
-        exists (
-            from [Specimen] S
-            where S.id in SpecimenIdsReferencedInConsent
-        )
-    """
-
-
-def create_library(base64_cql_query, url):
-    return Library(
-        version_id=FHIR_LIBRARY_VERSION,
-        last_updated=generate_creation_timestamp(),
-        data=base64_cql_query.decode("ascii"),
-        id=generate_id(),
-        url=url,
-    )
+    return compile_query(Query(context, [ConsentCriterion(CCEs)]))
 
 
-def create_measure(populations, url):
-    return Measure(
-        stratifiers=[],
-        populations=populations,
-        version_id=FHIR_MEASURE_YEAR_VERSION,
-        last_updated=generate_creation_timestamp(),
-        subject=CQL_QUERY_CONTEXT,
-        library_url=url,
-        id=generate_id(),
+def create_parameterized_cql_query(context: str):
+    return compile_query(
+        Query(context, [ConsentCriterion(QueryParameter("CCECodes", STRING_LIST))])
     )
 
 
-def create_evaluation_measure(report_type):
-    return EvaluationMeasure(
-        period_start=FHIR_MEASURE_EVALUATION_YEAR_START,
-        period_end=FHIR_MEASURE_EVALUATION_YEAR_END,
-        report_type=report_type,
-    )
+def create_cql_query_parameters(CCEs: list):
+    return [Parameter("CCECodes", cce) for cce in CCEs]
 
 
-def perform_cql_query(cql_query: str, granularity: Granularity):
-    logging.debug(cql_query)
-    base64_cql = encode(cql_query)
-    logging.debug("Creating Library")
-    library_url = generate_uuid()
-    library = create_library(base64_cql, library_url)
-    logging.debug("POST Library")
-    l = perform_fhir_api_request("POST", f"{FHIR_BASE_URL}/Library", library)
-    logging.debug("Library created")
-    populations = [
-        Population(expression="InInitialPopulation", code="initial-population")
-    ]
-    measure = create_measure(populations, library_url)
-    logging.debug("Creating Measure")
-    logging.debug(measure.get_resource())
-    created_measure = perform_fhir_api_request(
-        "POST", f"{FHIR_BASE_URL}/Measure", measure
-    )
-    logging.debug("Measure created")
-    measure_id = created_measure["id"]
-    report_type = EvaluationMeasure.SUBJECT_LIST
-    evaluation_measure = create_evaluation_measure(report_type)
-    logging.debug("Evaluating Measure")
-    logging.debug(evaluation_measure.get_resource())
-    evaluation_measure_results = perform_fhir_api_request(
-        "POST",
-        f"{FHIR_BASE_URL}/Measure/{measure_id}/$evaluate-measure",
-        json=evaluation_measure,
-    )
-    logging.debug("Measure evaluated")
-    logging.debug(evaluation_measure_results)
-
-    num = evaluation_measure_results["group"][0]["population"][0]["count"]
-    if granularity == Granularity.COUNT:
-        return num
-    list_id = evaluation_measure_results["group"][0]["population"][0]["subjectResults"][
-        "reference"
-    ][5:]
-    params = {"_list": list_id, "_count": MAX_RESULTS}
-    fhir_entries = perform_fhir_api_request(
-        "GET", f"{FHIR_BASE_URL}/{CQL_QUERY_CONTEXT}", params=params
-    )
-    logging.debug(fhir_entries)
-    return fhir_entries
+def count_specimens_as_of(moment, CCEs: list):
+    history = ConsentHistory().load(FHIR_CLIENT)
+    return history.count(moment, permit=CCEs)
 
 
 def main():
-    query = create_cql_query(CQL_QUERY_CONTEXT, CCEs)
-    qry_result = perform_cql_query(query, CQL_QUERY_GRANULARITY)
-    num = (
-        qry_result
-        if CQL_QUERY_GRANULARITY == Granularity.COUNT
-        else len(qry_result["entry"])
-    )
-    logging.info(
-        f"Found {num} {CQL_QUERY_CONTEXT}(s) according to the correspondent parameters."
-    )
+    if CONSENT_AS_OF is not None:
+        num = count_specimens_as_of(CONSENT_AS_OF, CCEs)
+        logging.info(f"Found {num} Specimen(s) permitting all of {CCEs} on {CONSENT_AS_OF}.")
+        return
+    if CQL_QUERY_PARAMETERIZED:
+        query = create_parameterized_cql_query(CQL_QUERY_CONTEXT)
+        parameters = create_cql_query_parameters(CCEs)
+    else:
+        query = create_cql_query(CQL_QUERY_CONTEXT, CCEs)
+        parameters = None
     if CQL_QUERY_GRANULARITY == Granularity.RESOURCES:
         logging.info("RESOURCES:")
-        logging.info(json.dumps(qry_result, indent=2, sort_keys=True))
+        num = 0
+        for resource in QUERY_CLIENT.iter_resources(query, parameters):
+            logging.info(json.dumps(resource, indent=2, sort_keys=True))
+            num += 1
     else:
+        num = perform_cql_query(query, CQL_QUERY_GRANULARITY, parameters)
+    logging.info(
+        f"Found {num} {CQL_QUERY_CONTEXT}(s) according to the correspondent parameters."
+    )
+    if CQL_QUERY_GRANULARITY == Granularity.COUNT:
         logging.info("No resources to show, as the granularity is COUNT")
 
-
 if __name__ == "__main__":
-    main()
+    COLLECTOR.sweep()
+    try:
+        main()
+    finally:
+        COLLECTOR.flush()
@@ -0,0 +1,153 @@
+import csv
+import json
+import random
+import time
+
+from cql.client import (
+    FHIRClient,
+    CQLQueryClient,
+    Granularity,
+    PhaseTimer,
+    ResourceCollector,
+)
+from cql.client.timing import summarize
+from cql.compiler import (
+    SPECIMEN,
+    ConsentCriterion,
+    DiagnosisCriterion,
+    GenderCriterion,
+    Query,
+    SampleTypeCriterion,
+    compile_query,
+)
+from cql.mock import MockServer, create_dataset
+
+import logging
+
+from test.valuesets import DISEASES, CCEs
+
+# payloads are not logged, so that logging does not weigh on the timings
+logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(message)s")
+
+
+FHIR_BASE_URL = "http://localhost:8089/fhir"
+FHIR_MOCK = False  # if True, queries go to an in-process cql.mock server instead of FHIR_BASE_URL
+FHIR_MOCK_PATIENTS = 10000  # Patients of the mock dataset, with 4 Specimens each
+FHIR_MOCK_LATENCY = {"evaluate": 0.0}  # seconds the mock server waits before answering, by request kind
+FHIR_TRANSACTION = False  # if True, Library and Measure are timed together in the transaction phase
+FHIR_GC_TTL = 24 * 60 * 60  # transient resources left by crashed runs are deleted after this many seconds
+CQL_QUERY_GRANULARITY = Granularity.COUNT  # with RESOURCES, the fetch of the subject List is timed too
+WARMUP_RUNS = 10  # runs per variant whose timings are discarded
+NUMBER_OF_RUNS = 1000  # measured runs per variant
+RANDOM_SEED = 42
+REPORT_NAME = "./Benchmark_report"  # .csv with every run, .json with the statistics
+SAMPLE_TYPES = ['dna', 'whole-blood', 'urine', 'blood-serum', 'tissue-other', 'saliva', 'blood-plasma']
+PHASES = ["library", "measure", "transaction", "evaluate", "fetch"]
+WITH_CONSENT = "with_consent"
+WITHOUT_CONSENT = "without_consent"
+
+TIMER = PhaseTimer()
+if FHIR_MOCK:
+    # measures the overhead of the client alone, against an in-memory dataset
+    MOCK_SERVER = MockServer(
+        create_dataset(FHIR_MOCK_PATIENTS, seed=RANDOM_SEED), latency=FHIR_MOCK_LATENCY
+    )
+    FHIR_BASE_URL = MOCK_SERVER.start()
+FHIR_CLIENT = FHIRClient(FHIR_BASE_URL)
+COLLECTOR = ResourceCollector(FHIR_CLIENT, ttl=FHIR_GC_TTL)
+# no registry: every run creates its Library and Measure, as in the original benchmark
+QUERY_CLIENT = CQLQueryClient(
+    FHIR_CLIENT,
+    collector=COLLECTOR,
+    subject=SPECIMEN,
+    transaction=FHIR_TRANSACTION,
+    timer=TIMER,
+)
+
+
+def create_query_spec(rng):
+    return (
+        rng.choice(CCEs),
+        rng.choice(["permit", "deny"]),
+        rng.choice(DISEASES),
+        rng.choice(SAMPLE_TYPES),
+        rng.choice(["male", "female"]),
+    )
+
+
+def create_query(variant, spec):
+    cce_code, cce_choice, diagnosis_code, sample_type, patient_gender = spec
+    criteria = [
+        DiagnosisCriterion(diagnosis_code),
+        SampleTypeCriterion(sample_type),
+        GenderCriterion(patient_gender),
+    ]
+    if variant == WITH_CONSENT:
+        criteria.append(ConsentCriterion([cce_code], cce_choice))
+    return compile_query(Query(SPECIMEN, criteria))
+
+
+def run_query(variant, spec):
+    query = create_query(variant, spec)
+    # the deletions of the previous runs must not overlap the timed one
+    COLLECTOR.flush()
+    TIMER.reset()
+    start = time.perf_counter_ns()
+    result = QUERY_CLIENT.perform_cql_query(query, CQL_QUERY_GRANULARITY)
+    total = time.perf_counter_ns() - start
+    count = result if CQL_QUERY_GRANULARITY == Granularity.COUNT else result["total"]
+    return count, total, dict(TIMER.phases)
+
+
+def main(number_of_runs, warmup_runs):
+    rng = random.Random(RANDOM_SEED)
+    rows = []
+    for i in range(warmup_runs + number_of_runs):
+        spec = create_query_spec(rng)
+        # both variants run the same spec back to back, alternating which one
+        # goes first, so that a drift of the server affects them equally
+        variants = [WITH_CONSENT, WITHOUT_CONSENT]
+        for variant in variants if i % 2 == 0 else variants[::-1]:
+            count, total, phases = run_query(variant, spec)
+            if i < warmup_runs:
+                continue
+            row = {"run": i - warmup_runs, "variant": variant}
+            row.update(zip(["cce_code", "cce_choice", "diagnosis_code", "sample_type", "patient_gender"], spec))
+            row.update({"count": count, "total_ns": total})
+            row.update({f"{p}_ns": phases.get(p, 0) for p in PHASES})
+            rows.append(row)
+        if i >= warmup_runs:
+            logging.info(f"Run {i - warmup_runs + 1}/{number_of_runs} done")
+
+    with open(f"{REPORT_NAME}.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    statistics = {
+        "seed": RANDOM_SEED,
+        "warmup_runs": warmup_runs,
+        "runs": number_of_runs,
+        "granularity": CQL_QUERY_GRANULARITY.value,
+        "unit": "ms",
+        "variants": {},
+    }
+    for variant in (WITH_CONSENT, WITHOUT_CONSENT):
+        variant_rows = [r for r in rows if r["variant"] == variant]
+        statistics["variants"][variant] = {
+            column[:-3]: summarize([r[column] / 1e6 for r in variant_rows])
+            for column in ["total_ns"] + [f"{p}_ns" for p in PHASES]
+        }
+    with open(f"{REPORT_NAME}.json", "w") as f:
+        json.dump(statistics, f, indent=2)
+    for variant, phases in statistics["variants"].items():
+        total = phases["total"]
+        logging.info(f"{variant}: p50 {total['p50']:.1f} ms, p95 {total['p95']:.1f} ms, p99 {total['p99']:.1f} ms")
+
+
+if __name__ == "__main__":
+    COLLECTOR.sweep()
+    try:
+        main(NUMBER_OF_RUNS, WARMUP_RUNS)
+    finally:
+        COLLECTOR.flush()
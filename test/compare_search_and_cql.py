@@ -0,0 +1,148 @@
+import random
+import time
+from functools import partial
+
+from cql.client import (
+    FHIRClient,
+    CQLQueryClient,
+    FHIRRequestError,
+    Granularity,
+    LibraryRegistry,
+    ResourceCollector,
+)
+from cql.compiler import (
+    SPECIMEN,
+    ConsentCriterion,
+    DiagnosisCriterion,
+    GenderCriterion,
+    Query,
+    SampleTypeCriterion,
+    compile_query,
+)
+from cql.compiler.search import plan_search
+from cql.client.cache import canonicalize_cql_query
+from cql.mock import MockServer, create_dataset
+from cql.mock.dataset import DIAGNOSES as MOCK_DIAGNOSES
+from cql.offline import CohortEngine
+
+import logging
+
+from test.valuesets import DISEASES
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(message)s")
+
+
+FHIR_BASE_URL = "http://localhost:8089/fhir"
+FHIR_MOCK = False  # if True, both paths go to an in-process cql.mock server, whose CQL is evaluated by cql.offline
+FHIR_MOCK_PATIENTS = 2000  # Patients of the mock dataset, with 4 Specimens and a Consent each
+FHIR_REGISTRY_PATH = "./cql_registry.sqlite"
+FHIR_GC_TTL = 24 * 60 * 60  # transient resources left by crashed runs are deleted after this many seconds
+NUMBER_OF_QUERIES = 50
+RANDOM_SEED = 42
+CCEs = ["CONTACT_TO_PARTICIPATE", "DATA_LINKAGE", "COMMERCIAL_USE"]  # Common Condition Elements codes
+SAMPLE_TYPES = ['dna', 'whole-blood', 'urine', 'blood-serum', 'tissue-other', 'saliva', 'blood-plasma']
+
+# the compiled CQL of the queries sent, by canonical text, for the mock
+QUERIES = {}
+if FHIR_MOCK:
+    # the mock answers the searches by the custom SearchParameters, and the
+    # CQL by the offline engine, which follows the CQL semantics: any
+    # difference in the counts is a difference between the two paths
+    MOCK_DATASET = list(create_dataset(FHIR_MOCK_PATIENTS, seed=RANDOM_SEED, consents=True))
+    ENGINE = CohortEngine(MOCK_DATASET)
+    MOCK_SERVER = MockServer(
+        MOCK_DATASET,
+        cql_evaluator=lambda cql_query, parameters: (
+            ENGINE.evaluate(QUERIES[canonicalize_cql_query(cql_query)])
+            if canonicalize_cql_query(cql_query) in QUERIES
+            else None
+        ),
+    )
+    FHIR_BASE_URL = MOCK_SERVER.start()
+FHIR_CLIENT = FHIRClient(FHIR_BASE_URL)
+COLLECTOR = ResourceCollector(FHIR_CLIENT, ttl=FHIR_GC_TTL)
+QUERY_CLIENT = CQLQueryClient(
+    FHIR_CLIENT,
+    collector=COLLECTOR,
+    subject=SPECIMEN,
+    registry=LibraryRegistry(FHIR_REGISTRY_PATH),
+)
+
+
+def create_random_query(rng, diseases):
+    return Query(
+        SPECIMEN,
+        [
+            ConsentCriterion([rng.choice(CCEs)], rng.choice(["permit", "deny"])),
+            DiagnosisCriterion(rng.choice(diseases)),
+            SampleTypeCriterion(rng.choice(SAMPLE_TYPES)),
+            GenderCriterion(rng.choice(["male", "female"])),
+        ],
+    )
+
+
+def time_call(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def time_search(params, granularity):
+    # the search is always sent as such: if the server does not support it the
+    # comparison fails, rather than falling back to comparing the CQL with itself
+    try:
+        return time_call(QUERY_CLIENT.perform_search, params, granularity)
+    except FHIRRequestError as e:
+        logging.warning(f'Search failed with status {e.status}: {e.outcome}')
+        return None, None
+
+
+def main(number_of_queries):
+    rng = random.Random(RANDOM_SEED)
+    f = open(f'./Search_vs_CQL_report_{number_of_queries}_queries.csv', 'w')
+    f.write('query;search_count;search_time;cql_count;cql_time\n')
+    search_times, cql_times, mismatches = [], [], 0
+    diseases = MOCK_DIAGNOSES if FHIR_MOCK else DISEASES
+    for i in range(number_of_queries):
+        query = create_random_query(rng, diseases)
+        QUERIES[canonicalize_cql_query(compile_query(query))] = query
+        # the two paths are interleaved, in alternating order, so that
+        # both see the same server state and caches
+        calls = [
+            ("search", time_search, plan_search(query)),
+            ("cql", partial(time_call, QUERY_CLIENT.perform_cql_query), compile_query(query)),
+        ]
+        results = {}
+        for path, function, argument in calls if i % 2 == 0 else calls[::-1]:
+            # the deletions of the previous query must not overlap the timed one
+            COLLECTOR.flush()
+            results[path] = function(argument, Granularity.COUNT)
+        search_count, search_time = results["search"]
+        cql_count, cql_time = results["cql"]
+        if search_time is not None:
+            search_times.append(search_time)
+        cql_times.append(cql_time)
+        if search_count is None:
+            mismatches += 1
+            logging.warning(f'Query {i}: no count from search, {cql_count} from CQL')
+        elif search_count != cql_count:
+            mismatches += 1
+            logging.warning(f'Query {i}: {search_count} from search, {cql_count} from CQL')
+        f.write(f'{i};{search_count};{search_time};{cql_count};{cql_time}\n')
+    f.close()
+    if search_times:
+        logging.info(f'Search: mean {sum(search_times) / len(search_times):.3f} s')
+    logging.info(f'CQL: mean {sum(cql_times) / len(cql_times):.3f} s')
+    logging.info(f'Queries with different or missing counts: {mismatches}')
+    return mismatches
+
+
+if __name__ == "__main__":
+    COLLECTOR.sweep()
+    try:
+        if main(NUMBER_OF_QUERIES):
+            raise SystemExit(1)
+    finally:
+        COLLECTOR.flush()
+        if FHIR_MOCK:
+            MOCK_SERVER.close()
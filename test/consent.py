@@ -30,11 +30,12 @@ def create_specimens_provision(provision_type, specimen_ids, cce_code, timestamp
             }
 
 
-def create_consent_resource(consent_id, patient_id, biobank_id, main_provision_timestamp,specimen_provisions):
-    consent_template = {
+def create_consent_bundle(consent_id, patient_id, biobank_id, main_provision_timestamp, specimen_provisions,
+                          full_url=None):
+    return {
       "entry": [
         {
-          "fullUrl": f'{uuid.uuid4()}',
+          "fullUrl": full_url if full_url is not None else f'{uuid.uuid4()}',
           "request": {
             "method": "PUT",
             "url": f'Consent/consent-urn-test-part-{consent_id}'
@@ -102,6 +103,26 @@ def create_consent_resource(consent_id, patient_id, biobank_id, main_provision_t
       "type": "transaction",
       "resourceType": "Bundle"
     }
-    f = open(f'./fhir_consents_output/consent_patient_{patient_id}.json', 'w')
-    json.dump(consent_template, f, indent=2)
 
+
+class ConsentWriter:
+    """
+    Writes each consent Bundle to its own file in output_dir, as soon as it is
+    created, so that nothing is kept in memory
+    """
+
+    def __init__(self, output_dir='./fhir_consents_output'):
+        self.output_dir = output_dir
+
+    def write(self, patient_id, bundle):
+        with open(f'{self.output_dir}/consent_patient_{patient_id}.json', 'w') as f:
+            json.dump(bundle, f, indent=2)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,15 +1,32 @@
-import base64
 import json
 import random
-import secrets
-import uuid
-import requests
 from datetime import datetime
 
 from datetime import datetime
-from cql.models import Library, Population, Measure, EvaluationMeasure
-from aiohttp import web
-from enum import Enum
+from cql.client import (
+    FHIRClient,
+    CQLQueryClient,
+    Granularity,
+    LibraryRegistry,
+    ResourceCollector,
+    BatchExecutor,
+)
+from cql.client.cube import CCE_DECISION, DIAGNOSIS, GENDER, SAMPLE_TYPE, perform_cube_query
+from cql.compiler import (
+    SPECIMEN,
+    STRING_LIST,
+    ConsentCriterion,
+    DiagnosisCriterion,
+    GenderCriterion,
+    Query,
+    QueryParameter,
+    SampleTypeCriterion,
+    SpecimenIdsCriterion,
+    SpecimenListCriterion,
+    compile_query,
+)
+from cql.consent import ConsentIndex, ConsentLists, PERMIT
+from cql.models import Parameter
 
 
 import logging
@@ -19,198 +36,123 @@ from test.valuesets import DISEASES, SAMPLE_TYPES
 logging.basicConfig(level=logging.DEBUG, format="%(levelname)s:%(message)s")
 
 
-class Granularity(Enum):
-    RESOURCES = "RESOURCES"
-    COUNT = "COUNT"
-
-
 FHIR_BASE_URL = "http://localhost:8089/fhir"
+FHIR_CLIENT_POOL_SIZE = 100
+FHIR_CLIENT_POOL_SIZE_PER_HOST = 32
+FHIR_REGISTRY_PATH = "./cql_registry.sqlite"
+FHIR_TRANSACTION = True  # if True, the Library and the Measure are created with a single transaction Bundle
+FHIR_GC_TTL = 24 * 60 * 60  # transient resources left by crashed runs are deleted after this many seconds
 FHIR_SPECIMEN_RESOURCE_URL = f"{FHIR_BASE_URL}/Specimen"
 FHIR_PATIENT_RESOURCE_URL = f"{FHIR_BASE_URL}/Patient"
 FHIR_ORGANIZATION_RESOURCE_URL = f"{FHIR_BASE_URL}/Organization"
-FHIR_REQUEST_HEADER = {"Content-type": "application/fhir+json"}
-MAX_RESULTS = 11000
-FHIR_LIBRARY_VERSION = "0.1.1"
-FHIR_MEASURE_YEAR_VERSION = "0.1.1"
-FHIR_MEASURE_EVALUATION_YEAR_START = "1900"
-FHIR_MEASURE_EVALUATION_YEAR_END = "2100"
+PAGE_SIZE = 1000  # resources retrieved per page with RESOURCES granularity
 CQL_QUERY_GRANULARITY = Granularity.COUNT  # it can be count or resources
+CQL_QUERY_PARAMETERIZED = False  # if True, the query values are passed as CQL parameters
+CQL_QUERY_CONCURRENCY = 1  # if greater than 1, the distinct queries are run concurrently by a BatchExecutor
+CQL_QUERY_CUBE = False  # if True, all the query cells are counted by one stratified evaluation per CCE
+# the index and list sources only keep the decisions in force (active
+# Consents, latest provision), while the CQL matches any provision, whatever
+# the Consent status: with withdrawn or superseded Consents the counts differ
+CONSENT_FROM_CQL = "cql"  # the Consents are evaluated by the CQL query
+CONSENT_FROM_INDEX = "index"  # the consented Specimen ids are passed from the local consent index
+CONSENT_FROM_LIST = "list"  # the consented Specimens are read from a materialized FHIR List
+CQL_QUERY_CONSENT_SOURCE = CONSENT_FROM_CQL  # how the consent check is done when the query is parameterized
 CCEs = ["CONTACT_TO_PARTICIPATE"]  # Common Condition Elements codes
 
-def encode(string):
-    return base64.b64encode(string.encode("ascii"))
-
-
-def generate_uuid():
-    return "urn:uuid:{uuid}".format(uuid=uuid.uuid1())
-
+FHIR_CLIENT = FHIRClient(
+    FHIR_BASE_URL,
+    pool_size=FHIR_CLIENT_POOL_SIZE,
+    pool_size_per_host=FHIR_CLIENT_POOL_SIZE_PER_HOST,
+)
+COLLECTOR = ResourceCollector(FHIR_CLIENT, ttl=FHIR_GC_TTL)
+QUERY_CLIENT = CQLQueryClient(
+    FHIR_CLIENT,
+    collector=COLLECTOR,
+    subject="Specimen",
+    registry=LibraryRegistry(FHIR_REGISTRY_PATH),
+    page_size=PAGE_SIZE,
+    transaction=FHIR_TRANSACTION,
+)
+
+
+def perform_cql_query(cql_query: str, granularity: Granularity, parameters=None):
+    return QUERY_CLIENT.perform_cql_query(cql_query, granularity, parameters)
 
-def generate_creation_timestamp():
-    return f"{datetime.today().strftime('%Y-%m-%dT%H:%M:%S.%f%z')[:-3]}Z"
+def create_cql_query(include_consent, cce_code, cce_choice, diagnosis_code, sample_type, patient_gender):
+    criteria = [
+        DiagnosisCriterion(diagnosis_code),
+        SampleTypeCriterion(sample_type),
+        GenderCriterion(patient_gender),
+    ]
+    if include_consent:
+        criteria.append(ConsentCriterion([cce_code], cce_choice))
+    return compile_query(Query(SPECIMEN, criteria))
 
 
-def generate_id():
-    return secrets.token_hex(8)
+def create_parameterized_cql_query(include_consent, consent_source=CONSENT_FROM_CQL):
+    criteria = [
+        DiagnosisCriterion(QueryParameter("DiagnosisCode")),
+        SampleTypeCriterion(QueryParameter("SampleType")),
+        GenderCriterion(QueryParameter("PatientGender")),
+    ]
+    if include_consent and consent_source == CONSENT_FROM_INDEX:
+        criteria.append(SpecimenIdsCriterion(QueryParameter("ConsentedSpecimenIds", STRING_LIST)))
+    elif include_consent and consent_source == CONSENT_FROM_LIST:
+        criteria.append(SpecimenListCriterion(QueryParameter("ConsentListId")))
+    elif include_consent:
+        criteria.append(ConsentCriterion(QueryParameter("CCECode", STRING_LIST), QueryParameter("CCEChoice")))
+    return compile_query(Query(SPECIMEN, criteria))
+
+
+def create_consent_index_parameters(consent_index, cce_code, cce_choice, diagnosis_code, sample_type, patient_gender):
+    parameters = create_cql_query_parameters(False, cce_code, cce_choice, diagnosis_code, sample_type, patient_gender)
+    if cce_choice == PERMIT:
+        parameters += consent_index.get_parameters("ConsentedSpecimenIds", permit=[cce_code])
+    else:
+        parameters += consent_index.get_parameters("ConsentedSpecimenIds", deny=[cce_code])
+    return parameters
 
 
-def perform_fhir_api_request(method, url, json=None, params=None):
-    try:
-        res = requests.request(
-            method,
-            url,
-            json=json.get_resource() if json is not None else None,
-            params=params if params is not None else None,
-            headers=FHIR_REQUEST_HEADER,
-        )
-    except requests.exceptions.ConnectionError:
-        raise web.HTTPInternalServerError(reason="Error contacting data service")
+def create_consent_list_parameters(consent_lists, cce_code, cce_choice, diagnosis_code, sample_type, patient_gender):
+    parameters = create_cql_query_parameters(False, cce_code, cce_choice, diagnosis_code, sample_type, patient_gender)
+    if cce_choice == PERMIT:
+        list_id = consent_lists.materialize(FHIR_CLIENT, permit=[cce_code])
+    else:
+        list_id = consent_lists.materialize(FHIR_CLIENT, deny=[cce_code])
+    parameters.append(Parameter("ConsentListId", list_id))
+    return parameters
 
-    logging.debug("Performing request to %s" % url)
-    if res.status_code not in (200, 201):
-        logging.debug(
-            "Error performing the request. Returned code %s" % res.status_code
-        )
-        raise Exception(res.json())
-    return res.json()
 
-def create_cql_query(include_consent, cce_code, cce_choice, diagnosis_code, sample_type, patient_gender):
+async def async_create_consent_list_parameters(consent_lists, cce_code, cce_choice, diagnosis_code, sample_type, patient_gender):
+    parameters = create_cql_query_parameters(False, cce_code, cce_choice, diagnosis_code, sample_type, patient_gender)
+    if cce_choice == PERMIT:
+        list_id = await consent_lists.async_materialize(FHIR_CLIENT.async_client, permit=[cce_code])
+    else:
+        list_id = await consent_lists.async_materialize(FHIR_CLIENT.async_client, deny=[cce_code])
+    parameters.append(Parameter("ConsentListId", list_id))
+    return parameters
 
-    query_header = f"""
-    library ConsentSpecimenQuery version '1.0.0'
-    using FHIR version '4.0.0'
-    include FHIRHelpers version '4.0.0'
-    codesystem SampleMaterialType:  'https://fhir.bbmri.de/CodeSystem/SampleMaterialType'
-    codesystem icd10: 'http://hl7.org/fhir/sid/icd-10'
-    define Patient:\n singleton from ([Patient])
-    context {'Unfiltered' if include_consent else 'Specimen'}
-    
-    """
-
-    search_consents_function = f"""
-        define SpecimenIdsReferencedInConsent:
-        flatten (
-            [Consent] C
-            return flatten (
-                C.provision.provision Q
-                return flatten (
-                    Q.data D 
-                    where Q.type = '{cce_choice}' and 
-                    Q.code.coding.code = '{cce_code}'
-                    return Split(D.reference.reference, '/')[1]
-                    )
-                )
-        )
-        
-    """
-
-    specimens_search_function = f"""
-        define FilteredSpecimens:
-        (exists(from Specimen.extension E where E.url = 'https://fhir.bbmri.de/StructureDefinition/SampleDiagnosis' and
-                      ('http://hl7.org/fhir/sid/icd-10' in E.value.coding.system and '{diagnosis_code}' in E.value.coding.code))) and 
-                      (exists from [Patient] P where (P.gender = '{patient_gender}')) and 
-                      (exists(from [Specimen] S where S.type.coding contains Code '{sample_type}' from SampleMaterialType))
-                      
-    """
-
-
-    query = query_header
-    initial_population = "define InInitialPopulation:\n"
-    consent_block =  """
-    
-    exists (
-            from [Specimen] S
-            where S.id in SpecimenIdsReferencedInConsent )
-    """
 
+def create_cql_query_parameters(include_consent, cce_code, cce_choice, diagnosis_code, sample_type, patient_gender):
+    parameters = [
+        Parameter("DiagnosisCode", diagnosis_code),
+        Parameter("SampleType", sample_type),
+        Parameter("PatientGender", patient_gender),
+    ]
     if include_consent:
-        query += search_consents_function
-        query += "context Specimen\n\n"
-        query+= specimens_search_function
-        query += initial_population
-        query+= 'FilteredSpecimens and \n'
-        query += consent_block
+        parameters += [
+            Parameter("CCECode", cce_code),
+            Parameter("CCEChoice", cce_choice),
+        ]
+    return parameters
 
-    else:
-        query += specimens_search_function
-        query += initial_population
-        query += 'FilteredSpecimens'
-
-    return query
-
-def create_library(base64_cql_query, url):
-    return Library(
-        version_id=FHIR_LIBRARY_VERSION,
-        last_updated=generate_creation_timestamp(),
-        data=base64_cql_query.decode("ascii"),
-        id=generate_id(),
-        url=url,
-    )
-
-
-def create_measure(populations, url):
-    return Measure(
-        stratifiers=[],
-        populations=populations,
-        version_id=FHIR_MEASURE_YEAR_VERSION,
-        last_updated=generate_creation_timestamp(),
-        subject='Specimen',
-        library_url=url,
-        id=generate_id(),
-    )
-
-
-def create_evaluation_measure(report_type):
-    return EvaluationMeasure(
-        period_start=FHIR_MEASURE_EVALUATION_YEAR_START,
-        period_end=FHIR_MEASURE_EVALUATION_YEAR_END,
-        report_type=report_type,
-    )
-
-
-def perform_cql_query(cql_query: str, granularity: Granularity):
-    logging.debug(cql_query)
-    base64_cql = encode(cql_query)
-    logging.debug("Creating Library")
-    library_url = generate_uuid()
-    library = create_library(base64_cql, library_url)
-    logging.debug("POST Library")
-    l = perform_fhir_api_request("POST", f"{FHIR_BASE_URL}/Library", library)
-    logging.debug("Library created")
-    populations = [
-        Population(expression="InInitialPopulation", code="initial-population")
-    ]
-    measure = create_measure(populations, library_url)
-    logging.debug("Creating Measure")
-    logging.debug(measure.get_resource())
-    created_measure = perform_fhir_api_request(
-        "POST", f"{FHIR_BASE_URL}/Measure", measure
-    )
-    logging.debug("Measure created")
-    measure_id = created_measure["id"]
-    report_type = EvaluationMeasure.SUBJECT_LIST
-    evaluation_measure = create_evaluation_measure(report_type)
-    logging.debug("Evaluating Measure")
-    logging.debug(evaluation_measure.get_resource())
-    evaluation_measure_results = perform_fhir_api_request(
-        "POST",
-        f"{FHIR_BASE_URL}/Measure/{measure_id}/$evaluate-measure",
-        json=evaluation_measure,
-    )
-    logging.debug("Measure evaluated")
-    logging.debug(evaluation_measure_results)
-
-    num = evaluation_measure_results["group"][0]["population"][0]["count"]
-    if granularity == Granularity.COUNT:
-        return num
-    list_id = evaluation_measure_results["group"][0]["population"][0]["subjectResults"][
-        "reference"
-    ][5:]
-    params = {"_list": list_id, "_count": MAX_RESULTS}
-    fhir_entries = perform_fhir_api_request(
-        "GET", f"{FHIR_BASE_URL}/Specimen", params=params
-    )
-    logging.debug(fhir_entries)
-    return fhir_entries
+def create_query_spec():
+    cce_code = random.choice(CCEs)
+    cce_choice = random.choice(['permit', 'deny'])
+    diagnosis_code = random.choice(DISEASES)
+    sample_type = random.choice(['dna', 'whole-blood', 'urine', 'blood-serum', 'tissue-other', 'saliva', 'blood-plasma'])
+    patient_gender = random.choice(["male", "female"])
+    return cce_code, cce_choice, diagnosis_code, sample_type, patient_gender
 
 
 def main(include_consent, number_of_iterations):
@@ -219,34 +161,110 @@ def main(include_consent, number_of_iterations):
     report_name = f'./Evaluation_report_{number_of_iterations}_iterations_{spec_cons if include_consent else spec_only}.csv'
     f = open(report_name, 'w')
     f.write('iteration;number_of_retrieved_samples;execution_time\n')
+    consent_index = consent_lists = None
+    if include_consent and CQL_QUERY_PARAMETERIZED and CQL_QUERY_CONSENT_SOURCE != CONSENT_FROM_CQL:
+        logging.info("Building the consent index")
+        consent_index = ConsentIndex().load(FHIR_CLIENT)
+        consent_lists = ConsentLists(consent_index)
     for i in range(0, number_of_iterations):
-        cce_code = random.choice(CCEs)
-        cce_choice = random.choice(['permit', 'deny'])
-        diagnosis_code = random.choice(DISEASES)
-        sample_type = random.choice(['dna', 'whole-blood', 'urine', 'blood-serum', 'tissue-other', 'saliva', 'blood-plasma'])
-        patient_gender = random.choice(["male", "female"])
-        query = create_cql_query(include_consent, cce_code, cce_choice, diagnosis_code,sample_type, patient_gender)
+        cce_code, cce_choice, diagnosis_code, sample_type, patient_gender = create_query_spec()
+        if consent_index is not None and CQL_QUERY_CONSENT_SOURCE == CONSENT_FROM_INDEX:
+            query = create_parameterized_cql_query(include_consent, CONSENT_FROM_INDEX)
+            parameters = create_consent_index_parameters(consent_index, cce_code, cce_choice, diagnosis_code, sample_type, patient_gender)
+        elif consent_lists is not None:
+            query = create_parameterized_cql_query(include_consent, CONSENT_FROM_LIST)
+            parameters = create_consent_list_parameters(consent_lists, cce_code, cce_choice, diagnosis_code, sample_type, patient_gender)
+        elif CQL_QUERY_PARAMETERIZED:
+            query = create_parameterized_cql_query(include_consent)
+            parameters = create_cql_query_parameters(include_consent, cce_code, cce_choice, diagnosis_code, sample_type, patient_gender)
+        else:
+            query = create_cql_query(include_consent, cce_code, cce_choice, diagnosis_code,sample_type, patient_gender)
+            parameters = None
+        # the deletions of the previous iteration must not overlap the timed one
+        COLLECTOR.flush()
         start = datetime.now()
-        qry_result = perform_cql_query(query, CQL_QUERY_GRANULARITY)
-        num = (
-            qry_result
-            if CQL_QUERY_GRANULARITY == Granularity.COUNT
-            else len(qry_result["entry"])
-        )
-        logging.info(
-            f"Found {num} Specimen(s) according to the correspondent parameters."
-        )
         if CQL_QUERY_GRANULARITY == Granularity.RESOURCES:
             logging.info("RESOURCES:")
-            logging.info(json.dumps(qry_result, indent=2, sort_keys=True))
+            num = 0
+            for resource in QUERY_CLIENT.iter_resources(query, parameters):
+                logging.info(json.dumps(resource, indent=2, sort_keys=True))
+                num += 1
         else:
+            num = perform_cql_query(query, CQL_QUERY_GRANULARITY, parameters)
+        logging.info(
+            f"Found {num} Specimen(s) according to the correspondent parameters."
+        )
+        if CQL_QUERY_GRANULARITY == Granularity.COUNT:
             logging.info("No resources to show, as the granularity is COUNT")
         end = datetime.now()
-        execution_time = (end - start).seconds
+        execution_time = (end - start).total_seconds()
         f.write(f"{i};{num};{execution_time}\n")
         logging.info(f'Overall execution time: {execution_time} seconds')
     f.close()
 
 
+def main_batch(include_consent, number_of_queries):
+    report_name = f'./Batch_report_{number_of_queries}_queries_{"spec_cons" if include_consent else "spec_only"}.csv'
+    consent_index = consent_lists = None
+    if include_consent and CQL_QUERY_PARAMETERIZED and CQL_QUERY_CONSENT_SOURCE != CONSENT_FROM_CQL:
+        logging.info("Building the consent index")
+        consent_index = ConsentIndex().load(FHIR_CLIENT)
+        consent_lists = ConsentLists(consent_index)
+
+    # the queries are built on the event loop of FHIR_CLIENT: the Lists must
+    # be uploaded with its async client, the synchronous one would deadlock
+    async def build_query(spec):
+        if consent_index is not None and CQL_QUERY_CONSENT_SOURCE == CONSENT_FROM_INDEX:
+            return create_parameterized_cql_query(include_consent, CONSENT_FROM_INDEX), create_consent_index_parameters(consent_index, *spec)
+        if consent_lists is not None:
+            return create_parameterized_cql_query(include_consent, CONSENT_FROM_LIST), await async_create_consent_list_parameters(consent_lists, *spec)
+        if CQL_QUERY_PARAMETERIZED:
+            return create_parameterized_cql_query(include_consent), create_cql_query_parameters(include_consent, *spec)
+        return create_cql_query(include_consent, *spec), None
+
+    executor = BatchExecutor(QUERY_CLIENT, build_query, granularity=CQL_QUERY_GRANULARITY, concurrency=CQL_QUERY_CONCURRENCY)
+    specs = (create_query_spec() for _ in range(number_of_queries))
+    f = open(report_name, 'w')
+    f.write('cce_code;cce_choice;diagnosis_code;sample_type;patient_gender;number_of_retrieved_samples;execution_time\n')
+    COLLECTOR.flush()
+    start = datetime.now()
+    for result in executor.run(specs):
+        if result.error is not None:
+            logging.error(f'Query {result.spec} failed: {result.error}')
+            continue
+        num = result.result if CQL_QUERY_GRANULARITY == Granularity.COUNT else result.result["total"]
+        f.write(f'{";".join(result.spec)};{num};{result.elapsed}\n')
+    f.close()
+    logging.info(f'Overall execution time: {(datetime.now() - start).total_seconds()} seconds')
+
+
+def main_cube(include_consent):
+    dimensions = [DIAGNOSIS, GENDER, SAMPLE_TYPE]
+    report_name = f'./Cube_report_{"spec_cons" if include_consent else "spec_only"}.csv'
+    f = open(report_name, 'w')
+    f.write(f'cce_code;{";".join(dimensions)};cce_choice;number_of_retrieved_samples;execution_time\n')
+    for cce_code in CCEs if include_consent else [None]:
+        start = datetime.now()
+        if include_consent:
+            rows = perform_cube_query(QUERY_CLIENT, dimensions + [CCE_DECISION], cce_code)
+        else:
+            rows = perform_cube_query(QUERY_CLIENT, dimensions)
+        execution_time = (datetime.now() - start).total_seconds()
+        for row in rows:
+            values = ";".join(str(row[d]) for d in dimensions)
+            f.write(f"{cce_code or ''};{values};{row.get(CCE_DECISION, '')};{row['count']};{execution_time}\n")
+        logging.info(f'Evaluated {len(rows)} cells in {execution_time} seconds')
+    f.close()
+
+
 if __name__ == "__main__":
-    main(True, 10)
+    COLLECTOR.sweep()
+    try:
+        if CQL_QUERY_CUBE:
+            main_cube(True)
+        elif CQL_QUERY_CONCURRENCY > 1:
+            main_batch(True, 10)
+        else:
+            main(True, 10)
+    finally:
+        COLLECTOR.flush()
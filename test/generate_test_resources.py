@@ -28,24 +28,62 @@ from bbmri_fp_etl.models import (
     Sex,
 )
 
+import hashlib
+import multiprocessing
+import os
 import random
-import pandas as pd
-from datetime import datetime
+import shutil
+import uuid
+from datetime import datetime, timedelta
 
 from bbmri_fp_etl.serializer import JsonFile
 from bbmri_fp_etl.sources import AbstractSource
 
-from test.consent import create_specimens_provision, create_consent_resource
+from test.consent import ConsentWriter, create_consent_bundle, create_specimens_provision
+from test.writers import BundleWriter, NdjsonWriter
 from test.valuesets import DISEASES, SAMPLE_TYPES, CCEs
 
 import logging
 
 logging.basicConfig(level=logging.DEBUG, format="%(levelname)s:%(message)s")
 
+NUMBER_OF_DONORS = 100000
+SHARD_SIZE = 10000  # donors per shard: each shard has its own seed, so the output does not depend on PROCESSES
+PROCESSES = os.cpu_count()
+RANDOM_SEED = 42
+FHIR_OUTPUT = "./fhir_output"
+FHIR_ORGS_OUTPUT = "./fhir_orgs_output"
+FHIR_CONSENTS_OUTPUT = "./fhir_consents_output"
+SPECIMENS_CSV = "./input_data/patient_specimens.csv"
+WRITE_BUFFER_SIZE = 1024 * 1024  # bytes buffered by the specimen rows writer
+# "json": a pretty-printed Bundle file per patient; "ndjson": compact Consents, one per line,
+# in files rolled at NDJSON_MAX_BYTES; "bundle": compact transaction Bundles of BUNDLE_SIZE Consents
+CONSENT_OUTPUT_FORMAT = "json"
+NDJSON_MAX_BYTES = 100 * 1024 * 1024
+BUNDLE_SIZE = 1000
+
+
+def derive_seed(seed, shard):
+    digest = hashlib.sha256(f"{seed}:{shard}".encode("ascii")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
 class ExampleSource(AbstractSource):
-    def __init__(self):
+    def __init__(
+        self,
+        first_donor=0,
+        number_of_donors=NUMBER_OF_DONORS,
+        seed=RANDOM_SEED,
+        specimen_writer=None,
+        consent_writer=None,
+    ):
         super().__init__()
-        self.specimen_rows = []
+        self.first_donor = first_donor
+        self.number_of_donors = number_of_donors
+        self.rng = random.Random(seed)
+        # rows and Bundles are written as the cases are generated
+        self.specimen_writer = specimen_writer
+        self.consent_writer = consent_writer
         self.biobank_id = "test-bb-1"
         self.collection_id = "test-biobank-1-collection-1"
 
@@ -113,7 +151,7 @@ class ExampleSource(AbstractSource):
 
     def _generate_random_sample_disease(self):
         disease_ontology_code = DiseaseOntologyCode(
-            code=random.choice(DISEASES), ontology=DiseaseOntology.ICD_10
+            code=self.rng.choice(DISEASES), ontology=DiseaseOntology.ICD_10
         )
         disease = Disease(main_code=disease_ontology_code, mapping_codes=[])
         return [disease]
@@ -122,27 +160,21 @@ class ExampleSource(AbstractSource):
         start = datetime(start_year, 1, 1)
         end = datetime(end_year, 12, 31)
 
-        random_day = random.randint(0, (end - start).days)
-        birth_date = (
-            pd.to_datetime(start + pd.Timedelta(days=random_day))
-            .normalize()  # sets time to 00:00:00
-            .to_pydatetime()
-        )
-
-        return birth_date
+        random_day = self.rng.randint(0, (end - start).days)
+        return start + timedelta(days=random_day)
 
     def select_random_cces_block(self):
-        x = random.randint(1, len(CCEs))  # x from 1 to 8
-        return random.sample(CCEs, x)
+        x = self.rng.randint(1, len(CCEs))  # x from 1 to 8
+        return self.rng.sample(CCEs, x)
 
     def _generate_case(self, donor_id):
         donor = Donor(
             id=f"{donor_id}",
-            gender=random.choice([Sex.MALE, Sex.FEMALE]),
+            gender=self.rng.choice([Sex.MALE, Sex.FEMALE]),
             birth_date=self._get_random_birth_date(1925, 2010),
         )
         samples = []
-        for i in range(1, random.choice([3, 4, 5, 6])):
+        for i in range(1, self.rng.choice([3, 4, 5, 6])):
             sample_id = f"Sample-{donor_id}-{i}"
             sampling_event = SamplingEvent(
                 id=f"SE-{sample_id}",
@@ -150,12 +182,12 @@ class ExampleSource(AbstractSource):
             )
             sample = Sample(
                 id=sample_id,
-                type=random.choice(SAMPLE_TYPES),
+                type=self.rng.choice(SAMPLE_TYPES),
                 events=[sampling_event],
                 content_diagnosis=self._generate_random_sample_disease(),
                 collection=Collection(id="test-biobank-1collection-1"),
             )
-            self.specimen_rows.append(
+            self.specimen_writer.write(
                 f"{donor_id}"
                 + ";"
                 + donor.gender
@@ -170,36 +202,73 @@ class ExampleSource(AbstractSource):
         sample_provisions = []
         for cce in self.select_random_cces_block():
             sample_consent_provision = create_specimens_provision(
-                random.choice(["permit",'deny']), [s.id for s in samples], cce, "2025-01-24T00:00:00Z"
+                self.rng.choice(["permit",'deny']), [s.id for s in samples], cce, "2025-01-24T00:00:00Z"
             )
             sample_provisions.append(sample_consent_provision)
-        create_consent_resource(
+        consent_bundle = create_consent_bundle(
             f"consent-patient-{donor.id}",
             donor.id,
             self.biobank_id,
             "2025-04-24T00:00:00Z",
             sample_provisions,
+            # drawn from the seeded generator, so that the output is reproducible
+            full_url=f"urn:uuid:{uuid.UUID(int=self.rng.getrandbits(128), version=4)}",
         )
+        self.consent_writer.write(donor.id, consent_bundle)
         return Case(donor=donor, samples=samples)
 
     def get_cases_data(self) -> Iterable[Case]:
-        cases = []
-        for i in range(0, 100000):
-            logging.debug(f'Generating case:{i}')
-            case = self._generate_case(i)
-            cases.append(case)
-        return cases
+        # a generator: the cases are created while the converter consumes them
+        for i in range(self.first_donor, self.first_donor + self.number_of_donors):
+            yield self._generate_case(i)
+
+
+def create_consent_writer(shard):
+    # one set of files per shard, named after it, so that the output is reproducible
+    if CONSENT_OUTPUT_FORMAT == "ndjson":
+        return NdjsonWriter(FHIR_CONSENTS_OUTPUT, f"Consent-{shard:05d}", NDJSON_MAX_BYTES)
+    if CONSENT_OUTPUT_FORMAT == "bundle":
+        return BundleWriter(FHIR_CONSENTS_OUTPUT, f"Consent-{shard:05d}", BUNDLE_SIZE)
+    return ConsentWriter(FHIR_CONSENTS_OUTPUT)
+
+
+def generate_shard(shard):
+    """
+    Generates the cases of the donors of a shard, with a seed derived from
+    RANDOM_SEED and the shard number, writes its resources to its own
+    FHIR_OUTPUT/shard-<n> directory, so that the files of concurrent shards
+    never collide, and its specimen rows to a part of the CSV file
+    """
+    shard_output = os.path.join(FHIR_OUTPUT, f"shard-{shard:05d}")
+    os.makedirs(shard_output, exist_ok=True)
+    first_donor = shard * SHARD_SIZE
+    number_of_donors = min(SHARD_SIZE, NUMBER_OF_DONORS - first_donor)
+    part = f"{SPECIMENS_CSV}.{shard}"
+    with open(part, "w", buffering=WRITE_BUFFER_SIZE) as specimen_writer, \
+            create_consent_writer(shard) as consent_writer:
+        source = ExampleSource(
+            first_donor,
+            number_of_donors,
+            derive_seed(RANDOM_SEED, shard),
+            specimen_writer,
+            consent_writer,
+        )
+        converter_cases = Converter(source, FHIRDest(JsonFile(shard_output)), Converter.CASE)
+        converter_cases.run()
+    logging.info(f'Generated cases {first_donor}-{first_donor + number_of_donors - 1}')
+    return part
 
 
 if __name__ == "__main__":
 
-    source = ExampleSource()
-    fhir_dest_cases = FHIRDest(JsonFile("./fhir_output"))
-    fhir_orgs_cases = FHIRDest(JsonFile("./fhir_orgs_output"))
-    converter_orgs = Converter(source, fhir_orgs_cases, Converter.ORGANIZATION)
+    converter_orgs = Converter(ExampleSource(), FHIRDest(JsonFile(FHIR_ORGS_OUTPUT)), Converter.ORGANIZATION)
     converter_orgs.run()
-    converter_cases = Converter(source, fhir_dest_cases, Converter.CASE)
-    converter_cases.run()
-    f = open("./input_data/patient_specimens.csv", "w")
-    for row in source.specimen_rows:
-        f.write(row)
+    number_of_shards = (NUMBER_OF_DONORS + SHARD_SIZE - 1) // SHARD_SIZE
+    with multiprocessing.Pool(PROCESSES) as pool:
+        parts = pool.map(generate_shard, range(number_of_shards), chunksize=1)
+    # the parts are joined in shard order, whatever the order they were written in
+    with open(SPECIMENS_CSV, "w") as f:
+        for part in parts:
+            with open(part) as p:
+                shutil.copyfileobj(p, f)
+            os.remove(part)
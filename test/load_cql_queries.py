@@ -0,0 +1,145 @@
+import csv
+import json
+
+from cql.client import (
+    FHIRClient,
+    CQLQueryClient,
+    Granularity,
+    LoadGenerator,
+    ResourceCollector,
+)
+from cql.compiler import (
+    SPECIMEN,
+    ConsentCriterion,
+    DiagnosisCriterion,
+    GenderCriterion,
+    Query,
+    SampleTypeCriterion,
+    compile_query,
+)
+from cql.mock import MockServer, create_dataset
+
+import logging
+
+from test.valuesets import DISEASES, CCEs
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(message)s")
+
+
+FHIR_BASE_URL = "http://localhost:8089/fhir"
+FHIR_MOCK = False  # if True, queries go to an in-process cql.mock server instead of FHIR_BASE_URL
+FHIR_MOCK_PATIENTS = 10000  # Patients of the mock dataset, with 4 Specimens each
+FHIR_MOCK_LATENCY = {"evaluate": 0.0}  # seconds the mock server waits before answering, by request kind
+FHIR_TRANSACTION = False
+FHIR_GC_TTL = 24 * 60 * 60  # transient resources left by crashed runs are deleted after this many seconds
+CQL_QUERY_GRANULARITY = Granularity.COUNT
+LOAD_MODE = "open"  # "open": Poisson arrivals at each of ARRIVAL_RATES; "closed": each of USERS users
+ARRIVAL_RATES = [0.5, 1, 2, 4, 8, 16]  # queries per second offered in open loop
+USERS = [1, 2, 4, 8, 16]  # concurrent users in closed loop
+THINK_TIME = 0  # mean seconds a closed-loop user waits between queries
+DURATION = 60  # seconds of each step
+MAX_IN_FLIGHT = 1000  # open-loop arrivals beyond this many running queries are dropped
+RANDOM_SEED = 42
+REPORT_NAME = "./Load_report"  # .csv with a row per step, .json with the timelines
+SAMPLE_TYPES = ['dna', 'whole-blood', 'urine', 'blood-serum', 'tissue-other', 'saliva', 'blood-plasma']
+WITH_CONSENT = "with_consent"
+WITHOUT_CONSENT = "without_consent"
+
+if FHIR_MOCK:
+    # measures the overhead of the client alone, against an in-memory dataset
+    MOCK_SERVER = MockServer(
+        create_dataset(FHIR_MOCK_PATIENTS, seed=RANDOM_SEED), latency=FHIR_MOCK_LATENCY
+    )
+    FHIR_BASE_URL = MOCK_SERVER.start()
+FHIR_CLIENT = FHIRClient(FHIR_BASE_URL)
+COLLECTOR = ResourceCollector(FHIR_CLIENT, ttl=FHIR_GC_TTL)
+# no cache and no coalescing: every arrival is evaluated by the server
+QUERY_CLIENT = CQLQueryClient(
+    FHIR_CLIENT,
+    collector=COLLECTOR,
+    subject=SPECIMEN,
+    transaction=FHIR_TRANSACTION,
+    coalesce=False,
+)
+
+
+def create_query_spec(rng):
+    return (
+        rng.choice(CCEs),
+        rng.choice(["permit", "deny"]),
+        rng.choice(DISEASES),
+        rng.choice(SAMPLE_TYPES),
+        rng.choice(["male", "female"]),
+    )
+
+
+def create_query_builder(variant):
+    def build_query(spec):
+        cce_code, cce_choice, diagnosis_code, sample_type, patient_gender = spec
+        criteria = [
+            DiagnosisCriterion(diagnosis_code),
+            SampleTypeCriterion(sample_type),
+            GenderCriterion(patient_gender),
+        ]
+        if variant == WITH_CONSENT:
+            criteria.append(ConsentCriterion([cce_code], cce_choice))
+        return compile_query(Query(SPECIMEN, criteria)), None
+
+    return build_query
+
+
+def run_step(variant, load):
+    # the deletions of the previous step must not overlap this one
+    COLLECTOR.flush()
+    # the same seed for every step, so that all of them see the same query mix
+    generator = LoadGenerator(
+        QUERY_CLIENT,
+        create_query_builder(variant),
+        create_query_spec,
+        granularity=CQL_QUERY_GRANULARITY,
+        seed=RANDOM_SEED,
+        max_in_flight=MAX_IN_FLIGHT,
+    )
+    if LOAD_MODE == "open":
+        return generator.run_open_loop(load, DURATION)
+    return generator.run_closed_loop(load, DURATION, THINK_TIME)
+
+
+def main():
+    loads = ARRIVAL_RATES if LOAD_MODE == "open" else USERS
+    rows, reports = [], []
+    for load in loads:
+        for variant in (WITH_CONSENT, WITHOUT_CONSENT):
+            report = run_step(variant, load).to_dict()
+            latency = report["latency_ms"]
+            rows.append({
+                "variant": variant,
+                "mode": LOAD_MODE,
+                "load": load,
+                "throughput": report["throughput"],
+                "error_rate": report["error_rate"],
+                "p50_ms": latency["p50"],
+                "p95_ms": latency["p95"],
+                "p99_ms": latency["p99"],
+                "p99.9_ms": latency["p99.9"],
+            })
+            reports.append({"variant": variant, "mode": LOAD_MODE, "load": load, **report})
+            logging.info(
+                f"{variant}, {LOAD_MODE} loop at {load}: {report['throughput']:.2f} queries/s, "
+                f"errors {report['error_rate']:.1%}, p99 {latency['p99']} ms"
+            )
+
+    with open(f"{REPORT_NAME}.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(f"{REPORT_NAME}.json", "w") as f:
+        json.dump({"seed": RANDOM_SEED, "duration": DURATION, "steps": reports}, f, indent=2)
+
+
+if __name__ == "__main__":
+    COLLECTOR.sweep()
+    try:
+        main()
+    finally:
+        COLLECTOR.flush()
@@ -0,0 +1,37 @@
+import itertools
+import os
+
+from cql.mock import load_bundles
+
+import logging
+
+from test.writers import BundleWriter, NdjsonWriter
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(message)s")
+
+
+# the files written by the ETL in test/generate_test_resources.py
+INPUT_FILES = ["./fhir_orgs_output/**/*.json", "./fhir_output/**/*.json"]
+OUTPUT_DIR = "./fhir_packed_output"
+OUTPUT_FORMAT = "bundle"  # "ndjson": resources one per line; "bundle": transaction Bundles of BUNDLE_SIZE resources
+NDJSON_MAX_BYTES = 100 * 1024 * 1024
+BUNDLE_SIZE = 1000
+OUTPUT_PREFIX = "Resources"
+
+
+def main():
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    if OUTPUT_FORMAT == "ndjson":
+        writer = NdjsonWriter(OUTPUT_DIR, OUTPUT_PREFIX, NDJSON_MAX_BYTES)
+    else:
+        writer = BundleWriter(OUTPUT_DIR, OUTPUT_PREFIX, BUNDLE_SIZE)
+    count = 0
+    with writer:
+        for resource in itertools.chain.from_iterable(load_bundles(p) for p in INPUT_FILES):
+            writer.write_resource(resource)
+            count += 1
+    logging.info(f'Packed {count} resources in {writer.files} files')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import itertools
+import random
+import time
+
+from cql.client import (
+    FHIRClient,
+    CQLQueryClient,
+    Granularity,
+    ResourceCollector,
+)
+from cql.compiler import (
+    SPECIMEN,
+    ConsentCriterion,
+    DiagnosisCriterion,
+    GenderCriterion,
+    Query,
+    SampleTypeCriterion,
+    compile_query,
+)
+from cql.mock import load_bundles
+from cql.offline import CohortEngine
+
+import logging
+
+from test.valuesets import DISEASES, CCEs
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(message)s")
+
+
+FHIR_BASE_URL = "http://localhost:8089/fhir"
+FHIR_GC_TTL = 24 * 60 * 60  # transient resources left by crashed runs are deleted after this many seconds
+# the files written by test/generate_test_resources.py and uploaded to Blaze;
+# the Consents are read whatever CONSENT_OUTPUT_FORMAT they were written with
+DATASET_FILES = [
+    "./fhir_output/**/*.json",
+    "./fhir_consents_output/*.json",
+    "./fhir_consents_output/*.ndjson",
+]
+NUMBER_OF_QUERIES = 1000
+RANDOM_SEED = 42
+INCLUDE_CONSENT = True
+SAMPLE_TYPES = ['dna', 'whole-blood', 'urine', 'blood-serum', 'tissue-other', 'saliva', 'blood-plasma']
+
+FHIR_CLIENT = FHIRClient(FHIR_BASE_URL)
+COLLECTOR = ResourceCollector(FHIR_CLIENT, ttl=FHIR_GC_TTL)
+QUERY_CLIENT = CQLQueryClient(FHIR_CLIENT, collector=COLLECTOR, subject=SPECIMEN)
+
+
+def create_query(rng, include_consent):
+    criteria = [
+        DiagnosisCriterion(rng.choice(DISEASES)),
+        SampleTypeCriterion(rng.choice(SAMPLE_TYPES)),
+        GenderCriterion(rng.choice(["male", "female"])),
+    ]
+    cce_code, cce_choice = rng.choice(CCEs), rng.choice(["permit", "deny"])
+    if include_consent:
+        criteria.append(ConsentCriterion([cce_code], cce_choice))
+    return Query(SPECIMEN, criteria)
+
+
+def main(number_of_queries, include_consent):
+    start = time.perf_counter()
+    engine = CohortEngine(
+        itertools.chain.from_iterable(load_bundles(p) for p in DATASET_FILES)
+    )
+    logging.info(f'Loaded {len(engine)} Specimens in {time.perf_counter() - start:.1f} s')
+    rng = random.Random(RANDOM_SEED)
+    f = open(f'./Validation_report_{number_of_queries}_queries.csv', 'w')
+    f.write('query;offline_count;offline_time;cql_count;cql_time\n')
+    offline_times, cql_times, mismatches = [], [], 0
+    for i in range(number_of_queries):
+        query = create_query(rng, include_consent)
+        start = time.perf_counter()
+        offline_count = engine.count(query)
+        offline_time = time.perf_counter() - start
+        # the deletions of the previous query must not overlap the timed one
+        COLLECTOR.flush()
+        start = time.perf_counter()
+        cql_count = QUERY_CLIENT.perform_cql_query(compile_query(query), Granularity.COUNT)
+        cql_time = time.perf_counter() - start
+        offline_times.append(offline_time)
+        cql_times.append(cql_time)
+        if offline_count != cql_count:
+            mismatches += 1
+            logging.warning(f'Query {i}: {offline_count} offline, {cql_count} from CQL')
+        f.write(f'{i};{offline_count};{offline_time};{cql_count};{cql_time}\n')
+    f.close()
+    logging.info(f'Offline: mean {sum(offline_times) / len(offline_times) * 1000:.3f} ms')
+    logging.info(f'CQL: mean {sum(cql_times) / len(cql_times):.3f} s')
+    logging.info(f'Queries with different counts: {mismatches}')
+
+
+if __name__ == "__main__":
+    COLLECTOR.sweep()
+    try:
+        main(NUMBER_OF_QUERIES, INCLUDE_CONSENT)
+    finally:
+        COLLECTOR.flush()
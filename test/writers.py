@@ -0,0 +1,114 @@
+import json
+
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024  # size at which an NDJSON file is rolled
+DEFAULT_BUNDLE_SIZE = 1000  # resources per transaction Bundle
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+def dump_compact(resource):
+    return json.dumps(resource, separators=(",", ":"), ensure_ascii=False)
+
+
+def create_transaction_bundle(resources):
+    return {
+        "resourceType": "Bundle",
+        "type": "transaction",
+        "entry": [
+            {
+                "resource": r,
+                "request": {"method": "PUT", "url": f"{r['resourceType']}/{r['id']}"},
+            }
+            for r in resources
+        ],
+    }
+
+
+class ResourceWriter:
+    """
+    Base class of the writers of generated resources. write(name, bundle)
+    takes a Bundle, like ConsentWriter, and writes each of its resources
+    """
+
+    def write(self, name, bundle):
+        for entry in bundle.get("entry", []):
+            self.write_resource(entry["resource"])
+
+    def write_resource(self, resource):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class NdjsonWriter(ResourceWriter):
+    """
+    Writes the resources as compact JSON, one per line, to
+    <output_dir>/<prefix>-<n>.ndjson files rolled when they reach max_bytes
+    """
+
+    def __init__(self, output_dir, prefix, max_bytes=DEFAULT_MAX_BYTES):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.files = 0
+        self._file = None
+        self._size = 0
+
+    def _roll(self):
+        self.close()
+        self.files += 1
+        self._file = open(
+            f"{self.output_dir}/{self.prefix}-{self.files:05d}.ndjson",
+            "wb",
+            buffering=WRITE_BUFFER_SIZE,
+        )
+        self._size = 0
+
+    def write_resource(self, resource):
+        line = (dump_compact(resource) + "\n").encode("utf-8")
+        if self._file is None or (self._size and self._size + len(line) > self.max_bytes):
+            self._roll()
+        self._file.write(line)
+        self._size += len(line)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+
+
+class BundleWriter(ResourceWriter):
+    """
+    Packs the resources in compact transaction Bundles of bundle_size PUT
+    entries, each written to <output_dir>/<prefix>-<n>.json, ready to be
+    uploaded by blazectl with far fewer requests and files
+    """
+
+    def __init__(self, output_dir, prefix, bundle_size=DEFAULT_BUNDLE_SIZE):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.bundle_size = bundle_size
+        self.files = 0
+        self._resources = []
+
+    def write_resource(self, resource):
+        self._resources.append(resource)
+        if len(self._resources) == self.bundle_size:
+            self.flush()
+
+    def flush(self):
+        if not self._resources:
+            return
+        self.files += 1
+        with open(f"{self.output_dir}/{self.prefix}-{self.files:06d}.json", "w", encoding="utf-8") as f:
+            f.write(dump_compact(create_transaction_bundle(self._resources)))
+        self._resources = []
+
+    def close(self):
+        self.flush()